@@ -0,0 +1,55 @@
+"""
+Benchmark of Bulk Data $export ingestion in bulk_export against paging through Condition searches.
+
+Finds the same cohort on a local stub FHIR server twice: with
+cohort_search.iter_patients_between_ages_and_condition, which pages through the Condition search
+(_count per page), and with bulk_export.iter_export_patients, which kicks off an export, polls its
+status and streams the gzipped NDJSON files. Prints the wall time and the number of requests of
+each, and checks that both return the same patients. --no-code-filter makes the stub reject code=
+searches, as servers without terminology support do, so the search has to page through every
+condition in the age range.
+
+Run from the repository root:
+    python -m benchmarks.bench_bulk_export --patients 50000 --latency 0.01
+"""
+import argparse
+import time
+
+from benchmarks.stub_fhir_server import StubFhirServer
+from bulk_export import iter_export_patients
+from cohort_search import iter_patients_between_ages_and_condition
+from fhir_client import FhirClient
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=50000, help="number of patients on the stub server")
+    parser.add_argument("--latency", type=float, default=0.01, help="stub latency per request in seconds")
+    parser.add_argument("--page-size", type=int, default=100, help="_count of the Condition search")
+    parser.add_argument("--file-size", type=int, default=10000, help="resources per export file")
+    parser.add_argument("--export-delay", type=float, default=0.5, help="seconds the stub takes to prepare an export")
+    parser.add_argument("--condition", default="Hyperglycemia")
+    parser.add_argument("--no-code-filter", action="store_true", help="make the stub reject code= searches")
+    args = parser.parse_args()
+
+    with StubFhirServer(n_patients=args.patients, latency=args.latency, export_delay=args.export_delay,
+                        export_file_size=args.file_size, support_code_filter=not args.no_code_filter) as server:
+        print(f"{'path':<8} {'patients':>9} {'seconds':>8} {'requests':>9}")
+        results = {}
+        for name, run in [
+            ("search", lambda: iter_patients_between_ages_and_condition(
+                0, 120, args.condition, page_size=args.page_size, client=client, index=None)),
+            ("export", lambda: iter_export_patients(0, 120, args.condition, client=client)),
+        ]:
+            client = FhirClient(server.base_url, cache=None)
+            server.reset_count()
+            start = time.perf_counter()
+            patients = list(run())
+            elapsed = time.perf_counter() - start
+            results[name] = sorted(p["patient_url"] for p in patients)
+            print(f"{name:<8} {len(patients):>9} {elapsed:>8.2f} {server.request_count:>9}")
+        assert results["search"] == results["export"], "search and export found different patients"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark of the multi-campaign batch runner in campaign_runner.run_campaigns.
+
+Runs a set of campaigns with overlapping criteria against a local stub FHIR server and a local
+mock OpenAI-compatible server, first one campaign at a time (each with its own Patient cache,
+as separate runs of the script would) and then as one batch, printing the wall time and the
+FHIR requests of each, followed by the batch's per-campaign summary.
+
+Run from the repository root:
+    python -m benchmarks.bench_campaigns --patients 5000 --latency 0.01 --no-include
+"""
+import argparse
+import tempfile
+import time
+
+from openai import OpenAI
+
+from benchmarks.mock_openai_server import MockOpenAIServer
+from benchmarks.stub_fhir_server import StubFhirServer
+from campaign_runner import SUMMARY_COLUMNS, run_campaigns
+
+PROPOSALS = [
+    "Patients aged 40 to 70 with Hyperglycemia",
+    "Patients aged 50 to 80 with Hyperglycemia or Osteoporosis",
+    "Patients aged 60 to 90 with Osteoporosis",
+    "Patients aged 30 to 60 with Hypertension or Hyperglycemia",
+    "Patients aged 45 to 75 with Polyp of colon",
+    "Patients aged 50 to 75 with Polyp of colon or Hypertension",
+]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=5000, help="number of patients on the stub server")
+    parser.add_argument("--latency", type=float, default=0.01, help="stub FHIR latency per request in seconds")
+    parser.add_argument("--llm-latency", type=float, default=0.01, help="mock completion latency in seconds")
+    parser.add_argument("--no-include", action="store_true",
+                        help="make the stub ignore _include, so patients are fetched separately")
+    args = parser.parse_args()
+
+    with StubFhirServer(n_patients=args.patients, latency=args.latency, support_include=not args.no_include) as fhir, \
+            MockOpenAIServer(latency=args.llm_latency) as llm, tempfile.TemporaryDirectory() as output_dir:
+        openai_client = OpenAI(api_key="mock", base_url=llm.base_url, max_retries=0)
+        options = {"fhir_base_url": fhir.base_url, "output_dir": output_dir, "templated": True}
+
+        start = time.perf_counter()
+        for proposal in PROPOSALS:
+            run_campaigns([proposal], openai_client, **options)
+        separate, separate_requests = time.perf_counter() - start, fhir.request_count
+
+        fhir.reset_count()
+        start = time.perf_counter()
+        campaigns = run_campaigns(PROPOSALS, openai_client, **options)
+        batch, batch_requests = time.perf_counter() - start, fhir.request_count
+
+        print(f"{'run':<9} {'seconds':>8} {'FHIR requests':>14}")
+        print(f"{'separate':<9} {separate:>8.2f} {separate_requests:>14}")
+        print(f"{'batch':<9} {batch:>8.2f} {batch_requests:>14}")
+        print()
+        columns = [c for c in SUMMARY_COLUMNS if c not in ("proposal", "criteria", "error")]
+        print(" ".join(f"{c:>17}" if c != "campaign" else f"{c:<40}" for c in columns))
+        for campaign in campaigns:
+            summary = campaign.summary()
+            assert not summary["error"], summary["error"]
+            print(" ".join(f"{summary[c]!s:>17}" if c != "campaign" else f"{summary[c]:<40}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark of the cohort criteria fast path in cohort_criteria.define_criteria.
+
+Defines the criteria of a proposal against a local mock OpenAI-compatible server by each route
+and prints the latency and LLM calls per run. The group chat is approximated by the
+completions it makes one after the other (by default 4: the epidemiologist, the critic, the
+manager picking speakers and the "give me the criteria again" round-trip), since its real
+cost depends on GPT-4.
+
+Run from the repository root:
+    python -m benchmarks.bench_cohort_criteria --latency 1.0 --runs 5
+"""
+import argparse
+import json
+import time
+
+from openai import OpenAI
+
+from benchmarks.mock_openai_server import MockOpenAIServer
+from cohort_criteria import CriteriaStore, define_criteria
+
+PROPOSAL = "Find patients for colonoscopy screening"
+CRITERIA = {"min_age": 45, "max_age": 75, "conditions": ["Polyp of colon"]}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=1.0, help="mock completion latency in seconds")
+    parser.add_argument("--chat-calls", type=int, default=4, help="completions the group chat is counted as")
+    parser.add_argument("--runs", type=int, default=5, help="runs per route")
+    args = parser.parse_args()
+
+    with MockOpenAIServer(latency=args.latency, json_reply=json.dumps(CRITERIA)) as server:
+        client = OpenAI(api_key="mock", base_url=server.base_url, max_retries=0)
+
+        def group_chat():
+            for _ in range(args.chat_calls):
+                client.chat.completions.create(model="gpt-4", messages=[{"role": "user", "content": PROPOSAL}])
+
+        def structured_call():
+            # A fresh store every run, so the proposal is always new
+            criteria, source = define_criteria(PROPOSAL, client, store=CriteriaStore(""))
+            assert source == "llm" and criteria.max_age == CRITERIA["max_age"]
+
+        store = CriteriaStore("")
+        define_criteria(PROPOSAL, client, store=store)
+
+        def repeat_proposal():
+            assert define_criteria(PROPOSAL, client, store=store)[1] == "store"
+
+        def criteria_in_proposal():
+            assert define_criteria("Patients aged 45 to 75 with Polyp of colon", client, store=CriteriaStore(""))[1] == "parsed"
+
+        print(f"{'route':<22} {'ms/run':>9} {'LLM calls/run':>14}")
+        for name, route in [("group chat", group_chat), ("structured call", structured_call),
+                            ("repeat proposal", repeat_proposal), ("criteria in proposal", criteria_in_proposal)]:
+            server.reset_count()
+            start = time.perf_counter()
+            for _ in range(args.runs):
+                route()
+            elapsed = (time.perf_counter() - start) / args.runs
+            print(f"{name:<22} {elapsed * 1000:>9.1f} {server.request_count / args.runs:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark of incremental cohort refreshes in cohort_refresh.refresh_cohort.
+
+Builds a campaign's cohort on a local stub FHIR server, then changes a share of the patients and
+conditions (the nightly churn) and compares refreshing the cohort from its checkpoint with
+searching for the whole cohort again, printing the time and the FHIR requests of each.
+
+Run from the repository root:
+    python -m benchmarks.bench_cohort_refresh --patients 20000 --churn 0.01 --latency 0.01
+"""
+import argparse
+import random
+import tempfile
+import time
+
+from benchmarks.stub_fhir_server import CONDITIONS, StubFhirServer
+from cohort_criteria import CohortCriteria
+from cohort_refresh import refresh_cohort
+from cohort_search import iter_patients_between_ages_and_conditions
+from fhir_client import FhirClient
+
+CRITERIA = CohortCriteria(40, 80, ("Hyperglycemia", "Osteoporosis"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=20000, help="number of patients on the stub server")
+    parser.add_argument("--churn", type=float, default=0.01, help="share of patients changed between the runs")
+    parser.add_argument("--latency", type=float, default=0.01, help="stub server latency per request in seconds")
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    with StubFhirServer(n_patients=args.patients, latency=args.latency) as server, \
+            tempfile.TemporaryDirectory() as checkpoint_dir:
+        client = FhirClient(server.base_url)
+        first = refresh_cohort("bench", CRITERIA, client=client, checkpoint_dir=checkpoint_dir)
+
+        # Half of the churn is new conditions, the other half updated patient details
+        changed = rng.sample(list(server.patients), int(args.patients * args.churn))
+        for i, patient_id in enumerate(changed):
+            if i % 2:
+                server.add_condition(patient_id, rng.choice(CONDITIONS)[0])
+            else:
+                server.update_patient(patient_id, telecom=[{"system": "email", "value": f"new{patient_id}@example.org"}])
+
+        server.reset_count()
+        start = time.perf_counter()
+        cohort = {p["patient_url"] for p in iter_patients_between_ages_and_conditions(
+            CRITERIA.min_age, CRITERIA.max_age, CRITERIA.conditions, client=client)}
+        full, full_requests = time.perf_counter() - start, server.request_count
+
+        server.reset_count()
+        start = time.perf_counter()
+        result = refresh_cohort("bench", CRITERIA, client=client, checkpoint_dir=checkpoint_dir)
+        incremental, incremental_requests = time.perf_counter() - start, server.request_count
+        assert result.members == len(cohort)
+
+        print(f"cohort of {first.members} patients, {len(changed)} changed: {len(result.added)} joined, "
+              f"{len(result.removed)} left, {len(result.updated)} updated")
+        print(f"{'refresh':<12} {'seconds':>8} {'FHIR requests':>14}")
+        print(f"{'full':<12} {full:>8.2f} {full_requests:>14}")
+        print(f"{'incremental':<12} {incremental:>8.2f} {incremental_requests:>14}")
+
+
+if __name__ == "__main__":
+    main()
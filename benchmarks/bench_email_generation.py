@@ -0,0 +1,54 @@
+"""
+Benchmark of concurrent outreach email generation in outreach_emails.generate_emails.
+
+Starts a local mock OpenAI-compatible server with a fixed completion latency (and optional
+failures) and writes the same set of emails at increasing concurrency, printing emails/second.
+
+Run from the repository root:
+    python -m benchmarks.bench_email_generation --patients 100 --latency 0.2 --error-rate 0.05
+"""
+import argparse
+import time
+
+from openai import OpenAI
+
+import outreach_emails
+from benchmarks.mock_openai_server import MockOpenAIServer
+from outreach_emails import generate_emails
+
+
+def make_patients(n: int):
+    return [{"full_name": f"Given{i} Family{i}", "condition": "Hyperglycemia (disorder)", "MRN": f"MRN-{i:08d}"}
+            for i in range(n)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=100, help="number of emails to write")
+    parser.add_argument("--latency", type=float, default=0.2, help="mock completion latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="random variation of the latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of completions that fail")
+    parser.add_argument("--rpm", type=float, default=None, help="requests per minute limit")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32],
+                        help="max_concurrency values to measure")
+    args = parser.parse_args()
+    # Keep retries quick so the benchmark measures throughput, not backoff
+    outreach_emails.RETRY_BACKOFF = 0.01
+
+    patients = make_patients(args.patients)
+    with MockOpenAIServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate) as server:
+        client = OpenAI(api_key="mock", base_url=server.base_url, max_retries=0)
+        print(f"{'concurrency':>11} {'seconds':>8} {'emails/s':>9} {'failed':>7} {'requests':>9}")
+        for max_concurrency in args.concurrency:
+            server.reset_count()
+            start = time.perf_counter()
+            results = list(generate_emails(client, patients, "Find patients for colonoscopy screening",
+                                           max_concurrency=max_concurrency, requests_per_minute=args.rpm))
+            elapsed = time.perf_counter() - start
+            written = sum(1 for r in results if r.content is not None)
+            print(f"{max_concurrency:>11} {elapsed:>8.2f} {written / elapsed:>9.1f} "
+                  f"{len(results) - written:>7} {server.request_count:>9}")
+
+
+if __name__ == "__main__":
+    main()
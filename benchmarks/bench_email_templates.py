@@ -0,0 +1,51 @@
+"""
+Benchmark of template-plus-slots email generation against one completion per patient.
+
+Writes the same cohort of emails with generate_emails (one completion per patient) and
+generate_templated_emails (one completion per distinct condition, with and without the
+per-patient personalization pass) against a local mock OpenAI-compatible server, and
+prints the LLM calls each mode made and how long it took.
+
+Run from the repository root:
+    python -m benchmarks.bench_email_templates --patients 500 --conditions 5 --latency 0.2
+"""
+import argparse
+
+from openai import OpenAI
+
+from benchmarks.mock_openai_server import MockOpenAIServer
+from outreach_emails import GenerationStats, NAME_SLOT, generate_emails, generate_templated_emails
+
+
+def make_patients(n: int, conditions: int):
+    return [{"full_name": f"Given{i} Family{i}", "condition": f"Condition {i % conditions} (disorder)",
+             "MRN": f"MRN-{i:08d}"} for i in range(n)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=500, help="number of emails to write")
+    parser.add_argument("--conditions", type=int, default=5, help="number of distinct conditions in the cohort")
+    parser.add_argument("--latency", type=float, default=0.2, help="mock completion latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=8, help="max_concurrency for every mode")
+    args = parser.parse_args()
+
+    patients = make_patients(args.patients, args.conditions)
+    proposal = "Find patients for colonoscopy screening"
+    modes = [
+        ("per patient", generate_emails, {}),
+        ("template", generate_templated_emails, {}),
+        ("template + personalize", generate_templated_emails, {"personalize": True}),
+    ]
+    with MockOpenAIServer(latency=args.latency) as server:
+        client = OpenAI(api_key="mock", base_url=server.base_url, max_retries=0)
+        print(f"{'mode':<24} {'emails':>7} {'LLM calls':>10} {'saved':>7} {'seconds':>8}")
+        for name, generate, options in modes:
+            stats = GenerationStats()
+            results = list(generate(client, patients, proposal, max_concurrency=args.concurrency, stats=stats, **options))
+            assert all(NAME_SLOT not in r.content for r in results if r.content)
+            print(f"{name:<24} {stats.emails:>7} {stats.llm_calls:>10} {stats.calls_saved:>7} {stats.seconds:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
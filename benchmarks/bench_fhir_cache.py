@@ -0,0 +1,53 @@
+"""
+Benchmark of the persistent FHIR response cache.
+
+Resolves the same cohort of patients three times against a local stub FHIR server that
+doesn't support _include (so every patient is read): once with an empty cache, once with
+a warm cache, and once after the cache has expired and a share of the patients changed,
+so the rest are revalidated with ifNoneMatch. Prints requests and cache counters per run.
+
+Run from the repository root:
+    python -m benchmarks.bench_fhir_cache --patients 2000 --changed 0.05
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.stub_fhir_server import StubFhirServer
+from fhir_cache import FhirCache
+from fhir_client import FhirClient
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=2000, help="number of patients on the stub server")
+    parser.add_argument("--latency", type=float, default=0.005, help="stub server latency per request in seconds")
+    parser.add_argument("--changed", type=float, default=0.05, help="share of patients updated before the last run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            StubFhirServer(n_patients=args.patients, latency=args.latency, support_include=False) as server:
+        client = FhirClient(server.base_url, cache=FhirCache(os.path.join(tmp, "fhir.sqlite3")))
+        patient_ids = list(server.patients)
+
+        print(f"{'run':<22} {'requests':>8} {'seconds':>8} {'hits':>6} {'304s':>6} {'misses':>6} {'KB saved':>9}")
+        for run in ("cold cache", "warm cache", "expired, some changed"):
+            if run.startswith("expired"):
+                client.cache.ttl = 0
+                for patient_id in random.Random(0).sample(patient_ids, int(len(patient_ids) * args.changed)):
+                    server.update_patient(patient_id)
+            stats_before = dict(client.cache.stats)
+            client.reset_stats()
+            start = time.perf_counter()
+            resolved = client.resolve_patients(patient_ids)
+            elapsed = time.perf_counter() - start
+            assert len(resolved) == len(patient_ids)
+            stats = {k: v - stats_before[k] for k, v in client.cache.stats.items()}
+            print(f"{run:<22} {client.request_count:>8} {elapsed:>8.2f} {stats['hits']:>6} "
+                  f"{stats['revalidated']:>6} {stats['misses']:>6} {stats['bytes_saved'] / 1024:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark of the speaker graph and history compaction of the hospitalgpt.py group chat
+(group_chat_policy).
+
+Runs the seven agents of hospitalgpt.py for --rounds turns against a local mock
+OpenAI-compatible server twice: as before, with GPT-4 choosing every speaker and every agent
+sent the whole conversation, and with HOSPITAL_TRANSITIONS choosing the speakers and
+HOSPITAL_HISTORY bounding each agent's history. The mock replies are scripted, so both chats
+take the same turns (plan, critique, criteria, code, execution, emails) in the same order.
+Prints the LLM requests, the prompt tokens and the wall time of each, and the savings report.
+
+Run from the repository root:
+    python -m benchmarks.bench_group_chat --rounds 30 --latency 0.3
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import time
+
+from autogen import AssistantAgent, GroupChat, GroupChatManager, UserProxyAgent
+
+from benchmarks.mock_openai_server import MockOpenAIServer
+from group_chat_policy import ChatSavings, SpeakerGraph, compact_history, HOSPITAL_HISTORY, HOSPITAL_TRANSITIONS
+
+# The order the scripted chat goes round in, as HOSPITAL_TRANSITIONS picks it
+SPEAKER_CYCLE = ["hospital_planner", "Critic", "epidemiologist", "data_analyst", "Executor", "outreach_admin", "Admin"]
+
+SELECT_PROMPT = "select the next role"
+FILLER = ("The plan covers patients aged 45 to 75 without a colonoscopy in the last ten years, "
+          "with their postal code, email address and medical record number. ")
+
+
+def scripted_reply(cycle):
+    # Speaker selections name the next agent of the cycle; agents reply with a few hundred tokens
+    def reply(request):
+        messages = request.get("messages", [])
+        if any(SELECT_PROMPT in str(m.get("content", "")) for m in messages):
+            return next(cycle)
+        system = str(messages[0].get("content", "")) if messages else ""
+        if "Data analyst" in system:
+            return "```python\nimport csv\nprint('Found 120 patients')\n```\n" + FILLER * 4
+        return FILLER * 10
+    return reply
+
+
+def make_agents(base_url: str):
+    config = {"config_list": [{"model": "gpt-4", "api_key": "mock", "base_url": base_url}],
+              "cache_seed": None, "temperature": 0, "timeout": 120}
+
+    def assistant(name, system_message):
+        return AssistantAgent(name=name, system_message=system_message, llm_config=config)
+
+    admin = UserProxyAgent(name="Admin", human_input_mode="NEVER", code_execution_config=False,
+                           default_auto_reply="Approved, continue.", is_termination_msg=lambda x: False)
+    executor = UserProxyAgent(name="Executor", human_input_mode="NEVER", code_execution_config=False,
+                              default_auto_reply="exitcode: 0 (execution succeeded)\nCode output: Found 120 patients")
+    return [admin,
+            assistant("hospital_planner", "Hospital administrator. Suggest a plan."),
+            assistant("epidemiologist", "Epidemiologist. Define the criteria."),
+            assistant("data_analyst", "Data analyst. Write python code to find the patients."),
+            executor,
+            assistant("outreach_admin", "Outreach administrator. Write the emails."),
+            assistant("Critic", "Critic. Double check plan, claims, code from other agents and provide feedback.")], config
+
+
+def run_chat(server: MockOpenAIServer, rounds: int, policy: bool):
+    server.reply = scripted_reply(itertools.cycle(SPEAKER_CYCLE))
+    agents, config = make_agents(server.base_url)
+    savings = ChatSavings()
+    options = {}
+    if policy:
+        options["speaker_selection_method"] = SpeakerGraph(HOSPITAL_TRANSITIONS, savings=savings)
+        compact_history(agents, HOSPITAL_HISTORY, savings)
+    groupchat = GroupChat(agents=agents, messages=[], max_round=rounds, **options)
+    manager = GroupChatManager(groupchat=groupchat, llm_config=config)
+    server.reset_count()
+    start = time.perf_counter()
+    # The manager prints every message; only the numbers are of interest here
+    with contextlib.redirect_stdout(io.StringIO()):
+        agents[0].initiate_chat(manager, message="Contact all the patients that need a colonoscopy screening.")
+    return time.perf_counter() - start, [m.get("name") for m in groupchat.messages], savings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=30, help="turns of the group chat")
+    parser.add_argument("--latency", type=float, default=0.3, help="mock completion latency in seconds")
+    args = parser.parse_args()
+
+    with MockOpenAIServer(latency=args.latency) as server:
+        print(f"{'chat':<22} {'LLM requests':>13} {'prompt tokens':>14} {'seconds':>8}")
+        results = {}
+        for name, policy in (("LLM speakers, full", False), ("graph, compacted", True)):
+            seconds, speakers, savings = run_chat(server, args.rounds, policy)
+            results[name] = speakers
+            print(f"{name:<22} {server.request_count:>13} {server.prompt_tokens:>14} {seconds:>8.2f}")
+        assert len(set(map(tuple, results.values()))) == 1, "the two chats took different turns"
+
+        print()
+        print(savings.report(seconds_per_selection=args.latency))
+
+
+if __name__ == "__main__":
+    main()
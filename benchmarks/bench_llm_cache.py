@@ -0,0 +1,77 @@
+"""
+Benchmark of the completion cache in llm_cache.
+
+Writes the outreach emails of a cohort through a CachedOpenAI client against a local mock
+OpenAI-compatible server, with a share of the completions failing, then runs the same job
+again as a re-run would. An autogen assistant answering the same messages twice is run through
+the same cache. Prints the API requests, the wall time and the per-step usage of each run: the
+second run of each costs no API calls.
+
+Run from the repository root:
+    python -m benchmarks.bench_llm_cache --patients 200 --latency 0.2 --error-rate 0.1
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from openai import OpenAI
+
+import outreach_emails
+from benchmarks.mock_openai_server import MockOpenAIServer
+from llm_cache import CachedOpenAI, CompletionCache, LLMUsage
+from outreach_emails import GenerationStats, generate_emails
+
+
+def make_patients(n: int):
+    return [{"full_name": f"Given{i} Family{i}", "condition": "Hyperglycemia (disorder)", "MRN": f"MRN-{i:08d}"}
+            for i in range(n)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=200, help="number of emails to write")
+    parser.add_argument("--latency", type=float, default=0.2, help="mock completion latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.1, help="share of completions that fail")
+    parser.add_argument("--concurrency", type=int, default=16, help="max_concurrency of the email generation")
+    args = parser.parse_args()
+    outreach_emails.RETRY_BACKOFF = 0.01
+
+    patients = make_patients(args.patients)
+    with MockOpenAIServer(latency=args.latency, error_rate=args.error_rate) as server, \
+            tempfile.TemporaryDirectory() as directory:
+        usage = LLMUsage()
+        cache = CompletionCache(os.path.join(directory, "llm_cache.sqlite3"), usage=usage)
+        client = CachedOpenAI(OpenAI(api_key="mock", base_url=server.base_url, max_retries=0),
+                              step="outreach_emails", cache=cache)
+
+        print(f"{'run':<14} {'emails':>7} {'failed':>7} {'API requests':>13} {'seconds':>8}")
+        for run in ("emails first", "emails re-run"):
+            server.reset_count()
+            stats = GenerationStats()
+            start = time.perf_counter()
+            for _ in generate_emails(client, patients, "colonoscopy screening", max_concurrency=args.concurrency,
+                                     stats=stats):
+                pass
+            print(f"{run:<14} {stats.emails:>7} {stats.failed:>7} {server.request_count:>13} "
+                  f"{time.perf_counter() - start:>8.2f}")
+
+        from autogen import AssistantAgent
+        server.error_rate = 0.0
+        config = {"config_list": [{"model": "gpt-4", "api_key": "mock", "base_url": server.base_url}],
+                  "cache": cache.for_step("agent"), "temperature": 0}
+        agent = AssistantAgent("epidemiologist", llm_config=config)
+        for run in ("agent first", "agent re-run"):
+            server.reset_count()
+            start = time.perf_counter()
+            for i in range(5):
+                agent.generate_reply(messages=[{"role": "user", "content": f"Define the cohort of proposal {i}"}])
+            print(f"{run:<14} {'':>7} {'':>7} {server.request_count:>13} {time.perf_counter() - start:>8.2f}")
+
+        print()
+        print(usage.report())
+        print(f"\ncache: {cache.stats}, {cache.size() / 1e3:.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
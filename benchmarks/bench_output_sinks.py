@@ -0,0 +1,55 @@
+"""
+Benchmark of the outreach email output sinks in outreach_sinks.
+
+Writes the same set of generated emails with each sink into a temporary directory, printing
+the time taken, the number of files created and the size on disk.
+
+Run from the repository root:
+    python -m benchmarks.bench_output_sinks --emails 20000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from outreach_emails import EmailResult
+from outreach_sinks import open_sink
+
+EMAIL_TEXT = ("Subject: Screening invitation\n\nDear {name},\n\nYou are invited to a colonoscopy screening "
+              "because you have previously had {condition}. Please reply to book an appointment.\n\n"
+              "Kind regards,\nOutreach team")
+
+
+def make_results(n: int):
+    for i in range(n):
+        patient = {"patient_url": f"http://localhost/Patient/{i}?_pretty=true", "full_name": f"Given{i} Family{i}",
+                   "age": 60, "postal_code": f"{i % 99999:05d}", "MRN": f"MRN-{i:08d}",
+                   "email": f"patient{i}@example.org", "condition": "Polyp of colon (disorder)"}
+        yield EmailResult(patient, EMAIL_TEXT.format(name=patient["full_name"], condition=patient["condition"]),
+                          None, 1, 0.0)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=20000, help="number of emails to write")
+    parser.add_argument("--batch-size", type=int, default=500, help="batch_size of the CSV and JSONL sinks")
+    args = parser.parse_args()
+
+    print(f"{'sink':<6} {'seconds':>8} {'emails/s':>10} {'files':>7} {'MB':>7}")
+    for format, name in [("text", "emails"), ("csv", "out.csv"), ("jsonl", "out.jsonl")]:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, name)
+            options = {} if format == "text" else {"batch_size": args.batch_size}
+            start = time.perf_counter()
+            with open_sink(path, format, **options) as sink:
+                for result in make_results(args.emails):
+                    sink.write(result)
+            elapsed = time.perf_counter() - start
+            files = [os.path.join(root, f) for root, _, names in os.walk(directory) for f in names]
+            size = sum(os.path.getsize(f) for f in files)
+            assert sink.written == args.emails
+            print(f"{format:<6} {elapsed:>8.2f} {args.emails / elapsed:>10.0f} {len(files):>7} {size / 1e6:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
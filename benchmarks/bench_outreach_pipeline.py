@@ -0,0 +1,67 @@
+"""
+Benchmark of the streaming outreach pipeline in outreach_pipeline.run_outreach_pipeline.
+
+Runs the cohort search against a local stub FHIR server and writes the emails with a local
+mock OpenAI-compatible server, first one step after the other (the whole cohort is collected
+and then the emails are written) and then as a pipeline, printing the total time, the time
+until the first email was written and the throughput and queue depth of each stage.
+
+Run from the repository root:
+    python -m benchmarks.bench_outreach_pipeline --patients 2000 --fhir-latency 0.05 --llm-latency 0.05
+"""
+import argparse
+import time
+
+from openai import OpenAI
+
+from benchmarks.mock_openai_server import MockOpenAIServer
+from benchmarks.stub_fhir_server import StubFhirServer
+from cohort_search import iter_patients_between_ages_and_condition
+from fhir_client import FhirClient
+from outreach_emails import generate_emails
+from outreach_pipeline import run_outreach_pipeline
+
+USER_PROPOSAL = "Find patients for colonoscopy screening"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=2000, help="number of patients on the stub server")
+    parser.add_argument("--fhir-latency", type=float, default=0.05, help="stub FHIR latency per request in seconds")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="mock completion latency in seconds")
+    parser.add_argument("--page-size", type=int, default=50, help="conditions per search page")
+    parser.add_argument("--concurrency", type=int, default=16, help="max_concurrency of the email stage")
+    parser.add_argument("--queue-size", type=int, default=64, help="size of the queues between the stages")
+    args = parser.parse_args()
+
+    with StubFhirServer(n_patients=args.patients, latency=args.fhir_latency) as fhir, \
+            MockOpenAIServer(latency=args.llm_latency) as llm:
+        fhir_client = FhirClient(fhir.base_url)
+        openai_client = OpenAI(api_key="mock", base_url=llm.base_url, max_retries=0)
+
+        def search():
+            # Every age and every condition, so the whole stub cohort goes through the pipeline
+            return iter_patients_between_ages_and_condition(0, 120, "disorder", page_size=args.page_size,
+                                                            server_filter=False, client=fhir_client)
+
+        start = time.perf_counter()
+        cohort = list(search())
+        first = None
+        for _ in generate_emails(openai_client, cohort, USER_PROPOSAL, max_concurrency=args.concurrency):
+            first = first or time.perf_counter()
+        sequential = time.perf_counter() - start
+        print(f"sequential: {len(cohort)} emails in {sequential:.2f}s, first email after {first - start:.2f}s")
+
+        written = []
+        start = time.perf_counter()
+        stats = run_outreach_pipeline(openai_client, search(), USER_PROPOSAL, written.append,
+                                      max_concurrency=args.concurrency, queue_size=args.queue_size)
+        pipelined = time.perf_counter() - start
+        assert len(written) == len(cohort)
+        print(f"pipeline:   {len(written)} emails in {pipelined:.2f}s, first email after "
+              f"{stats.time_to_first_output:.2f}s ({sequential / pipelined:.1f}x faster)")
+        print(stats.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Benchmark of the local patient index in patient_index against scanning the patients.
+
+Writes a synthetic bulk export (Patient.ndjson and Condition.ndjson, in the layout of the stub
+FHIR server) to a temporary directory, builds a PatientIndex from it and times age + condition
+queries: count() finds the matching patients and query() also builds their dictionaries.
+
+For comparison, the same queries are answered by scanning the conditions of the first
+--scan-patients patients the way the FHIR search path does (strptime and relativedelta per
+patient), and the scan time is scaled up to all the patients. The index answers are checked
+against the scan for those patients.
+
+Run from the repository root:
+    python -m benchmarks.bench_patient_index --patients 1000000
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+
+from dateutil.relativedelta import relativedelta
+
+from benchmarks.stub_fhir_server import make_condition, make_patient
+from cohort_search import condition_matcher
+from patient_index import PatientIndex
+
+QUERIES = [(50, 70, "Myocardial"), (18, 30, "Acute bronchitis"), (60, 65, "Osteoporosis"),
+           (40, 80, "Diabetes"), (100, 105, "Hyperglycemia")]
+
+
+def write_export(directory: str, n: int, seed: int = 0):
+    rng = random.Random(seed)
+    patients, conditions = os.path.join(directory, "Patient.ndjson"), os.path.join(directory, "Condition.ndjson")
+    n_conditions = 0
+    with open(patients, "w") as p, open(conditions, "w") as c:
+        for i in range(n):
+            p.write(json.dumps(make_patient(i, rng)) + "\n")
+            for _ in range(rng.randint(0, 3)):
+                c.write(json.dumps(make_condition(n_conditions, str(i), rng)) + "\n")
+                n_conditions += 1
+    return patients, conditions, n_conditions
+
+
+def load_sample(patients_path: str, conditions_path: str, n: int):
+    # The first n patients and their conditions, as the FHIR search would return them
+    with open(patients_path) as f:
+        patients = {}
+        for line in f:
+            if len(patients) == n:
+                break
+            patient = json.loads(line)
+            patients[patient["id"]] = patient
+    with open(conditions_path) as f:
+        conditions = [c for c in map(json.loads, f) if c["subject"]["reference"].split("/")[-1] in patients]
+    return patients, conditions
+
+
+def scan(patients, conditions, min_age: int, max_age: int, condition: str):
+    matches = condition_matcher([condition])
+    now = datetime.datetime.now()
+    found = set()
+    for resource_ in conditions:
+        if not matches(resource_):
+            continue
+        patient = patients[resource_["subject"]["reference"].split("/")[-1]]
+        age = relativedelta(now, datetime.datetime.strptime(patient["birthDate"], "%Y-%m-%d")).years
+        if min_age <= age <= max_age:
+            found.add(patient["id"])
+    return found
+
+
+def max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=1000000, help="number of synthetic patients")
+    parser.add_argument("--scan-patients", type=int, default=100000, help="patients in the scan comparison")
+    parser.add_argument("--repeat", type=int, default=20, help="times each query is run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        patients_path, conditions_path, n_conditions = write_export(directory, args.patients)
+        print(f"wrote {args.patients} patients and {n_conditions} conditions in {time.perf_counter() - start:.1f}s")
+
+        rss_before = max_rss_mb()
+        start = time.perf_counter()
+        index = PatientIndex.from_ndjson([patients_path], [conditions_path], "http://localhost/fhir")
+        build = time.perf_counter() - start
+        print(f"built index of {len(index)} patients in {build:.1f}s ({len(index) / build:,.0f} patients/s), "
+              f"{index.nbytes() / 1e6:.0f} MB of columns, peak RSS +{max_rss_mb() - rss_before:.0f} MB")
+
+        index_path = os.path.join(directory, "patients.idx")
+        start = time.perf_counter()
+        index.save(index_path)
+        saved = time.perf_counter() - start
+        start = time.perf_counter()
+        index = PatientIndex.load(index_path)
+        print(f"saved in {saved:.2f}s, loaded in {time.perf_counter() - start:.2f}s "
+              f"({os.path.getsize(index_path) / 1e6:.0f} MB file)")
+
+        sample = min(args.scan_patients, args.patients)
+        patients, conditions = load_sample(patients_path, conditions_path, sample)
+
+    print(f"\n{'query':<32} {'patients':>9} {'count p50 ms':>13} {'query p50 ms':>13} {'scan ms':>10} {'speedup':>8}")
+    for min_age, max_age, condition in QUERIES:
+        counts, times = [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            index.count(min_age, max_age, condition)
+            counts.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            results = list(index.query(min_age, max_age, condition))
+            times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        expected = scan(patients, conditions, min_age, max_age, condition)
+        scanned = (time.perf_counter() - start) * args.patients / sample
+        found = {result["patient_url"].split("/Patient/")[1].split("?")[0] for result in results}
+        assert {pid for pid in found if int(pid) < sample} == expected, "index and scan disagree"
+        p50 = statistics.median(times)
+        assert index.count(min_age, max_age, condition) == len(results)
+        print(f"{f'{min_age}-{max_age} {condition}':<32} {len(results):>9} {statistics.median(counts) * 1000:>13.2f} "
+              f"{p50 * 1000:>13.1f} {scanned * 1000:>10.0f} {scanned / p50:>7.0f}x")
+    print(f"\nscan times are measured on {sample} patients and scaled to {args.patients}")
+
+
+if __name__ == "__main__":
+    main()
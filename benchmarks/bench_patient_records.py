@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of patient_record.PatientRecord against the decoded Patient resources and
+patient dictionaries it replaces.
+
+Decodes the same recorded Patient JSON (an NDJSON file given with --input, e.g. a bulk export's
+Patient file, or synthetic Synthea-style patients) four ways and prints the time per patient
+and the memory held per patient once they are all decoded:
+- resource: json.loads, keeping the whole resource, as a search page holds it
+- dict: json.loads and the 7-key patient dictionary built from it with nested lookups,
+  strptime and relativedelta, as patient_details did before PatientRecord
+- record: PatientRecord.from_json, which decodes with orjson when it is installed
+- record-json: a PatientRecord decoded with the json module
+
+Run from the repository root:
+    python -m benchmarks.bench_patient_records --patients 100000
+"""
+import argparse
+import datetime
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+from dateutil.relativedelta import relativedelta
+
+import fhir_client
+from benchmarks.stub_fhir_server import make_condition, make_patient
+from patient_record import PatientRecord
+
+
+def patient_dict(patient, condition, default_email=None):
+    # The patient dictionary as it was built before PatientRecord
+    if 'telecom' not in patient or 'maritalStatus' not in patient:
+        return None
+    full_name = patient['name'][0]['given'][0] + " " + patient['name'][0]['family']
+    email = next((t['value'] for t in patient['telecom'] if t['system'] == 'email'), default_email)
+    mrn = next((i['value'] for i in patient['identifier'] if 'type' in i and i['type']['text'] == 'Medical Record Number'), None)
+    patient_age = relativedelta(datetime.datetime.now(), datetime.datetime.strptime(patient['birthDate'], '%Y-%m-%d')).years
+    postal_code = patient['address'][0]['postalCode'] if 'address' in patient and patient['address'] else None
+    return {'patient_url': f"http://localhost/baseR4/Patient/{patient['id']}?_pretty=true", 'full_name': full_name,
+            'age': patient_age, 'postal_code': postal_code, 'MRN': mrn, 'email': email,
+            'condition': condition['code']['coding'][0]['display']}
+
+
+def recorded_patients(path: str, n: int):
+    if path:
+        with open(path, "rb") as f:
+            return [line for line in f if line.strip()][:n]
+    rng = random.Random(0)
+    return [json.dumps(make_patient(i, rng), separators=(",", ":")).encode() for i in range(n)]
+
+
+def measure(decode, lines):
+    # Seconds to decode every line, and the bytes held by the decoded objects
+    gc.collect()
+    gc.disable()
+    start = time.perf_counter()
+    decoded = [decode(line) for line in lines]
+    elapsed = time.perf_counter() - start
+    gc.enable()
+    del decoded
+    gc.collect()
+    tracemalloc.start()
+    # Kept alive until the traced memory has been read
+    decoded = [decode(line) for line in lines]
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del decoded
+    return elapsed, held
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=100000, help="number of patients to decode")
+    parser.add_argument("--input", default="", help="NDJSON file of recorded Patient resources")
+    args = parser.parse_args()
+
+    lines = recorded_patients(args.input, args.patients)
+    condition = make_condition(0, "0", random.Random(0))
+    decoders = {
+        "resource": json.loads,
+        "dict": lambda line: patient_dict(json.loads(line), condition),
+        "record": PatientRecord.from_json,
+        "record-json": lambda line: PatientRecord.from_resource(json.loads(line)),
+    }
+    print(f"{len(lines)} patients, {sum(map(len, lines)) / len(lines):.0f} bytes of JSON each, "
+          f"orjson {'installed' if fhir_client.orjson else 'not installed'}")
+    print(f"{'decoded as':<10} {'us/patient':>11} {'bytes/patient':>14}")
+    for name, decode in decoders.items():
+        elapsed, held = measure(decode, lines)
+        print(f"{name:<10} {elapsed / len(lines) * 1e6:>11.1f} {held / len(lines):>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark of how many requests it takes to resolve the patients of a Condition search.
+
+Compares the original N+1 pattern (one Patient/{id} GET per matching condition) with
+_include=Condition:subject and with the batch Bundle fallback used when the server
+ignores _include, against a local stub FHIR server.
+
+Run from the repository root:
+    python -m benchmarks.bench_patient_resolution --patients 2000 --latency 0.005
+"""
+import argparse
+import time
+
+from benchmarks.stub_fhir_server import StubFhirServer
+from fhir_client import FhirClient, included_resources
+
+
+def n_plus_one(client: FhirClient) -> int:
+    resolved = 0
+    for entry in client.search_entries("Condition", {}):
+        patient_id = entry["resource"]["subject"]["reference"].split("/")[1]
+        resolved += len(client.fetch_patients([patient_id], max_in_flight=1))
+    return resolved
+
+
+def with_include(client: FhirClient) -> int:
+    resolved = 0
+    for bundle in client.search_pages("Condition", {"_include": "Condition:subject"}):
+        conditions = [e for e in bundle["entry"] if e["resource"]["resourceType"] == "Condition"]
+        patient_ids = [e["resource"]["subject"]["reference"].split("/")[1] for e in conditions]
+        known = included_resources(bundle, "Patient")
+        resolved += len(client.resolve_patients(patient_ids, known=known))
+    return resolved
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=2000, help="number of patients on the stub server")
+    parser.add_argument("--latency", type=float, default=0.005, help="stub server latency per request in seconds")
+    args = parser.parse_args()
+
+    scenarios = [
+        ("N+1 Patient reads", n_plus_one, {}),
+        ("_include=Condition:subject", with_include, {}),
+        ("batch Bundle fallback", with_include, {"support_include": False}),
+        ("per-patient fallback", with_include, {"support_include": False, "support_batch": False}),
+    ]
+    print(f"{'strategy':<28} {'patients':>8} {'requests':>8} {'seconds':>8}")
+    for name, strategy, server_options in scenarios:
+        with StubFhirServer(n_patients=args.patients, latency=args.latency, **server_options) as server:
+            # No response cache, so every patient goes over the network
+            client = FhirClient(server.base_url)
+            start = time.perf_counter()
+            resolved = strategy(client)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<28} {resolved:>8} {client.request_count:>8} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
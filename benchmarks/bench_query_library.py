@@ -0,0 +1,147 @@
+"""
+Benchmark of the query library and the warm executor of hospitalgpt.py (query_library,
+warm_executor).
+
+First runs the same FHIR query (a Condition search against a local stub FHIR server, written
+with requests) --executions times with autogen's LocalCommandLineCodeExecutor, which starts a new
+interpreter for each, and with WarmPythonExecutor, and prints the time per execution.
+
+Then runs a small group chat (epidemiologist, data analyst, executor) against a local mock
+OpenAI-compatible server with a QueryLibrary: a first run where the analyst writes the query, a
+second run that reuses it, a run with another age range and one for female patients only,
+which the library keys apart so the analyst writes new code, and a run for a new condition where
+the analyst's code always fails, which stops after DEFAULT_MAX_FIX_ATTEMPTS failures. Prints the analyst's LLM calls, the executions and the turns
+of each.
+
+Run from the repository root:
+    python -m benchmarks.bench_query_library --executions 20
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from autogen import AssistantAgent, GroupChat, GroupChatManager, UserProxyAgent
+from autogen.coding import CodeBlock, LocalCommandLineCodeExecutor
+
+from benchmarks.mock_openai_server import MockOpenAIServer
+from benchmarks.stub_fhir_server import StubFhirServer
+from cohort_criteria import CohortCriteria, parse_criteria
+from group_chat_policy import SpeakerGraph, Transition, execution_failed, has_code
+from query_library import QueryLibrary, QueryReuse
+from warm_executor import WarmPythonExecutor
+
+QUERY = '''CRITERIA = {criteria}
+import requests
+r = requests.get("{base_url}/Condition", params={{"code:text": CRITERIA["conditions"][0], "_count": 100}})
+r.raise_for_status()
+print(len(r.json().get("entry", [])), "conditions found")
+'''
+BROKEN_QUERY = '''CRITERIA = {criteria}
+raise RuntimeError("The FHIR search failed")
+'''
+
+TRANSITIONS = [
+    Transition("Admin", "epidemiologist"),
+    Transition("epidemiologist", "data_analyst"),
+    Transition("data_analyst", "Executor", when=has_code),
+    Transition("data_analyst", "Admin"),
+    Transition("Executor", "data_analyst", when=execution_failed),
+    Transition("Executor", "Admin"),
+]
+
+
+def time_executor(executor, code: str, n: int):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        result = executor.execute_code_blocks([CodeBlock(code=code, language="python")])
+        times.append(time.perf_counter() - start)
+        assert result.exit_code == 0, result.output
+    return statistics.mean(times), statistics.median(times)
+
+
+class ScriptedChat:
+    # The mock LLM's side of the chat: the epidemiologist gives the criteria and the data analyst
+    # writes the query for them (query_criteria, if parse_criteria can't read them), or a broken one
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.criteria = ""
+        self.query_criteria = None
+        self.broken = False
+        self.analyst_calls = 0
+
+    def reply(self, request):
+        system = str(request["messages"][0].get("content", ""))
+        if system.startswith("Epidemiologist"):
+            return self.criteria
+        if system.startswith("Data analyst"):
+            self.analyst_calls += 1
+            criteria = json.dumps((self.query_criteria or parse_criteria(self.criteria)).to_dict())
+            code = (BROKEN_QUERY if self.broken else QUERY).format(criteria=criteria, base_url=self.base_url)
+            return f"```python\n{code}```"
+        return "TERMINATE"
+
+
+def run_chat(llm_url: str, library: QueryLibrary, work_dir: str):
+    config = {"config_list": [{"model": "gpt-4", "api_key": "mock", "base_url": llm_url}], "cache_seed": None}
+    admin = UserProxyAgent("Admin", human_input_mode="NEVER", code_execution_config=False, default_auto_reply="TERMINATE")
+    epidemiologist = AssistantAgent("epidemiologist", system_message="Epidemiologist. Define the criteria.", llm_config=config)
+    data_analyst = AssistantAgent("data_analyst", system_message="Data analyst. Write the query.", llm_config=config)
+    executor = WarmPythonExecutor(work_dir)
+    executor_agent = UserProxyAgent("Executor", human_input_mode="NEVER",
+                                    code_execution_config={"last_n_messages": 1, "executor": executor})
+    reuse = QueryReuse(library)
+    reuse.attach(data_analyst, executor)
+    agents = [admin, epidemiologist, data_analyst, executor_agent]
+    groupchat = GroupChat(agents=agents, messages=[], max_round=20, speaker_selection_method=SpeakerGraph(TRANSITIONS))
+    manager = GroupChatManager(groupchat=groupchat, llm_config=config)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        admin.initiate_chat(manager, message="Find the patients for a screening.")
+    executor.close()
+    return time.perf_counter() - start, len(groupchat.messages), executor.executions, reuse
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--executions", type=int, default=20, help="executions of the query per executor")
+    parser.add_argument("--latency", type=float, default=0.5, help="mock completion latency in seconds")
+    args = parser.parse_args()
+
+    with StubFhirServer(n_patients=1000) as fhir, MockOpenAIServer(latency=args.latency) as llm, \
+            tempfile.TemporaryDirectory() as directory:
+        code = QUERY.format(criteria='{"min_age": 50, "max_age": 70, "conditions": ["Hyperglycemia"]}',
+                            base_url=fhir.base_url)
+        print(f"{'executor':<28} {'mean ms':>8} {'p50 ms':>8}")
+        cold = LocalCommandLineCodeExecutor(work_dir=directory)
+        warm = WarmPythonExecutor(directory)
+        for name, executor in (("new interpreter per run", cold), ("warm worker", warm)):
+            mean, p50 = time_executor(executor, code, args.executions)
+            print(f"{name:<28} {mean * 1e3:>8.1f} {p50 * 1e3:>8.1f}")
+        warm.close()
+
+        chat = ScriptedChat(fhir.base_url)
+        llm.reply = chat.reply
+        library = QueryLibrary(os.path.join(directory, "query_library.json"))
+        runs = [
+            ("first run", "Patients aged 50 to 70 with Hyperglycemia.", None, False),
+            ("second run", "Patients aged 50 to 70 with Hyperglycemia.", None, False),
+            ("other ages", "Patients aged 30 to 45 with Hyperglycemia.", None, False),
+            ("female only", "Female patients aged 50 to 70 with Hyperglycemia.", CohortCriteria(50, 70, ("Hyperglycemia",)),
+             False),
+            ("broken code", "Patients aged 50 to 70 with Osteoporosis.", None, True),
+        ]
+        print(f"\n{'chat':<12} {'analyst LLM calls':>18} {'executions':>11} {'turns':>6} {'seconds':>8}")
+        for name, criteria, query_criteria, broken in runs:
+            chat.criteria, chat.query_criteria, chat.broken, chat.analyst_calls = criteria, query_criteria, broken, 0
+            seconds, turns, executions, reuse = run_chat(llm.base_url, library, directory)
+            print(f"{name:<12} {chat.analyst_calls:>18} {executions:>11} {turns:>6} {seconds:>8.2f}   {reuse.report()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark of resuming an interrupted outreach run from its run_journal.RunJournal.
+
+Streams the cohort of a local stub FHIR server into email writing with a local mock
+OpenAI-compatible server, as hospital_w_func_teams does, and kills the run after --crash-after
+emails. The run is then resumed from its journal, and for comparison started over without one.
+Prints the FHIR requests, completions and wall time of each run, and checks that the resumed
+run's output holds every patient's email exactly once.
+
+Run from the repository root:
+    python -m benchmarks.bench_run_journal --patients 2000 --crash-after 1500
+"""
+import argparse
+import csv
+import functools
+import os
+import tempfile
+import time
+
+from openai import OpenAI
+
+from benchmarks.mock_openai_server import MockOpenAIServer
+from benchmarks.stub_fhir_server import StubFhirServer
+from cohort_search import iter_patients_between_ages_and_condition
+from fhir_client import FhirClient
+from outreach_pipeline import run_outreach_pipeline
+from outreach_sinks import open_sink
+from run_journal import RunJournal
+
+USER_PROPOSAL = "Find patients for colonoscopy screening"
+
+
+class Crash(Exception):
+    pass
+
+
+def save(sink, journal, crash_after, result):
+    # save_outreach_email of hospital_w_func_teams, dying once crash_after emails are saved
+    if crash_after is not None and sink.written >= crash_after:
+        raise Crash()
+    sink.write(result)
+    if journal and result.content is not None:
+        journal.record_email(result.patient, result.content)
+
+
+def run(openai_client, search, output, journal=None, crash_after=None, concurrency=16):
+    with open_sink(output) as sink:
+        patients = search()
+        if journal:
+            journal.replay(sink)
+            patients = journal.pending(journal.cohort(search))
+        run_outreach_pipeline(openai_client, patients, USER_PROPOSAL,
+                              functools.partial(save, sink, journal, crash_after), max_concurrency=concurrency)
+    if journal:
+        journal.finish()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=2000, help="number of patients on the stub server")
+    parser.add_argument("--crash-after", type=int, default=1500, help="emails written before the run is killed")
+    parser.add_argument("--fhir-latency", type=float, default=0.02, help="stub FHIR latency per request in seconds")
+    parser.add_argument("--llm-latency", type=float, default=0.1, help="mock completion latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=16, help="max_concurrency of the email stage")
+    args = parser.parse_args()
+
+    with StubFhirServer(n_patients=args.patients, latency=args.fhir_latency) as fhir, \
+            MockOpenAIServer(latency=args.llm_latency) as llm, tempfile.TemporaryDirectory() as directory:
+        fhir_client = FhirClient(fhir.base_url)
+        openai_client = OpenAI(api_key="mock", base_url=llm.base_url, max_retries=0)
+        output = os.path.join(directory, "out.csv")
+        journals = os.path.join(directory, "journals")
+
+        def search():
+            return iter_patients_between_ages_and_condition(0, 120, "disorder", server_filter=False, client=fhir_client)
+
+        runs = {
+            "interrupted": lambda: run(openai_client, search, output, RunJournal.open(USER_PROPOSAL, journals),
+                                       args.crash_after, args.concurrency),
+            "resumed": lambda: run(openai_client, search, output, RunJournal.open(USER_PROPOSAL, journals),
+                                   concurrency=args.concurrency),
+            "started over": lambda: run(openai_client, search, os.path.join(directory, "restart.csv"),
+                                        concurrency=args.concurrency),
+        }
+        print(f"{'run':<13} {'FHIR requests':>14} {'completions':>12} {'seconds':>8}")
+        for name, job in runs.items():
+            fhir.reset_count()
+            llm.reset_count()
+            start = time.perf_counter()
+            try:
+                job()
+            except Crash:
+                pass
+            print(f"{name:<13} {fhir.request_count:>14} {llm.request_count:>12} {time.perf_counter() - start:>8.2f}")
+
+        with open(output, newline="") as f:
+            urls = [row["patient_url"] for row in csv.DictReader(f)]
+        with open(os.path.join(directory, "restart.csv"), newline="") as f:
+            expected = {row["patient_url"] for row in csv.DictReader(f)}
+        assert len(urls) == len(set(urls)) and set(urls) == expected, "the resumed output differs"
+        print(f"\nresumed output: {len(urls)} emails, each patient once")
+
+
+if __name__ == "__main__":
+    main()
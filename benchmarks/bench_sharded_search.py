@@ -0,0 +1,50 @@
+"""
+Benchmark of the sharded cohort search (cohort_search.iter_sharded_condition_matches).
+
+Runs the same cohort search against a local stub FHIR server with 1 worker (the whole
+birthdate window in one search, page after page) and then with the window split into birthdate
+shards searched by 2, 4, 8, ... workers. Prints the wall time, the FHIR requests and the speedup
+of each, and checks that every run finds the same patients.
+
+Run from the repository root:
+    python -m benchmarks.bench_sharded_search --patients 20000 --latency 0.05 --workers 1 2 4 8 16
+"""
+import argparse
+import time
+
+from benchmarks.stub_fhir_server import StubFhirServer
+from cohort_search import iter_patients_between_ages_and_condition
+from fhir_client import FhirClient
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=20000, help="number of patients on the stub server")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub latency per request in seconds")
+    parser.add_argument("--page-size", type=int, default=100, help="conditions per search page")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="worker counts to compare")
+    parser.add_argument("--max-shard-results", type=int, default=1000,
+                        help="conditions above which a shard is split in two")
+    args = parser.parse_args()
+
+    with StubFhirServer(n_patients=args.patients, latency=args.latency) as server:
+        client = FhirClient(server.base_url)
+        expected = None
+        baseline = None
+        print(f"{'workers':>7} {'patients':>9} {'requests':>9} {'seconds':>8} {'speedup':>8}")
+        for workers in args.workers:
+            client.reset_stats()
+            start = time.perf_counter()
+            patients = list(iter_patients_between_ages_and_condition(
+                0, 120, "disorder", page_size=args.page_size, server_filter=False, client=client,
+                workers=workers, max_shard_results=args.max_shard_results))
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            urls = sorted(p["patient_url"] for p in patients)
+            expected = expected or urls
+            assert urls == expected, f"{workers} workers found different patients"
+            print(f"{workers:>7} {len(patients):>9} {client.request_count:>9} {elapsed:>8.2f} {baseline / elapsed:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
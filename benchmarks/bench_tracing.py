@@ -0,0 +1,142 @@
+"""
+Benchmark of the span tracing of a run (tracing).
+
+Runs a cohort search against a local stub FHIR server and writes the emails with a local mock
+OpenAI-compatible server, with the steps traced the way hospital_w_func_teams.py traces them,
+three times: keeping the spans in memory only, also writing them to a JSON lines file, and also
+sending them to a local stub OpenTelemetry collector (OTLP/HTTP JSON). Prints the wall time,
+the spans and the tracing cost of each, checks that the file and the collector got every span,
+and prints the hot spot report of the last run.
+
+Run from the repository root:
+    python -m benchmarks.bench_tracing --patients 1000 --fhir-latency 0.01 --llm-latency 0.02
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from openai import OpenAI
+
+from benchmarks.mock_openai_server import MockOpenAIServer
+from benchmarks.stub_fhir_server import StubFhirServer
+from cohort_search import iter_patients_between_ages_and_condition
+from fhir_client import FhirClient
+from llm_cache import CachedOpenAI, CompletionCache, LLMUsage
+from outreach_emails import generate_emails
+from tracing import JsonlExporter, OtlpExporter, Tracer, traced, tracer
+
+USER_PROPOSAL = "Find patients for colonoscopy screening"
+
+
+class StubCollector:
+    # Counts the spans POSTed to /v1/traces, as an OpenTelemetry collector would receive them
+    def __init__(self):
+        self.spans = 0
+        self.names = set()
+        self._lock = threading.Lock()
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args) -> None:
+                pass
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                spans = [s for rs in body["resourceSpans"] for ss in rs["scopeSpans"] for s in ss["spans"]]
+                with collector._lock:
+                    collector.spans += len(spans)
+                    collector.names.update(s["name"] for s in spans)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.endpoint = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def span_cost(n: int = 100000) -> float:
+    # Seconds per span for an empty span with a counter, kept in memory only
+    local = Tracer()
+    start = time.perf_counter()
+    for _ in range(n):
+        with local.span("empty") as span:
+            span.add("n")
+    return (time.perf_counter() - start) / n
+
+
+def run(fhir_url: str, llm_url: str, concurrency: int) -> float:
+    fhir_client = FhirClient(fhir_url)
+    openai_client = CachedOpenAI(OpenAI(api_key="mock", base_url=llm_url, max_retries=0), step="emails",
+                                 cache=CompletionCache(":memory:", usage=LLMUsage()), usage=LLMUsage())
+
+    @traced()
+    def find_patients():
+        return iter_patients_between_ages_and_condition(0, 120, "disorder", server_filter=False, client=fhir_client)
+
+    @traced()
+    def write_outreach_emails(patients):
+        for result in generate_emails(openai_client, patients, USER_PROPOSAL, max_concurrency=concurrency):
+            with tracer.span("save_outreach_email") as span:
+                span.add("emails.saved").add("emails.bytes", len((result.content or "").encode()))
+
+    start = time.perf_counter()
+    write_outreach_emails(list(find_patients()))
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=1000, help="number of patients on the stub server")
+    parser.add_argument("--fhir-latency", type=float, default=0.01, help="stub FHIR latency per request in seconds")
+    parser.add_argument("--llm-latency", type=float, default=0.02, help="mock completion latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=16, help="max_concurrency of the email step")
+    args = parser.parse_args()
+
+    cost = span_cost()
+    collector = StubCollector()
+    with StubFhirServer(n_patients=args.patients, latency=args.fhir_latency) as fhir, \
+            MockOpenAIServer(latency=args.llm_latency) as llm, tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trace.jsonl")
+        configs = [
+            ("in memory", lambda: []),
+            ("JSONL file", lambda: [JsonlExporter(path)]),
+            ("JSONL + collector", lambda: [JsonlExporter(path), OtlpExporter(collector.endpoint)]),
+        ]
+        print(f"empty span: {cost * 1e6:.1f}us\n")
+        print(f"{'exporters':<18} {'seconds':>8} {'spans':>7} {'span cost s':>12} {'overhead':>9}")
+        for name, exporters in configs:
+            if os.path.exists(path):
+                os.remove(path)
+            tracer.exporters = exporters()
+            tracer.reset()
+            seconds = run(fhir.base_url, llm.base_url, args.concurrency)
+            tracer.flush()
+            for exporter in tracer.exporters:
+                exporter.close()
+            spans = sum(t.count for t in tracer.totals.values())
+            # The export time is in the run's time, so only the in memory span cost is estimated
+            estimate = spans * cost
+            print(f"{name:<18} {seconds:>8.2f} {spans:>7} {estimate:>12.4f} {estimate / seconds:>8.2%}")
+            if tracer.exporters:
+                with open(path) as f:
+                    assert sum(1 for _ in f) == spans, "the JSONL file is missing spans"
+        assert collector.spans == spans, f"the collector got {collector.spans} of {spans} spans"
+        tracer.exporters = []
+    collector.stop()
+    print(f"\nThe collector received {collector.spans} spans ({len(collector.names)} span names)\n")
+    print(tracer.report())
+
+
+if __name__ == "__main__":
+    main()
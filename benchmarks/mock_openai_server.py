@@ -0,0 +1,123 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional
+
+
+class MockOpenAIServer:
+    '''
+    A small in-process server that answers OpenAI-compatible /v1/chat/completions requests.
+
+    Each completion takes `latency` seconds, plus or minus up to `jitter` seconds, and a share
+    `error_rate` of the requests fail with a 500 error. The reply echoes the start of the prompt
+    so different prompts give different emails. Requests for JSON output (response_format
+    json_object) are answered with `json_reply` instead. `reply`, if given, is called with each
+    request body and the text it returns is the reply (None keeps the default one).
+    request_count records how many requests were made.
+
+    Example usage:
+    >>> with MockOpenAIServer(latency=0.5) as server:
+    ...     client = OpenAI(api_key="mock", base_url=server.base_url)
+    '''
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0,
+                 json_reply: str = "{}", reply: Optional[Callable[[Dict], Optional[str]]] = None):
+        self.latency = latency
+        self.reply = reply
+        self.json_reply = json_reply
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.request_count = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> str:
+        server = self
+
+        class Handler(MockOpenAIHandler):
+            mock = server
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self) -> None:
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def reset_count(self) -> None:
+        with self._lock:
+            self.request_count = self.prompt_tokens = self.completion_tokens = 0
+
+    def __enter__(self) -> "MockOpenAIServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    mock: MockOpenAIServer = None
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send_json(self, body: Dict, status: int = 200) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self) -> None:
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        mock = self.mock
+        with mock._lock:
+            mock.request_count += 1
+            delay = max(0.0, mock.latency + mock._rng.uniform(-mock.jitter, mock.jitter))
+            failed = mock._rng.random() < mock.error_rate
+        time.sleep(delay)
+
+        if not self.path.endswith("/chat/completions"):
+            self._send_json({"error": {"message": "not found"}}, status=404)
+            return
+        if failed:
+            self._send_json({"error": {"message": "mock server error", "type": "server_error"}}, status=500)
+            return
+
+        prompt = " ".join(str(m.get("content", "")) for m in request.get("messages", []))
+        content = mock.reply(request) if mock.reply else None
+        if content is None and (request.get("response_format") or {}).get("type") == "json_object":
+            content = mock.json_reply
+        elif content is None:
+            content = f"Subject: Screening invitation\n\nDear patient,\n\n{prompt[:200]}\n\nKind regards,\nOutreach team"
+        prompt_tokens, completion_tokens = len(prompt) // 4, len(content) // 4
+        with mock._lock:
+            mock.prompt_tokens += prompt_tokens
+            mock.completion_tokens += completion_tokens
+        self._send_json({
+            "id": f"chatcmpl-mock-{mock.request_count}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
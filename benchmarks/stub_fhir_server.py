@@ -0,0 +1,534 @@
+import datetime
+import gzip
+import json
+import operator
+import random
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+# SNOMED display names (and codes) that the synthetic conditions are drawn from
+CONDITIONS = [
+    ("80394007", "Hyperglycemia (disorder)"),
+    ("64859006", "Osteoporosis (disorder)"),
+    ("10509002", "Acute bronchitis (disorder)"),
+    ("22298006", "Myocardial infarction (disorder)"),
+    ("44054006", "Diabetes mellitus type 2 (disorder)"),
+    ("38341003", "Hypertension (disorder)"),
+    ("195662009", "Acute viral pharyngitis (disorder)"),
+    ("68496003", "Polyp of colon (disorder)"),
+]
+
+# Page size used when a search does not set _count
+DEFAULT_PAGE_SIZE = 20
+# Searches whose matches are kept for paging through them, as a real server keeps its results
+SEARCH_SNAPSHOTS = 32
+# Patients are born up to this many days ago
+MAX_AGE_DAYS = 110 * 365
+
+
+def make_patient(i: int, rng: random.Random) -> Dict:
+    birth_date = datetime.date.today() - datetime.timedelta(days=rng.randint(0, MAX_AGE_DAYS))
+    return {
+        "resourceType": "Patient",
+        "id": str(i),
+        "meta": {"versionId": "1", "lastUpdated": "2024-01-01T00:00:00+00:00"},
+        "identifier": [
+            {"system": "https://github.com/synthetichealth/synthea", "value": f"synthea-{i}"},
+            {"type": {"text": "Medical Record Number"}, "value": f"MRN-{i:08d}"},
+        ],
+        "name": [{"use": "official", "family": f"Family{i}", "given": [f"Given{i}"]}],
+        "telecom": [
+            {"system": "phone", "value": f"555-{i % 10000:04d}"},
+            {"system": "email", "value": f"patient{i}@example.org"},
+        ],
+        "gender": rng.choice(["male", "female"]),
+        "birthDate": birth_date.isoformat(),
+        "address": [{"city": "Springfield", "postalCode": f"{rng.randint(1000, 99999):05d}"}],
+        "maritalStatus": {"text": rng.choice(["M", "S"])},
+    }
+
+
+def concept(code: str, display: str) -> Dict:
+    return {"coding": [{"system": "http://snomed.info/sct", "code": code, "display": display}], "text": display}
+
+
+# Conditions share their code and first version's meta, so a million of them fit in memory.
+# Changes replace these dicts rather than modify them
+_CONCEPTS = [concept(code, display) for code, display in CONDITIONS]
+_FIRST_VERSION = {"versionId": "1", "lastUpdated": "2024-01-01T00:00:00+00:00"}
+
+
+def make_condition(i: int, patient_id: str, rng: random.Random) -> Dict:
+    return {
+        "resourceType": "Condition",
+        "id": f"c{i}",
+        "meta": _FIRST_VERSION,
+        "code": rng.choice(_CONCEPTS),
+        "subject": {"reference": f"Patient/{patient_id}"},
+    }
+
+
+def etag_of(resource: Dict) -> str:
+    return f'W/"{resource["meta"]["versionId"]}"'
+
+
+def now_instant() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds")
+
+
+def parse_instant(value: str) -> datetime.datetime:
+    instant = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return instant if instant.tzinfo else instant.replace(tzinfo=datetime.timezone.utc)
+
+
+# FHIR search prefixes of dates and instants
+_PREFIXES = {"le": operator.le, "lt": operator.lt, "ge": operator.ge, "gt": operator.gt, "eq": operator.eq}
+
+
+def _prefixed(value: str):
+    # "gt2024-01-01" -> (operator.gt, "2024-01-01"); no prefix means eq
+    if value[:2] in _PREFIXES:
+        return _PREFIXES[value[:2]], value[2:]
+    return operator.eq, value
+
+
+def last_updated_matches(resource: Dict, values: List[str]) -> bool:
+    updated = parse_instant(resource["meta"]["lastUpdated"])
+    return all(compare(updated, parse_instant(operand)) for compare, operand in map(_prefixed, values))
+
+
+class SyntheticPatients(Mapping):
+    '''
+    The patients of a StubFhirServer by id ("0" to str(n - 1)). Only their birth dates are kept;
+    a patient is built from its own seed whenever it is read, so the same id always gives the
+    same patient and a million of them take a few MB. Patients that are changed are stored.
+    '''
+
+    def __init__(self, n: int, seed: int, birth_days: array):
+        self.n = n
+        self.seed = seed
+        self._today = datetime.date.today()
+        # Days before today each patient was born
+        self._birth_days = birth_days
+        self._changed: Dict[str, Dict] = {}
+
+    def _index(self, patient_id: str) -> Optional[int]:
+        if patient_id.isdigit() and str(int(patient_id)) == patient_id and int(patient_id) < self.n:
+            return int(patient_id)
+        return None
+
+    def __getitem__(self, patient_id: str) -> Dict:
+        if patient_id in self._changed:
+            return self._changed[patient_id]
+        i = self._index(patient_id)
+        if i is None:
+            raise KeyError(patient_id)
+        patient = make_patient(i, random.Random(self.seed * self.n + i))
+        patient["birthDate"] = self.birth_date(patient_id)
+        return patient
+
+    def __setitem__(self, patient_id: str, patient: Dict) -> None:
+        if self._index(patient_id) is None:
+            raise KeyError(patient_id)
+        self._changed[patient_id] = patient
+
+    def __iter__(self) -> Iterator[str]:
+        return map(str, range(self.n))
+
+    def __len__(self) -> int:
+        return self.n
+
+    def birth_date(self, patient_id: str) -> str:
+        # Without building the patient, for birthdate searches
+        if patient_id in self._changed:
+            return self._changed[patient_id]["birthDate"]
+        return (self._today - datetime.timedelta(days=self._birth_days[int(patient_id)])).isoformat()
+
+
+class StubFhirServer:
+    '''
+    A small in-process FHIR R4 server seeded with synthetic, Synthea-style patients.
+
+    Every patient has one condition. Each request sleeps for `latency` seconds before it
+    is answered to simulate the round-trip to a remote server, and request_count records
+    how many requests were made. Responses are gzipped if the client accepts it. Patient
+    reads carry an ETag and answer If-None-Match with 304 Not Modified. Searches are paged with _count (default 20, as on HAPI)
+    and a next link carrying _offset. support_include and support_batch switch off
+    _include=Condition:subject and batch Bundles, and support_code_filter makes code= and
+    code:text= searches fail, to mimic more limited servers. throttle_rate is the share of
+    requests answered with 429 Too Many Requests and a Retry-After header. Conditions and
+    patients can be changed with add_condition, update_condition and update_patient, and
+    searches support _lastUpdated, so incremental refreshes can be tested. Patients are built
+    when they are read (see SyntheticPatients) and the matches of the last SEARCH_SNAPSHOTS
+    searches are kept for paging, so it serves a million patients.
+
+    Bulk Data exports ([base]/$export and [base]/Patient/$export, with _type and _since) are
+    kicked off asynchronously: the status endpoint answers 202 with X-Progress (and Retry-After,
+    if export_retry_after is set) until export_delay seconds have passed, then returns the
+    manifest. The NDJSON files hold
+    export_file_size resources each and are gzipped on the fly, or served as .ndjson.gz
+    blobs if export_gzip_files is set.
+
+    Example usage:
+    >>> with StubFhirServer(n_patients=1000, latency=0.02) as server:
+    ...     FhirClient(server.base_url).fetch_patients(ids)
+    '''
+
+    def __init__(self, n_patients: int = 1000, latency: float = 0.0, seed: int = 0,
+                 support_include: bool = True, support_batch: bool = True, support_code_filter: bool = True,
+                 throttle_rate: float = 0.0, export_delay: float = 0.0, export_file_size: int = 10000,
+                 export_gzip_files: bool = False, export_retry_after: Optional[int] = None):
+        rng = random.Random(seed)
+        self.export_delay = export_delay
+        self.export_file_size = export_file_size
+        self.export_gzip_files = export_gzip_files
+        self.export_retry_after = export_retry_after
+        self.exports: Dict[str, Dict] = {}
+        self.throttle_rate = throttle_rate
+        self._throttle_rng = random.Random(seed)
+        self.latency = latency
+        self.support_include = support_include
+        self.support_batch = support_batch
+        self.support_code_filter = support_code_filter
+        birth_days = array("H")
+        self.conditions: List[Dict] = []
+        for i in range(n_patients):
+            birth_days.append(rng.randint(0, MAX_AGE_DAYS))
+            self.conditions.append(make_condition(i, str(i), rng))
+        self.patients = SyntheticPatients(n_patients, seed, birth_days)
+        self.request_count = 0
+        self._lock = threading.Lock()
+        # Bumped on every change, so searches made before it aren't paged from
+        self._version = 0
+        self._snapshots: OrderedDict = OrderedDict()
+        self._httpd: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/baseR4"
+
+    def start(self) -> str:
+        server = self
+
+        class Handler(StubFhirHandler):
+            stub = server
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def update_patient(self, patient_id: str, **changes) -> None:
+        '''
+        Bumps the version of a patient, so cached copies of it are no longer current, after
+        applying any changes, e.g. update_patient("1", birthDate="1950-01-01").
+        '''
+        patient = self.patients[patient_id]
+        patient.update(changes)
+        patient["meta"] = {"versionId": str(int(patient["meta"]["versionId"]) + 1), "lastUpdated": now_instant()}
+        with self._lock:
+            self.patients[patient_id] = patient
+            self._version += 1
+
+    def add_condition(self, patient_id: str, code: Optional[str] = None) -> Dict:
+        '''
+        Records a new condition for a patient, one of CONDITIONS (a random one if code is None).
+        '''
+        rng = random.Random(len(self.conditions))
+        condition = make_condition(len(self.conditions), patient_id, rng)
+        if code is not None:
+            condition["code"] = concept(code, dict(CONDITIONS)[code])
+        condition["meta"] = {"versionId": "1", "lastUpdated": now_instant()}
+        with self._lock:
+            self.conditions.append(condition)
+            self._version += 1
+        return condition
+
+    def update_condition(self, condition_id: str, code: str) -> None:
+        '''
+        Changes the code of a condition, e.g. when a diagnosis is corrected.
+        '''
+        condition = next(c for c in self.conditions if c["id"] == condition_id)
+        condition["code"] = concept(code, dict(CONDITIONS)[code])
+        condition["meta"] = {"versionId": str(int(condition["meta"]["versionId"]) + 1), "lastUpdated": now_instant()}
+        with self._lock:
+            self._version += 1
+
+    def reset_count(self) -> None:
+        with self._lock:
+            self.request_count = 0
+
+    def __enter__(self) -> "StubFhirServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def search(self, resource_type: str, query: Dict[str, List[str]]) -> List[Dict]:
+        '''
+        The matches of a Condition or Patient search. Paging through a search reuses its matches
+        instead of searching again, until the resources change.
+        '''
+        key = (resource_type, self._version,
+               tuple(sorted((k, tuple(v)) for k, v in query.items() if k not in ("_offset", "_count", "_include"))))
+        with self._lock:
+            matches = self._snapshots.get(key)
+            if matches is not None:
+                self._snapshots.move_to_end(key)
+                return matches
+        matches = self.search_conditions(query) if resource_type == "Condition" else self.search_patients(query)
+        with self._lock:
+            self._snapshots[key] = matches
+            while len(self._snapshots) > SEARCH_SNAPSHOTS:
+                self._snapshots.popitem(last=False)
+        return matches
+
+    def search_conditions(self, query: Dict[str, List[str]]) -> List[Dict]:
+        '''
+        Applies the subject.birthdate=leX / subject.birthdate=gtY, code=system|code,...,
+        code:text=, subject=Patient/id,... and _lastUpdated=geX search parameters.
+        '''
+        matches = list(self.conditions)
+        for subjects in query.get("subject", []):
+            references = {s if "/" in s else f"Patient/{s}" for s in subjects.split(",")}
+            matches = [c for c in matches if c["subject"]["reference"] in references]
+        if "_lastUpdated" in query:
+            matches = [c for c in matches if last_updated_matches(c, query["_lastUpdated"])]
+        if "code" in query:
+            tokens = {token.split("|")[-1] for value in query["code"] for token in value.split(",")}
+            matches = [c for c in matches if any(coding["code"] in tokens for coding in c["code"]["coding"])]
+        for text in query.get("code:text", []):
+            matches = [c for c in matches if text.lower() in c["code"]["text"].lower()]
+        for value in query.get("subject.birthdate", []):
+            compare, date = _prefixed(value)
+            matches = [c for c in matches
+                       if compare(self.patients.birth_date(c["subject"]["reference"].split("/")[1]), date)]
+        return matches
+
+    def start_export(self, request_url: str, query: Dict[str, List[str]]) -> str:
+        '''
+        Records a Bulk Data export job and returns its id.
+        '''
+        types = [t for value in query.get("_type", ["Patient,Condition"]) for t in value.split(",")]
+        with self._lock:
+            job_id = str(len(self.exports) + 1)
+            self.exports[job_id] = {"request": request_url, "types": types, "since": query.get("_since"),
+                                    "started": time.monotonic(), "transactionTime": now_instant()}
+        return job_id
+
+    def export_resources(self, job_id: str, resource_type: str) -> List[Dict]:
+        job = self.exports[job_id]
+        resources = list(self.patients.values()) if resource_type == "Patient" else list(self.conditions)
+        if job["since"]:
+            resources = [r for r in resources if last_updated_matches(r, [f"ge{job['since'][0]}"])]
+        return resources
+
+    def search_patients(self, query: Dict[str, List[str]]) -> List[Dict]:
+        '''
+        Applies the _lastUpdated=geX and birthdate=leX search parameters.
+        '''
+        # By birth date first, so only the patients that match are built
+        ids = list(self.patients)
+        for value in query.get("birthdate", []):
+            compare, date = _prefixed(value)
+            ids = [i for i in ids if compare(self.patients.birth_date(i), date)]
+        matches = [self.patients[i] for i in ids]
+        if "_lastUpdated" in query:
+            matches = [p for p in matches if last_updated_matches(p, query["_lastUpdated"])]
+        return matches
+
+
+class StubFhirHandler(BaseHTTPRequestHandler):
+    stub: StubFhirServer = None
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send_json(self, body: Dict, status: int = 200, headers: Optional[Dict[str, str]] = None) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            payload = gzip.compress(payload, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_not_modified(self, etag: str) -> None:
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _url(self, path: str, query: Dict[str, List[str]], offset: int) -> str:
+        return f"http://{self.headers['Host']}{path}?{urlencode({**query, '_offset': [offset]}, doseq=True)}"
+
+    def _count_request(self) -> bool:
+        # Returns False if the request was throttled and has already been answered
+        with self.stub._lock:
+            self.stub.request_count += 1
+            throttled = self.stub._throttle_rng.random() < self.stub.throttle_rate
+        if self.stub.latency:
+            time.sleep(self.stub.latency)
+        if throttled:
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self._send_json({"resourceType": "OperationOutcome"}, status=429, headers={"Retry-After": "0"})
+        return not throttled
+
+    def _send_searchset(self, path: str, query: Dict[str, List[str]], matches: List[Dict]) -> None:
+        # One page of search results, with a next link if there are more
+        started = now_instant()
+        total = len(matches)
+        offset = int(query.pop("_offset", ["0"])[0])
+        count = int(query.get("_count", [str(DEFAULT_PAGE_SIZE)])[0])
+        matches = matches[offset:offset + count]
+        links = [{"relation": "self", "url": self._url(path, query, offset)}]
+        if offset + count < total:
+            links.append({"relation": "next", "url": self._url(path, query, offset + count)})
+
+        entries = [{"resource": r, "search": {"mode": "match"}} for r in matches]
+        if self.stub.support_include and "Condition:subject" in query.get("_include", []):
+            subject_ids = dict.fromkeys(c["subject"]["reference"].split("/")[1] for c in matches)
+            entries += [{"resource": self.stub.patients[i], "search": {"mode": "include"}} for i in subject_ids]
+        self._send_json({
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "meta": {"lastUpdated": started},
+            "total": total,
+            "link": links,
+            "entry": entries,
+        })
+
+    def do_POST(self) -> None:
+        if not self._count_request():
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.stub.support_batch or body.get("type") != "batch":
+            self._send_json({"resourceType": "OperationOutcome"}, status=400)
+            return
+
+        entries = []
+        for entry in body.get("entry", []):
+            resource_type, _, resource_id = entry["request"]["url"].partition("/")
+            patient = self.stub.patients.get(resource_id) if resource_type == "Patient" else None
+            if patient is None:
+                entries.append({"response": {"status": "404 Not Found"}})
+            elif entry["request"].get("ifNoneMatch") == etag_of(patient):
+                entries.append({"response": {"status": "304 Not Modified", "etag": etag_of(patient)}})
+            else:
+                entries.append({"resource": patient, "response": {"status": "200 OK", "etag": etag_of(patient)}})
+        self._send_json({"resourceType": "Bundle", "type": "batch-response", "entry": entries})
+
+    def _export_status(self, job_id: str) -> None:
+        job = self.stub.exports.get(job_id)
+        if job is None:
+            self._send_json({"resourceType": "OperationOutcome"}, status=404)
+            return
+        elapsed = time.monotonic() - job["started"]
+        if elapsed < self.stub.export_delay:
+            headers = {"X-Progress": f"{100 * elapsed / self.stub.export_delay:.0f}% complete"}
+            if self.stub.export_retry_after is not None:
+                headers["Retry-After"] = str(self.stub.export_retry_after)
+            self._send_json({}, status=202, headers=headers)
+            return
+        base = f"http://{self.headers['Host']}/baseR4"
+        extension = "ndjson.gz" if self.stub.export_gzip_files else "ndjson"
+        output = []
+        for resource_type in job["types"]:
+            count = len(self.stub.export_resources(job_id, resource_type))
+            for n in range(0, count, self.stub.export_file_size):
+                output.append({"type": resource_type, "count": min(self.stub.export_file_size, count - n),
+                               "url": f"{base}/$export-file/{job_id}/{resource_type}-{n}.{extension}"})
+        self._send_json({"transactionTime": job["transactionTime"], "request": job["request"],
+                         "requiresAccessToken": False, "output": output, "error": []})
+
+    def _export_file(self, job_id: str, name: str) -> None:
+        resource_type, _, rest = name.partition("-")
+        if job_id not in self.stub.exports:
+            self._send_json({"resourceType": "OperationOutcome"}, status=404)
+            return
+        offset = int(rest.split(".")[0])
+        resources = self.stub.export_resources(job_id, resource_type)[offset:offset + self.stub.export_file_size]
+        payload = "".join(json.dumps(r) + "\n" for r in resources).encode()
+        self.send_response(200)
+        if self.stub.export_gzip_files:
+            payload = gzip.compress(payload, compresslevel=1)
+            self.send_header("Content-Type", "application/gzip")
+        else:
+            self.send_header("Content-Type", "application/fhir+ndjson")
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                payload = gzip.compress(payload, compresslevel=1)
+                self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_DELETE(self) -> None:
+        # Clients delete an export job once they have its files
+        if not self._count_request():
+            return
+        parts = [p for p in urlsplit(self.path).path.split("/") if p][1:]
+        if len(parts) == 2 and parts[0] == "$export-status" and self.stub.exports.pop(parts[1], None):
+            self.send_response(202)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self._send_json({"resourceType": "OperationOutcome"}, status=404)
+
+    def do_GET(self) -> None:
+        if not self._count_request():
+            return
+
+        url = urlsplit(self.path)
+        parts = [p for p in url.path.split("/") if p][1:]  # drop the baseR4 prefix
+        query = parse_qs(url.query)
+
+        if parts in (["$export"], ["Patient", "$export"]):
+            if self.headers.get("Prefer") != "respond-async":
+                self._send_json({"resourceType": "OperationOutcome"}, status=400)
+                return
+            job_id = self.stub.start_export(f"http://{self.headers['Host']}{self.path}", query)
+            location = f"http://{self.headers['Host']}/baseR4/$export-status/{job_id}"
+            self._send_json({}, status=202, headers={"Content-Location": location})
+        elif len(parts) == 2 and parts[0] == "$export-status":
+            self._export_status(parts[1])
+        elif len(parts) == 3 and parts[0] == "$export-file":
+            self._export_file(parts[1], parts[2])
+        elif len(parts) == 2 and parts[0] == "Patient":
+            patient = self.stub.patients.get(parts[1])
+            if patient is None:
+                self._send_json({"resourceType": "OperationOutcome"}, status=404)
+            elif self.headers.get("If-None-Match") == etag_of(patient):
+                self._send_not_modified(etag_of(patient))
+            else:
+                self._send_json(patient, headers={"ETag": etag_of(patient)})
+        elif parts == ["Condition"] and not self.stub.support_code_filter and ("code" in query or "code:text" in query):
+            self._send_json({"resourceType": "OperationOutcome",
+                             "issue": [{"severity": "error", "code": "not-supported"}]}, status=400)
+        elif parts == ["Condition"]:
+            self._send_searchset(url.path, query, self.stub.search("Condition", query))
+        elif parts == ["Patient"]:
+            self._send_searchset(url.path, query, self.stub.search("Patient", query))
+        else:
+            self._send_json({"resourceType": "OperationOutcome"}, status=404)
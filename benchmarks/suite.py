@@ -0,0 +1,350 @@
+"""
+Offline benchmark suite: the hospital_w_func_teams.py pipeline and each of its steps, against a
+local stub FHIR server and a local mock OpenAI-compatible server.
+
+For each --patients scale (1k to 1M Synthea-style patients) the stub FHIR server is seeded and
+every step runs in its own process, so each one's peak memory is its own:
+- define_criteria: --criteria-calls structured completions defining the cohort criteria
+- find_patients: the cohort search for CRITERIA (patients aged 45 to 75 with a polyp of colon)
+- write_emails: one email completion per patient of the cohort
+- save_emails: writing the cohort's emails to out.csv
+- pipeline: hospital_w_func_teams.py itself, end to end, with the mock servers in place of
+  hapi.fhir.org, OpenAI and DeepInfra
+Each step runs --repeat times and the run with the median time is kept. Prints the items, wall
+time, throughput, p50/p99 latency (of each completion, FHIR request or write) and peak memory
+of each. The results are saved in RESULTS_DIR, one JSON file per run named
+after the time and the git commit, and compared with the last run with the same options: changes
+of more than --threshold in throughput, p99 latency or peak memory are marked as regressions.
+
+Run from the repository root:
+    python -m benchmarks.suite --patients 1000,100000 --llm-latency 0.05
+    python -m benchmarks.suite --patients 1000000 --steps find_patients,save_emails
+    python -m benchmarks.suite --compare .benchmark_results/20240101T120000-abc1234.json
+"""
+import argparse
+import csv
+import datetime
+import glob
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+# Where each run's results are saved, to compare later runs with
+RESULTS_DIR = os.getenv("BENCHMARK_RESULTS_DIR", ".benchmark_results")
+STEPS = ("define_criteria", "find_patients", "write_emails", "save_emails", "pipeline")
+# The proposal of hospital_w_func_teams.py, and the criteria the mock GPT-4 defines for it
+USER_PROPOSAL = "Find patients for colonoscopy screening"
+CRITERIA = {"min_age": 45, "max_age": 75, "conditions": ["Polyp of colon"]}
+# Relative change of a metric that is reported as a regression
+DEFAULT_THRESHOLD = 0.20
+# Latencies closer than this are the same, however large the relative change (e.g. buffered writes)
+MIN_LATENCY_CHANGE_MS = 1.0
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values: List[float], q: float) -> float:
+    # Nearest rank, so p99 of 100 values is the 99th
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def read_cohort(work_dir: str) -> List[Dict]:
+    with open(os.path.join(work_dir, "cohort.jsonl"), encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+# The steps, each run in a child process (see run_step). Each returns the number of items it
+# handled and the latency of each of its operations in seconds; the time of the whole step,
+# without starting the process and importing the modules, is added by main
+
+def step_define_criteria(args) -> Dict:
+    from openai import OpenAI
+    from cohort_criteria import request_criteria
+    client = OpenAI(api_key="mock", base_url=args.llm_url, max_retries=0)
+    latencies = []
+    for i in range(args.criteria_calls):
+        start = time.perf_counter()
+        assert request_criteria(client, f"{USER_PROPOSAL} ({i})", "gpt-4"), "no criteria defined"
+        latencies.append(time.perf_counter() - start)
+    return {"items": len(latencies), "latencies": latencies}
+
+
+def step_find_patients(args) -> Dict:
+    from cohort_search import iter_patients_between_ages_and_conditions
+    from fhir_client import FhirClient
+    client = FhirClient(args.fhir_url)
+    count = 0
+    # The cohort is kept for the email steps
+    with open(os.path.join(args.work_dir, "cohort.jsonl"), "w", encoding="utf-8") as f:
+        for patient in iter_patients_between_ages_and_conditions(CRITERIA["min_age"], CRITERIA["max_age"],
+                                                                 CRITERIA["conditions"], client=client):
+            f.write(json.dumps(patient) + "\n")
+            count += 1
+    return {"items": count, "latencies": [t.connect + t.wait + t.transfer for t in client.timings]}
+
+
+def step_write_emails(args) -> Dict:
+    from openai import OpenAI
+    from outreach_emails import generate_emails
+    client = OpenAI(api_key="mock", base_url=args.llm_url, max_retries=0)
+    latencies = [result.latency for result in generate_emails(client, read_cohort(args.work_dir), USER_PROPOSAL)
+                 if result.content is not None]
+    return {"items": len(latencies), "latencies": latencies}
+
+
+def step_save_emails(args) -> Dict:
+    from outreach_emails import EmailResult
+    from outreach_sinks import open_sink
+    content = "Subject: Screening invitation\n\nDear patient,\n\n" + "Please book your screening. " * 20
+    latencies = []
+    with open_sink(os.path.join(args.work_dir, "out.csv")) as sink:
+        for patient in read_cohort(args.work_dir):
+            start = time.perf_counter()
+            sink.write(EmailResult(patient, content, None, 1, 0.0))
+            latencies.append(time.perf_counter() - start)
+    return {"items": len(latencies), "latencies": latencies}
+
+
+STEP_FUNCTIONS = {"define_criteria": step_define_criteria, "find_patients": step_find_patients,
+                  "write_emails": step_write_emails, "save_emails": step_save_emails}
+
+
+def _serve_stub(n_patients: int, latency: float, connection) -> None:
+    from benchmarks.stub_fhir_server import StubFhirServer
+    with StubFhirServer(n_patients=n_patients, latency=latency) as fhir:
+        connection.send(fhir.base_url)
+        connection.recv()
+
+
+@contextlib.contextmanager
+def stub_fhir_process(n_patients: int, latency: float):
+    '''
+    Runs a StubFhirServer in its own process and yields its base URL. On Linux a child's peak
+    memory includes what its parent held when it was started, so the million patients of the
+    stub are kept out of the process that starts the steps.
+    '''
+    context = multiprocessing.get_context("spawn")
+    connection, child_connection = context.Pipe()
+    process = context.Process(target=_serve_stub, args=(n_patients, latency, child_connection), daemon=True)
+    process.start()
+    try:
+        yield connection.recv()
+    finally:
+        connection.send("stop")
+        process.join(10)
+        if process.is_alive():
+            process.kill()
+
+
+def child_env(fhir_url: str, llm_url: str, work_dir: str) -> Dict[str, str]:
+    # Points the scripts at the local servers, with the caches and stores that would carry
+    # results over from one run to the next turned off
+    return {**os.environ,
+            "FHIR_BASE_URL": fhir_url,
+            "OAI_CONFIG_LIST": json.dumps([{"model": "gpt-4", "api_key": "mock", "base_url": llm_url}]),
+            "OPENAI_API_KEY": "mock",
+            "EMAIL_BASE_URL": llm_url,
+            "FHIR_CACHE_PATH": "",
+            "LLM_CACHE_PATH": "",
+            "COHORT_CRITERIA_PATH": "",
+            "QUERY_LIBRARY_PATH": "",
+            "RUN_JOURNAL_DIR": os.path.join(work_dir, "journals"),
+            "TRACE_PATH": os.path.join(work_dir, "trace.jsonl"),
+            "OTEL_EXPORTER_OTLP_ENDPOINT": "",
+            "PYTHONPATH": REPO_ROOT}
+
+
+def run_process(command: List[str], env: Dict[str, str], cwd: str, log_path: str):
+    '''
+    Runs a command and returns its wall time, exit status and peak memory in MB.
+    '''
+    with open(log_path, "wb") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, env=env, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives the resource usage of this child alone
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return seconds, process.returncode, peak
+
+
+def run_step(step: str, args, fhir_url: str, llm_url: str, work_dir: str) -> Dict:
+    env = child_env(fhir_url, llm_url, work_dir)
+    log_path = os.path.join(work_dir, f"{step}.log")
+    if step == "pipeline":
+        for path in ("out.csv", "trace.jsonl"):
+            if os.path.exists(os.path.join(work_dir, path)):
+                os.remove(os.path.join(work_dir, path))
+        seconds, code, peak = run_process([sys.executable, os.path.join(REPO_ROOT, "hospital_w_func_teams.py")],
+                                          env, work_dir, log_path)
+        result = {"items": 0, "latencies": []}
+        if code == 0:
+            with open(os.path.join(work_dir, "out.csv"), newline="", encoding="utf-8") as f:
+                result["items"] = sum(1 for _ in csv.DictReader(f))
+            with open(os.path.join(work_dir, "trace.jsonl"), encoding="utf-8") as f:
+                spans = (json.loads(line) for line in f)
+                result["latencies"] = [s["duration"] for s in spans if s["name"] == "LLM outreach_emails"]
+    else:
+        result_path = os.path.join(work_dir, f"{step}.json")
+        command = [sys.executable, "-m", "benchmarks.suite", "--run-step", step, "--fhir-url", fhir_url,
+                   "--llm-url", llm_url, "--work-dir", work_dir, "--criteria-calls", str(args.criteria_calls),
+                   "--result", result_path]
+        seconds, code, peak = run_process(command, env, REPO_ROOT, log_path)
+        result = {"items": 0, "latencies": []}
+        if code == 0:
+            with open(result_path, encoding="utf-8") as f:
+                result = json.load(f)
+    if code != 0:
+        with open(log_path, encoding="utf-8", errors="replace") as f:
+            tail = f.read()[-2000:]
+        raise RuntimeError(f"{step} failed with exit code {code}:\n{tail}")
+    latencies = result["latencies"]
+    # The pipeline is timed end to end, including the start of the script
+    seconds = result.get("seconds", seconds)
+    return {"step": step, "items": result["items"], "seconds": round(seconds, 3),
+            "throughput": round(result["items"] / seconds, 2) if seconds else 0.0,
+            "p50_ms": round(percentile(latencies, 0.50) * 1e3, 3), "p99_ms": round(percentile(latencies, 0.99) * 1e3, 3),
+            "peak_mb": round(peak, 1)}
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def save_results(run: Dict, directory: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{run['created'].replace(':', '').replace('-', '')[:15]}-{run['commit']}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(run, f, indent=1)
+    return path
+
+
+def latest_results(directory: str, options: Dict, exclude: Optional[str] = None) -> Optional[str]:
+    # The newest saved run with the same options
+    for path in sorted(glob.glob(os.path.join(directory, "*.json")), reverse=True):
+        if os.path.abspath(path) == os.path.abspath(exclude or ""):
+            continue
+        with open(path, encoding="utf-8") as f:
+            if json.load(f).get("options") == options:
+                return path
+    return None
+
+
+def compare(run: Dict, baseline: Dict, threshold: float) -> List[str]:
+    '''
+    Prints how each result changed from the baseline run and returns the regressions: throughput
+    down, or p99 latency or peak memory up, by more than threshold.
+    '''
+    before = {(r["patients"], r["step"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\ncompared with {baseline['commit']} ({baseline['created']}):")
+    print(f"{'patients':>9} {'step':<16} {'throughput':>11} {'p99':>8} {'peak':>8}")
+    for r in run["results"]:
+        b = before.get((r["patients"], r["step"]))
+        if b is None:
+            continue
+        changes, regressed = {}, False
+        for metric, worse in (("throughput", -1), ("p99_ms", 1), ("peak_mb", 1)):
+            changes[metric] = (r[metric] - b[metric]) / b[metric] if b[metric] else 0.0
+            if metric == "p99_ms" and abs(r[metric] - b[metric]) < MIN_LATENCY_CHANGE_MS:
+                continue
+            if changes[metric] * worse > threshold:
+                regressed = True
+                regressions.append(f"{r['step']} at {r['patients']} patients: {metric} {b[metric]} -> {r[metric]}")
+        print(f"{r['patients']:>9} {r['step']:<16} {changes['throughput']:>+11.1%} {changes['p99_ms']:>+8.1%} "
+              f"{changes['peak_mb']:>+8.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", default="1000", help="comma separated numbers of patients on the stub server")
+    parser.add_argument("--steps", default=",".join(STEPS), help=f"comma separated steps, of {', '.join(STEPS)}")
+    parser.add_argument("--fhir-latency", type=float, default=0.01, help="stub FHIR latency per request in seconds")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="mock completion latency in seconds")
+    parser.add_argument("--criteria-calls", type=int, default=20, help="completions of the define_criteria step")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each step, of which the median is kept")
+    parser.add_argument("--results-dir", default=RESULTS_DIR, help="where the results are saved")
+    parser.add_argument("--compare", default="latest", help="results file to compare with, 'latest' or 'none'")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="relative change that is a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 if anything regressed")
+    parser.add_argument("--no-save", action="store_true", help="don't save the results")
+    # Used by the suite to run one step in a child process
+    parser.add_argument("--run-step", choices=sorted(STEP_FUNCTIONS), help=argparse.SUPPRESS)
+    parser.add_argument("--fhir-url", help=argparse.SUPPRESS)
+    parser.add_argument("--llm-url", help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_step:
+        start = time.perf_counter()
+        result = STEP_FUNCTIONS[args.run_step](args)
+        result["seconds"] = time.perf_counter() - start
+        with open(args.result, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return
+
+    from benchmarks.mock_openai_server import MockOpenAIServer
+
+    scales = [int(n) for n in args.patients.split(",")]
+    steps = [s for s in STEPS if s in args.steps.split(",")]
+    # write_emails and save_emails read the cohort that find_patients writes
+    if {"write_emails", "save_emails"} & set(steps) and "find_patients" not in steps:
+        steps.insert(0, "find_patients")
+    options = {"steps": steps, "fhir_latency": args.fhir_latency, "llm_latency": args.llm_latency,
+               "criteria_calls": args.criteria_calls, "repeat": args.repeat}
+    run = {"commit": git_commit(), "created": datetime.datetime.now().isoformat(timespec="seconds"),
+           "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+           "options": options, "results": []}
+
+    print(f"{'patients':>9} {'step':<16} {'items':>8} {'seconds':>8} {'items/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'peak MB':>8}")
+    with MockOpenAIServer(latency=args.llm_latency, json_reply=json.dumps(CRITERIA)) as llm:
+        for n in scales:
+            start = time.perf_counter()
+            with stub_fhir_process(n, args.fhir_latency) as fhir_url, tempfile.TemporaryDirectory() as work_dir:
+                print(f"{n:>9} {'(seed stub)':<16} {n:>8} {time.perf_counter() - start:>8.2f}")
+                for step in steps:
+                    # The run with the median time, so one slow or lucky run doesn't look like a change
+                    runs = sorted((run_step(step, args, fhir_url, llm.base_url, work_dir) for _ in range(args.repeat)),
+                                  key=lambda r: r["seconds"])
+                    result = {"patients": n, **runs[len(runs) // 2]}
+                    run["results"].append(result)
+                    print(f"{n:>9} {step:<16} {result['items']:>8} {result['seconds']:>8.2f} {result['throughput']:>9.1f} "
+                          f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['peak_mb']:>8.1f}")
+
+    saved = None if args.no_save else save_results(run, args.results_dir)
+    if saved:
+        print(f"\nSaved the results to {saved}")
+    baseline_path = {"latest": lambda: latest_results(args.results_dir, options, exclude=saved),
+                     "none": lambda: None}.get(args.compare, lambda: args.compare)()
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            regressions = compare(run, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
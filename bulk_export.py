@@ -0,0 +1,188 @@
+import time
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Union
+
+import fhir_client
+from cohort_search import birthdate_window, condition_matcher, patient_details
+from fhir_client import FhirClient, loads
+
+# Seconds between status checks when the server doesn't send Retry-After
+DEFAULT_POLL_INTERVAL = 2.0
+# Seconds to wait for an export to complete before giving up
+DEFAULT_EXPORT_TIMEOUT = 3600
+# Bytes read from an export file at a time
+CHUNK_SIZE = 1 << 16
+# Resource types exported for cohort searches
+COHORT_TYPES = ("Patient", "Condition")
+
+
+class BulkExportError(Exception):
+    '''
+    Raised when the server refuses an export, the export fails or it doesn't finish in time.
+    '''
+
+
+class ExportManifest(NamedTuple):
+    '''
+    The completed export's manifest: the server time the export reflects, the kick-off URL and
+    the output (and error) files, each a dict with "type", "url" and usually "count".
+    '''
+    transaction_time: str
+    request: str
+    output: List[Dict]
+    error: List[Dict]
+
+    def urls(self, resource_type: str) -> List[str]:
+        return [file['url'] for file in self.output if file.get('type') == resource_type]
+
+
+def _describe(r) -> str:
+    # The diagnostics of an OperationOutcome, or the status line
+    try:
+        issues = r.json().get('issue', [])
+    except ValueError:
+        issues = []
+    details = "; ".join(i.get('diagnostics') or i.get('code', '') for i in issues)
+    return f"{r.status_code} {r.reason}" + (f": {details}" if details else "")
+
+
+def start_export(client: FhirClient, types: Iterable[str] = COHORT_TYPES, since: Optional[str] = None,
+                 level: str = "Patient") -> str:
+    '''
+    Kicks off a Bulk Data export and returns the URL of its status endpoint.
+
+    Parameters:
+    types (Iterable[str]): The resource types to export (_type).
+    since (str): Only export resources changed since this instant (_since).
+    level (str): "Patient" exports every patient's compartment ([base]/Patient/$export),
+    "system" everything on the server ([base]/$export).
+    '''
+    params = {'_type': ",".join(types)}
+    if since:
+        params['_since'] = since
+    url = "$export" if level == "system" else f"{level}/$export"
+    r = client.request("GET", url, params=params, headers={"Accept": "application/fhir+json", "Prefer": "respond-async"})
+    if r.status_code != 202 or 'Content-Location' not in r.headers:
+        raise BulkExportError(f"Export was not started: {_describe(r)}")
+    return r.headers['Content-Location']
+
+
+def wait_for_export(client: FhirClient, status_url: str, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                    timeout: float = DEFAULT_EXPORT_TIMEOUT,
+                    on_progress: Optional[Callable[[str], None]] = None) -> ExportManifest:
+    '''
+    Polls the status endpoint of an export until the manifest is ready, waiting as long as the
+    server's Retry-After asks (or poll_interval). X-Progress is passed to on_progress.
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        r = client.request("GET", status_url)
+        if r.status_code == 200:
+            manifest = r.json()
+            return ExportManifest(manifest.get('transactionTime', ''), manifest.get('request', ''),
+                                  manifest.get('output', []), manifest.get('error', []))
+        if r.status_code != 202:
+            raise BulkExportError(f"Export failed: {_describe(r)}")
+        if on_progress and 'X-Progress' in r.headers:
+            on_progress(r.headers['X-Progress'])
+        retry_after = r.headers.get('Retry-After', '')
+        wait = float(retry_after) if retry_after.isdigit() else poll_interval
+        if time.monotonic() + wait > deadline:
+            client.request("DELETE", status_url)
+            raise BulkExportError(f"Export did not finish within {timeout} seconds")
+        time.sleep(wait)
+
+
+def iter_ndjson(client: FhirClient, url: str) -> Iterator[Dict]:
+    '''
+    Downloads an NDJSON export file and yields its resources one line at a time, so memory use
+    doesn't grow with the file. The file may be gzipped in transit (Content-Encoding) or stored
+    gzipped (a .gz blob).
+    '''
+    r = client.request("GET", url, stream=True, headers={"Accept": "application/fhir+ndjson"})
+    try:
+        if not r.ok:
+            raise BulkExportError(f"Export file {url} could not be read: {_describe(r)}")
+        gunzip = None
+        pending = b""
+        for chunk in r.iter_content(CHUNK_SIZE):
+            if gunzip is None:
+                # gzip files start with 1f 8b; the chunks of a Content-Encoding: gzip body are already decoded
+                gunzip = zlib.decompressobj(wbits=31) if chunk[:2] == b"\x1f\x8b" else False
+            if gunzip:
+                chunk = gunzip.decompress(chunk)
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield loads(line)
+        if gunzip:
+            pending += gunzip.flush()
+        if pending.strip():
+            yield loads(pending)
+    finally:
+        r.close()
+
+
+def iter_export(client: FhirClient, manifest: ExportManifest, types: Iterable[str] = COHORT_TYPES) -> Iterator[Dict]:
+    '''
+    Yields the resources of the given types from an export's files, type by type.
+    '''
+    for resource_type in types:
+        for url in manifest.urls(resource_type):
+            yield from iter_ndjson(client, url)
+
+
+def export(client: Optional[FhirClient] = None, types: Iterable[str] = COHORT_TYPES, since: Optional[str] = None,
+           poll_interval: float = DEFAULT_POLL_INTERVAL, timeout: float = DEFAULT_EXPORT_TIMEOUT) -> ExportManifest:
+    '''
+    Runs a patient-level export of the types and returns its manifest once it is complete.
+
+    Example usage:
+    >>> manifest = export(since="2024-01-01T00:00:00Z")
+    >>> for resource in iter_export(fhir_client.client, manifest):
+    ...     print(resource['resourceType'], resource['id'])
+    '''
+    client = client or fhir_client.client
+    types = list(types)
+    return wait_for_export(client, start_export(client, types, since), poll_interval, timeout)
+
+
+def iter_export_patients(min_age: int, max_age: int, condition: Union[str, Iterable[str]],
+                         default_email: Optional[str] = None, client: Optional[FhirClient] = None,
+                         manifest: Optional[ExportManifest] = None) -> Iterator[Dict[str, Union[str, int, None]]]:
+    '''
+    Finds the patients between the ages with the condition in a Bulk Data export instead of
+    paging through Condition searches, and yields them in the layout of
+    get_patients_between_ages_and_condition.
+
+    The Condition files are read first, keeping only the first matching condition of each
+    patient, then the Patient files, so only the cohort is held in memory however big the
+    export is. A new export is run unless the manifest of a completed one is given.
+
+    Parameters:
+    min_age (int): The minimum age to filter patients by.
+    max_age (int): The maximum age to filter patients by.
+    condition (str): Only patients with a condition whose name contains this text are returned.
+    A list of conditions returns the patients with any of them.
+    default_email (str): The email address to use for patients who don't have one.
+    client (FhirClient): The FHIR client to export with. Defaults to the shared fhir_client.client.
+    manifest (ExportManifest): A completed export with Patient and Condition files.
+    '''
+    client = client or fhir_client.client
+    manifest = manifest or export(client)
+    matches = condition_matcher([condition] if isinstance(condition, str) else condition)
+    min_birthdate, max_birthdate = birthdate_window(min_age, max_age)
+
+    matched: Dict[str, Dict] = {}
+    for resource in iter_export(client, manifest, ["Condition"]):
+        if 'subject' in resource and matches(resource):
+            matched.setdefault(resource['subject']['reference'].split('/')[-1], {'code': resource['code']})
+    if not matched:
+        return
+
+    for patient in iter_export(client, manifest, ["Patient"]):
+        if patient.get('id') in matched and min_birthdate < patient.get('birthDate', '') <= max_birthdate:
+            details = patient_details(client, patient['id'], patient, matched[patient['id']], default_email)
+            if details:
+                yield details
@@ -0,0 +1,337 @@
+"""
+Runs a batch of screening campaigns, e.g. every night, from a file with one proposal per line:
+
+    python campaign_runner.py proposals.txt --output-dir campaigns
+
+Each campaign's criteria are defined (see cohort_criteria), the FHIR searches of all the campaigns
+are merged so that every condition is searched once for each set of overlapping age ranges the
+campaigns ask for, and the emails of each campaign are then written to <output-dir>/<campaign>.csv. A
+summary of every campaign (wall time, FHIR requests, LLM calls and tokens) is written to
+<output-dir>/summary.csv. With --incremental each cohort is refreshed from the checkpoint of
+the previous run and only the patients who joined it are emailed.
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from cohort_criteria import CohortCriteria, CriteriaStore, define_criteria, normalize_proposal
+from cohort_refresh import refresh_cohort, COHORT_CHECKPOINT_DIR
+from cohort_search import iter_patients_between_ages_and_condition
+from fhir_cache import FhirCache
+import fhir_client
+from fhir_client import FhirClient, FHIR_BASE_URL, DEFAULT_MAX_IN_FLIGHT
+from llm_cache import CachedOpenAI, llm_usage
+from outreach_emails import GenerationStats, DEFAULT_MAX_CONCURRENCY, EMAIL_BASE_URL, MODEL_DI
+from outreach_pipeline import run_outreach_pipeline
+from outreach_sinks import open_sink
+from patient_record import DEFAULT_EMAIL
+
+# Default number of campaigns that define criteria or write emails at the same time
+DEFAULT_MAX_CAMPAIGNS = 4
+# Default number of merged FHIR searches that run at the same time
+DEFAULT_MAX_SEARCHES = 4
+# Columns of summary.csv, in order
+SUMMARY_COLUMNS = ["campaign", "proposal", "criteria", "criteria_source", "patients", "removed", "emails", "failed",
+                   "fhir_requests", "shared_searches", "llm_calls", "prompt_tokens", "completion_tokens",
+                   "seconds", "error"]
+
+
+class Campaign:
+    '''
+    One campaign of a batch run and what it cost. patients are the patients emails were written
+    for (the new members on an incremental run, where removed counts the ones who left).
+    fhir_requests is the campaign's share of the requests of the searches it used, split evenly
+    between the campaigns that shared each one, and seconds is the time spent on the campaign:
+    defining its criteria, the searches or refresh it used (shared searches in full) and writing
+    its emails.
+    '''
+
+    def __init__(self, name: str, proposal: str):
+        self.name = name
+        self.proposal = proposal
+        self.criteria: Optional[CohortCriteria] = None
+        self.criteria_source: Optional[str] = None
+        self.patients = 0
+        self.removed = 0
+        self.fhir_requests = 0.0
+        self.shared_searches = 0
+        self.stats = GenerationStats()
+        self.seconds = 0.0
+        self.error: Optional[str] = None
+
+    def summary(self) -> Dict:
+        return {
+            "campaign": self.name,
+            "proposal": self.proposal,
+            "criteria": str(self.criteria) if self.criteria else "",
+            "criteria_source": self.criteria_source,
+            "patients": self.patients,
+            "removed": self.removed,
+            "emails": self.stats.emails,
+            "failed": self.stats.failed,
+            "fhir_requests": round(self.fhir_requests, 1),
+            "shared_searches": self.shared_searches,
+            "llm_calls": self.stats.llm_calls,
+            "prompt_tokens": self.stats.prompt_tokens,
+            "completion_tokens": self.stats.completion_tokens,
+            "seconds": round(self.seconds, 2),
+            "error": self.error or "",
+        }
+
+
+class MergedSearch:
+    '''
+    One FHIR search for a condition, shared by every campaign that targets it, over the union of
+    their age ranges. Each campaign then keeps the patients within its own range.
+    '''
+
+    def __init__(self, condition: str, min_age: int, max_age: int):
+        self.condition = condition
+        self.min_age = min_age
+        self.max_age = max_age
+        self.campaigns: List[Campaign] = []
+        self.patients: List[Dict] = []
+        self.requests = 0
+        self.seconds = 0.0
+
+    def widen(self, min_age: int, max_age: int) -> None:
+        self.min_age = min(self.min_age, min_age)
+        self.max_age = max(self.max_age, max_age)
+
+
+def read_proposals(path: str) -> List[str]:
+    '''
+    Reads one proposal per line, skipping blank lines and lines that start with #.
+    '''
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def campaign_names(proposals: Iterable[str]) -> List[str]:
+    # File-name friendly names, e.g. "find-patients-for-colonoscopy-screening", unique in the batch
+    names = []
+    for proposal in proposals:
+        stem = "-".join(normalize_proposal(proposal).split())[:60].strip("-") or "campaign"
+        name, n = stem, 1
+        while name in names:
+            n += 1
+            name = f"{stem}-{n}"
+        names.append(name)
+    return names
+
+
+def merge_searches(campaigns: Iterable[Campaign]) -> List[MergedSearch]:
+    '''
+    Groups the searches of the campaigns by condition (ignoring case) and age range. Campaigns
+    whose age ranges for a condition overlap or touch share one search over their union; ranges
+    that don't are searched separately, so no search fetches patients no campaign asked for.
+    '''
+    by_condition: Dict[str, List] = {}
+    for campaign in campaigns:
+        if campaign.criteria is None:
+            continue
+        for condition in campaign.criteria.conditions:
+            by_condition.setdefault(" ".join(condition.lower().split()), []).append((campaign, condition))
+
+    searches: List[MergedSearch] = []
+    for wanted in by_condition.values():
+        search = None
+        for campaign, condition in sorted(wanted, key=lambda item: item[0].criteria.min_age):
+            criteria = campaign.criteria
+            if search is None or criteria.min_age > search.max_age + 1:
+                search = MergedSearch(condition, criteria.min_age, criteria.max_age)
+                searches.append(search)
+            search.widen(criteria.min_age, criteria.max_age)
+            if campaign not in search.campaigns:
+                search.campaigns.append(campaign)
+    return searches
+
+
+def campaign_patients(campaign: Campaign, searches: Iterable[MergedSearch]) -> Iterator[Dict]:
+    # The campaign's patients from the merged searches it takes part in, each patient once
+    seen = set()
+    for search in searches:
+        for patient in search.patients:
+            if (campaign.criteria.min_age <= patient['age'] <= campaign.criteria.max_age
+                    and patient['patient_url'] not in seen):
+                seen.add(patient['patient_url'])
+                yield patient
+
+
+def write_summary(campaigns: Iterable[Campaign], path: str) -> None:
+    with open(path + ".partial", "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        for campaign in campaigns:
+            writer.writerow(campaign.summary())
+    os.replace(path + ".partial", path)
+
+
+def run_campaigns(proposals: Iterable[str], openai_client, criteria_client=None, fhir_base_url: str = FHIR_BASE_URL,
+                  cache: Optional[FhirCache] = None, output_dir: str = ".", output_format: str = "csv",
+                  criteria_model: str = "gpt-4", email_model: str = MODEL_DI,
+                  store: Optional[CriteriaStore] = None, default_email: Optional[str] = None,
+                  max_campaigns: int = DEFAULT_MAX_CAMPAIGNS, max_searches: int = DEFAULT_MAX_SEARCHES,
+                  max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                  templated: bool = False, incremental: bool = False,
+                  checkpoint_dir: str = COHORT_CHECKPOINT_DIR) -> List[Campaign]:
+    '''
+    Runs a batch of campaigns, sharing the FHIR work between them.
+
+    The criteria of every proposal are defined first, up to max_campaigns at a time. The
+    campaigns' searches are then merged by condition and age range (see merge_searches) and each
+    merged search runs once, up to max_searches at a time. They share one Patient cache, so a
+    patient that turns up in several searches is only fetched once (the on-disk cache of
+    fhir_client.client is used if `cache` is None, or an in-memory one if that is turned off).
+    Finally each campaign's emails are written through run_outreach_pipeline to
+    <output_dir>/<campaign name>.<output_format>, up to max_campaigns campaigns at a time.
+
+    With incremental=True each campaign's cohort is refreshed from its checkpoint in
+    checkpoint_dir instead (see cohort_refresh.refresh_cohort) and emails are only written for
+    the patients who joined it since the last run. The searches aren't merged then, as each
+    refresh only asks for what changed.
+
+    A campaign that fails is recorded in its error and doesn't stop the others.
+
+    Parameters:
+    proposals (Iterable[str]): The proposal of each campaign, e.g. "Find patients for colonoscopy screening".
+    openai_client: The client that writes the emails.
+    criteria_client: The client that defines the criteria of new proposals (see define_criteria).
+    fhir_base_url (str): The FHIR server to search.
+    cache (FhirCache): The Patient cache shared by the searches. Defaults to fhir_client.client's.
+    store (CriteriaStore): Where the criteria of known proposals are kept.
+    The other parameters are passed on to the search and to run_outreach_pipeline.
+
+    Returns:
+    The Campaigns, in the order of the proposals.
+    '''
+    proposals = list(proposals)
+    campaigns = [Campaign(name, proposal) for name, proposal in zip(campaign_names(proposals), proposals)]
+    if cache is None:
+        cache = fhir_client.client.cache if fhir_client.client.cache is not None else FhirCache(":memory:")
+    os.makedirs(output_dir, exist_ok=True)
+
+    def define(campaign: Campaign) -> None:
+        start = time.perf_counter()
+        try:
+            campaign.criteria, campaign.criteria_source = define_criteria(
+                campaign.proposal, criteria_client, criteria_model, store, stats=campaign.stats)
+            if campaign.criteria is None:
+                campaign.error = "Could not define the cohort criteria"
+        except Exception as e:
+            campaign.error = f"{type(e).__name__}: {e}"
+        campaign.seconds += time.perf_counter() - start
+
+    def search(merged: MergedSearch) -> None:
+        # A client of its own (on the shared cache) so its requests can be counted
+        client = FhirClient(fhir_base_url, cache=cache)
+        search_start = time.perf_counter()
+        try:
+            merged.patients = list(iter_patients_between_ages_and_condition(
+                merged.min_age, merged.max_age, merged.condition, default_email=default_email,
+                max_in_flight=max_in_flight, client=client))
+        except Exception as e:
+            for campaign in merged.campaigns:
+                campaign.error = campaign.error or f"Search for {merged.condition} failed: {type(e).__name__}: {e}"
+        merged.requests = client.request_count
+        merged.seconds = time.perf_counter() - search_start
+
+    def refresh(campaign: Campaign) -> List[Dict]:
+        if campaign.criteria is None or campaign.error:
+            return []
+        client = FhirClient(fhir_base_url, cache=cache)
+        start = time.perf_counter()
+        try:
+            result = refresh_cohort(campaign.name, campaign.criteria, default_email=default_email, client=client,
+                                    checkpoint_dir=checkpoint_dir, max_in_flight=max_in_flight)
+        except Exception as e:
+            campaign.error = f"Refresh failed: {type(e).__name__}: {e}"
+            return []
+        finally:
+            campaign.seconds += time.perf_counter() - start
+        campaign.fhir_requests = result.requests
+        campaign.removed = len(result.removed)
+        return result.added
+
+    def write(campaign: Campaign, patients: Iterable[Dict]) -> None:
+        start = time.perf_counter()
+        if campaign.criteria is not None and not campaign.error:
+            extension = "" if output_format == "text" else f".{output_format}"
+            try:
+                with open_sink(os.path.join(output_dir, campaign.name + extension), output_format) as sink:
+                    pipeline_stats = run_outreach_pipeline(openai_client, patients, campaign.proposal, sink.write,
+                                                           model=email_model, max_concurrency=max_concurrency,
+                                                           templated=templated, stats=campaign.stats)
+                campaign.patients = pipeline_stats["search"].items
+            except Exception as e:
+                campaign.error = f"{type(e).__name__}: {e}"
+        campaign.seconds += time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, max_campaigns)) as pool:
+        list(pool.map(define, campaigns))
+
+    if incremental:
+        with ThreadPoolExecutor(max_workers=max(1, max_searches)) as pool:
+            patients = list(pool.map(refresh, campaigns))
+    else:
+        searches = merge_searches(campaigns)
+        with ThreadPoolExecutor(max_workers=max(1, max_searches)) as pool:
+            list(pool.map(search, searches))
+        patients = []
+        for campaign in campaigns:
+            used = [merged for merged in searches if campaign in merged.campaigns]
+            campaign.fhir_requests = sum(merged.requests / len(merged.campaigns) for merged in used)
+            campaign.shared_searches = sum(1 for merged in used if len(merged.campaigns) > 1)
+            campaign.seconds += sum(merged.seconds for merged in used)
+            patients.append(campaign_patients(campaign, used) if campaign.criteria is not None else [])
+
+    with ThreadPoolExecutor(max_workers=max(1, max_campaigns)) as pool:
+        list(pool.map(write, campaigns, patients))
+
+    write_summary(campaigns, os.path.join(output_dir, "summary.csv"))
+    return campaigns
+
+
+def main() -> None:
+    from autogen import config_list_from_json
+    from openai import OpenAI
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("proposals", help="file with one proposal per line")
+    parser.add_argument("--output-dir", default="campaigns", help="where the emails and summary.csv are written")
+    parser.add_argument("--format", default="csv", choices=["csv", "jsonl", "text"], help="output format of the emails")
+    parser.add_argument("--max-campaigns", type=int, default=DEFAULT_MAX_CAMPAIGNS, help="campaigns run at the same time")
+    parser.add_argument("--max-searches", type=int, default=DEFAULT_MAX_SEARCHES, help="FHIR searches run at the same time")
+    parser.add_argument("--templated", action="store_true", help="write one email per condition and fill in the names")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only write emails for patients who joined each cohort since the last run")
+    args = parser.parse_args()
+
+    gpt4 = config_list_from_json("OAI_CONFIG_LIST", filter_dict={"model": ["gpt-4"]})[0]
+    # Completions go through the shared cache, so re-running a batch doesn't pay for them again
+    criteria_client = CachedOpenAI(OpenAI(api_key=gpt4.get("api_key"), base_url=gpt4.get("base_url")),
+                                   step="define_criteria")
+    openai_client = CachedOpenAI(OpenAI(api_key=os.getenv("OPENAI_API_KEY"),
+                                        base_url=EMAIL_BASE_URL), step="outreach_emails")
+
+    campaigns = run_campaigns(read_proposals(args.proposals), openai_client, criteria_client,
+                              output_dir=args.output_dir, output_format=args.format, criteria_model=gpt4["model"],
+                              store=CriteriaStore(), default_email=DEFAULT_EMAIL,
+                              max_campaigns=args.max_campaigns, max_searches=args.max_searches,
+                              templated=args.templated, incremental=args.incremental)
+    for campaign in campaigns:
+        summary = campaign.summary()
+        print(f"{summary['campaign']}: {summary['emails']} emails, {summary['fhir_requests']} FHIR requests, "
+              f"{summary['llm_calls']} LLM calls, {summary['prompt_tokens'] + summary['completion_tokens']} tokens, "
+              f"{summary['seconds']}s" + (f" ({summary['error']})" if summary['error'] else ""))
+    print(llm_usage.report())
+
+
+if __name__ == "__main__":
+    main()
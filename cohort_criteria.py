@@ -0,0 +1,206 @@
+import json
+import os
+import re
+import threading
+from typing import Dict, NamedTuple, Optional, Tuple
+
+# Where the criteria of proposals seen before are kept; an empty string keeps them in memory only
+COHORT_CRITERIA_PATH = os.getenv("COHORT_CRITERIA_PATH", ".cohort_criteria.json")
+# Oldest age accepted in criteria
+MAX_AGE = 150
+
+CRITERIA_SYSTEM_PROMPT = """
+Epidemiologist. You are an expert in the healthcare system. You define the criteria to target patients
+for outreach. The criteria must be min age, max age and any previous conditions. The conditions must be
+in the format of snowmed display names e.g. Osteoporsis (Disorder), Acute bronchitis, Hyperglycemia.
+
+Reply with only a JSON object with the keys "min_age" (number), "max_age" (number) and "conditions"
+(a list of condition display names), e.g. {"min_age": 50, "max_age": 70, "conditions": ["Osteoporosis"]}
+"""
+
+# "aged 50 to 70", "between 50 and 70", "aged between 50-70", "from 50 to 70"
+_AGE_RANGE = re.compile(r"\b(?:aged?|between|from)\s+(?:between\s+)?(\d{1,3})\s*(?:-|–|to|and)\s*(\d{1,3})\b", re.I)
+# "with Osteoporosis", "with Hyperglycemia or Prediabetes" up to the end of the sentence
+_CONDITIONS = re.compile(r"\bwith\s+(?:a\s+history\s+of\s+|previous\s+|prior\s+)?(.+?)\s*(?:\.|;|\bTERMINATE\b|$)", re.I)
+_CONDITION_SEPARATORS = re.compile(r"\s*(?:,|\bor\b|/)\s*", re.I)
+# "with no history of diabetes", "without diabetes", "never had", "but not": criteria that exclude
+# patients, which the sentence form can't express
+_NEGATION = re.compile(r"\b(?:no|not|without|never|excluding|except)\b", re.I)
+# "Male patients", "women", "smokers": demographic filters that CohortCriteria has no field for
+_DEMOGRAPHICS = re.compile(r"\b(?:male|female|men|women|man|woman|boys?|girls?|sex|gender|pregnant|smok\w*|"
+                           r"ethnicity|race|residents?|living)\b", re.I)
+# Qualifiers of the conditions: "diabetes and hypertension" (both, not either), "diabetes taking
+# metformin", "diabetes who smoke", "diabetes since 2020"
+_CONDITION_QUALIFIERS = re.compile(r"\b(?:and|on|taking|takes|take|prescribed|using|treated|medications?|drugs?|"
+                                   r"therapy|who|whose|that|which|since|after|before|within|during)\b", re.I)
+# The keys of the JSON form; any other key ("sex", "medications") is a criterion it can't hold
+_CRITERIA_KEYS = {"min_age", "max_age", "conditions", "condition"}
+
+
+class CohortCriteria(NamedTuple):
+    '''
+    The patients a campaign targets: everyone aged min_age to max_age (inclusive) with any of
+    the conditions, as free-text or SNOMED display names.
+    '''
+    min_age: int
+    max_age: int
+    conditions: Tuple[str, ...]
+
+    def __str__(self) -> str:
+        return f"Patients aged between {self.min_age} and {self.max_age} with {' or '.join(self.conditions)}."
+
+    def to_dict(self) -> Dict:
+        return {"min_age": self.min_age, "max_age": self.max_age, "conditions": list(self.conditions)}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> Optional["CohortCriteria"]:
+        '''
+        Builds the criteria from their JSON form, or returns None if they are missing or don't
+        make sense. A single "condition" is accepted in place of "conditions".
+        '''
+        try:
+            conditions = data.get("conditions", data.get("condition"))
+            if isinstance(conditions, str):
+                conditions = [conditions]
+            conditions = tuple(c.strip() for c in conditions if isinstance(c, str) and c.strip())
+            min_age, max_age = int(data["min_age"]), int(data["max_age"])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+        if not conditions or not 0 <= min_age <= max_age <= MAX_AGE:
+            return None
+        return cls(min_age, max_age, conditions)
+
+    @classmethod
+    def from_json(cls, text: str) -> Optional["CohortCriteria"]:
+        try:
+            return cls.from_dict(json.loads(text))
+        except (TypeError, ValueError):
+            return None
+
+
+def normalize_proposal(proposal: str) -> str:
+    '''
+    The key a proposal is memoized under: lower case, with punctuation and repeated spaces
+    removed, so "Find patients for colonoscopy screening." and "find patients for
+    colonoscopy  screening" share their criteria.
+    '''
+    return " ".join(re.sub(r"[^\w]+", " ", proposal.lower()).split())
+
+
+def parse_criteria(text: str) -> Optional[CohortCriteria]:
+    '''
+    Reads criteria written out in the text itself, as JSON or as a sentence in the form the
+    epidemiologist uses, e.g. "Patients aged 50 to 70 with Osteoporsis. TERMINATE". Returns None
+    if the text doesn't spell out both an age range and at least one condition, or if it says
+    anything else the criteria can't hold, so that it is left to the model rather than read as
+    the wrong cohort: negations ("with no history of diabetes"), sex or other demographics,
+    medications and other qualifiers of the conditions, conditions joined by "and", or JSON
+    keys other than the ages and conditions.
+    '''
+    text = text.strip()
+    if text.startswith("{"):
+        criteria = CohortCriteria.from_json(text)
+        return criteria if criteria and set(json.loads(text)) <= _CRITERIA_KEYS else None
+    if _NEGATION.search(text) or _DEMOGRAPHICS.search(text):
+        return None
+    ages, conditions = _AGE_RANGE.search(text), _CONDITIONS.search(text)
+    if not ages or not conditions or _CONDITION_QUALIFIERS.search(conditions.group(1)):
+        return None
+    names = [name for name in _CONDITION_SEPARATORS.split(conditions.group(1)) if name]
+    return CohortCriteria.from_dict({"min_age": ages.group(1), "max_age": ages.group(2), "conditions": names})
+
+
+def states_criteria(text: str) -> bool:
+    '''
+    Whether the text spells out criteria, as JSON or as an age range and conditions, whether or
+    not parse_criteria can read them. Text that does, but that parse_criteria returns None for,
+    carries criteria the parser doesn't handle (a negation, a medication, the patients' sex).
+    '''
+    text = text.strip()
+    if text.startswith("{"):
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return False
+        return isinstance(data, dict) and ("min_age" in data or "max_age" in data)
+    return bool(_AGE_RANGE.search(text) and _CONDITIONS.search(text))
+
+
+class CriteriaStore:
+    '''
+    Remembers the criteria defined for each proposal, keyed by normalize_proposal, in a JSON
+    file at `path` (or only in memory if path is empty). The file is rewritten atomically
+    whenever criteria are added.
+    '''
+
+    def __init__(self, path: str = COHORT_CRITERIA_PATH):
+        self.path = path
+        self._criteria: Dict[str, CohortCriteria] = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for key, data in json.load(f).items():
+                    criteria = CohortCriteria.from_dict(data)
+                    if criteria:
+                        self._criteria[key] = criteria
+
+    def get(self, proposal: str) -> Optional[CohortCriteria]:
+        return self._criteria.get(normalize_proposal(proposal))
+
+    def put(self, proposal: str, criteria: CohortCriteria) -> None:
+        with self._lock:
+            self._criteria[normalize_proposal(proposal)] = criteria
+            if self.path:
+                with open(self.path + ".partial", "w", encoding="utf-8") as f:
+                    json.dump({key: c.to_dict() for key, c in self._criteria.items()}, f, indent=1)
+                os.replace(self.path + ".partial", self.path)
+
+    def __len__(self) -> int:
+        return len(self._criteria)
+
+
+def request_criteria(openai_client, proposal: str, model: str, stats=None) -> Optional[CohortCriteria]:
+    '''
+    Asks the model for the criteria of a proposal in one structured (JSON mode) completion.
+    Returns None if the request fails or the reply isn't valid criteria. The call and its
+    tokens are counted in stats (an outreach_emails.GenerationStats) if it is given.
+    '''
+    if stats:
+        stats.add(llm_calls=1)
+    try:
+        completion = openai_client.chat.completions.create(
+            model=model,
+            messages=[{"role": "system", "content": CRITERIA_SYSTEM_PROMPT},
+                      {"role": "user", "content": proposal}],
+            response_format={"type": "json_object"},
+            temperature=0,
+        )
+    except Exception:
+        return None
+    if stats:
+        stats.add_usage(completion)
+    return CohortCriteria.from_json(completion.choices[0].message.content or "")
+
+
+def define_criteria(proposal: str, openai_client=None, model: str = "gpt-4",
+                    store: Optional[CriteriaStore] = None, stats=None) -> Tuple[Optional[CohortCriteria], str]:
+    '''
+    Defines the cohort criteria of a proposal by the cheapest route that works: the criteria
+    stored for the same proposal before, then criteria spelled out in the proposal itself, then
+    one structured completion. New criteria are added to the store.
+
+    Returns:
+    The criteria, or None if none of the routes worked, and the route taken: "store", "parsed",
+    "llm" or "none". The completion, if one is made, is counted in stats.
+    '''
+    criteria = store.get(proposal) if store is not None else None
+    if criteria:
+        return criteria, "store"
+    criteria, source = parse_criteria(proposal), "parsed"
+    if criteria is None and openai_client is not None:
+        criteria, source = request_criteria(openai_client, proposal, model, stats), "llm"
+    if criteria is None:
+        return None, "none"
+    if store is not None:
+        store.put(proposal, criteria)
+    return criteria, source
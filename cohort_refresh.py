@@ -0,0 +1,261 @@
+import datetime
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import fhir_client
+from cohort_criteria import CohortCriteria
+from cohort_search import (birthdate_window, condition_matcher, iter_condition_matches, patient_details)
+from condition_codes import condition_search_params
+from fhir_client import FhirClient, DEFAULT_MAX_IN_FLIGHT, DEFAULT_PAGE_SIZE
+
+# Where the checkpoint of each campaign is kept
+COHORT_CHECKPOINT_DIR = os.getenv("COHORT_CHECKPOINT_DIR", ".cohort_checkpoints")
+# Number of patients whose conditions are rechecked with one search (subject=Patient/1,Patient/2,...)
+RECHECK_BATCH_SIZE = 50
+# Seconds our clock may be ahead of the server's, taken off the time a refresh started when the
+# server doesn't report its own
+CLOCK_SKEW_MARGIN = int(os.getenv("CLOCK_SKEW_MARGIN", "300"))
+
+
+def parse_instant(value: str) -> datetime.datetime:
+    instant = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return instant if instant.tzinfo else instant.replace(tzinfo=datetime.timezone.utc)
+
+
+class CohortCheckpoint:
+    '''
+    What a campaign's cohort looked like after its last refresh: the criteria and the birthdate
+    window it was computed for, the server's time when that refresh started (the _lastUpdated
+    to search from next time) and the members, as patient dictionaries keyed by patient id.
+    '''
+
+    def __init__(self, criteria: CohortCriteria, window: Tuple[str, str], last_updated: Optional[str] = None,
+                 members: Optional[Dict[str, Dict]] = None):
+        self.criteria = criteria
+        self.window = window
+        self.last_updated = last_updated
+        self.members: Dict[str, Dict] = members or {}
+
+    def to_dict(self) -> Dict:
+        return {"criteria": self.criteria.to_dict(), "window": list(self.window),
+                "last_updated": self.last_updated, "members": self.members}
+
+    @classmethod
+    def load(cls, path: str) -> Optional["CohortCheckpoint"]:
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        criteria = CohortCriteria.from_dict(data["criteria"])
+        return cls(criteria, tuple(data["window"]), data.get("last_updated"), data["members"]) if criteria else None
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".partial", "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(path + ".partial", path)
+
+
+class RefreshResult(NamedTuple):
+    '''
+    The outcome of refresh_cohort. added are the patients who joined the cohort (everyone on a
+    full refresh), removed the ones who left it and updated the members whose details changed.
+    '''
+    added: List[Dict]
+    removed: List[Dict]
+    updated: List[Dict]
+    members: int
+    full: bool
+    requests: int
+
+
+class _ServerClock:
+    # Tracks the server's time when the refresh started: the earliest meta.lastUpdated of the
+    # search Bundles (the time each search ran). Using the server's clock keeps the checkpoint
+    # right whatever ours says. A server that doesn't report it keeps the previous checkpoint, or
+    # on a full refresh gets our own start time less CLOCK_SKEW_MARGIN: the resources' own
+    # lastUpdated can't be used, as anything changed while the refresh ran would be skipped.
+    def __init__(self):
+        self.started = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=CLOCK_SKEW_MARGIN)
+        self.searched: Optional[datetime.datetime] = None
+
+    def page(self, bundle: Dict) -> None:
+        updated = bundle.get('meta', {}).get('lastUpdated')
+        if updated:
+            instant = parse_instant(updated)
+            self.searched = instant if self.searched is None else min(self.searched, instant)
+
+    def checkpoint(self, previous: Optional[str]) -> str:
+        if self.searched:
+            return self.searched.isoformat()
+        return previous or self.started.isoformat()
+
+
+def _in_window(birth_date: str, window: Tuple[str, str]) -> bool:
+    return window[0] < birth_date <= window[1]
+
+
+def _entering(old: Tuple[str, str], new: Tuple[str, str]) -> List[Tuple[str, str]]:
+    # The parts of the new birthdate window that weren't in the old one, as (gt, le) pairs. As
+    # time passes the window moves forward, and the patients who turned min_age come into it
+    slices = [(new[0], min(new[1], old[0])), (max(new[0], old[1]), new[1])]
+    return [(low, high) for low, high in slices if low < high]
+
+
+def refresh_cohort(name: str, criteria: CohortCriteria, default_email: Optional[str] = None,
+                   client: Optional[FhirClient] = None, checkpoint_dir: str = COHORT_CHECKPOINT_DIR,
+                   max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, page_size: int = DEFAULT_PAGE_SIZE) -> RefreshResult:
+    '''
+    Brings a campaign's stored cohort up to date and returns what changed, so outreach only has
+    to be written for the new members.
+
+    The first refresh of a campaign (or the first after its criteria changed) searches for the
+    whole cohort. After that only the resources changed since the last refresh are searched
+    (_lastUpdated=ge<checkpoint>), so a nightly refresh takes time in proportion to the churn
+    rather than the population:
+    - Members who have aged out of the range are removed.
+    - Patients who have aged into the range are searched for with their birthdates only.
+    - Changed Conditions that match add their patients. A changed Condition that no longer
+      matches triggers a recheck of its patient's conditions, as does a changed Patient who
+      isn't a member yet.
+    - Changed Patients in the birthdate window who are members have their details updated, or
+      are removed if they no longer qualify.
+
+    Deleted resources don't show up in searches, and neither do members whose birthDate was
+    corrected to one outside the window, so these patients stay in the cohort until a full
+    refresh (delete the checkpoint file to force one).
+
+    Parameters:
+    name (str): The campaign, which names its checkpoint file in checkpoint_dir.
+    criteria (CohortCriteria): The patients the campaign targets.
+    default_email (str): The email address to use for patients who don't have one.
+    client (FhirClient): The FHIR client to search with. Defaults to the shared fhir_client.client.
+    '''
+    client = client or fhir_client.client
+    path = os.path.join(checkpoint_dir, f"{name}.json")
+    requests_before = client.request_count
+    window = birthdate_window(criteria.min_age, criteria.max_age)
+    matches = condition_matcher(criteria.conditions)
+    clock = _ServerClock()
+    checkpoint = CohortCheckpoint.load(path)
+    include = {'_include': 'Condition:subject'}
+
+    def birthdate_params(low: str, high: str) -> Dict:
+        return {'subject.birthdate': [f'le{high}', f'gt{low}']}
+
+    def search(params: Dict, filtered: bool = True) -> Iterable[Tuple[str, Dict, Dict]]:
+        # Searches for each condition of the criteria in turn, or for any condition at once
+        if not filtered:
+            return iter_condition_matches(client, params, lambda resource: True, max_in_flight=max_in_flight,
+                                          page_size=page_size, on_page=clock.page)
+        return (match for condition in criteria.conditions
+                for match in iter_condition_matches(client, params, matches, condition_search_params(condition),
+                                                    max_in_flight=max_in_flight, page_size=page_size,
+                                                    on_page=clock.page))
+
+    if checkpoint is None or checkpoint.criteria != criteria or not checkpoint.last_updated:
+        members: Dict[str, Dict] = {}
+        for patient_id, patient, condition in search({**birthdate_params(*window), **include}):
+            details = patient_details(client, patient_id, patient, condition, default_email)
+            if details and patient_id not in members:
+                members[patient_id] = {**details, 'birthDate': patient['birthDate']}
+        CohortCheckpoint(criteria, window, clock.checkpoint(None), members).save(path)
+        return RefreshResult([_public(m) for m in members.values()], [], [], len(members), True,
+                             client.request_count - requests_before)
+
+    members = dict(checkpoint.members)
+    added: Dict[str, Dict] = {}
+    updated: Dict[str, Dict] = {}
+    removed: Dict[str, Dict] = {}
+    recheck: Set[str] = set()
+    since = {'_lastUpdated': f'ge{checkpoint.last_updated}'}
+
+    def add(patient_id: str, patient: Dict, condition: Dict) -> None:
+        if patient_id in members or not _in_window(patient['birthDate'], window):
+            return
+        details = patient_details(client, patient_id, patient, condition, default_email)
+        if details:
+            members[patient_id] = added[patient_id] = {**details, 'birthDate': patient['birthDate']}
+
+    def remove(patient_id: str) -> None:
+        member = members.pop(patient_id, None)
+        if member is not None:
+            removed[patient_id] = member
+            added.pop(patient_id, None)
+            updated.pop(patient_id, None)
+
+    # Members who have aged out of the range
+    for patient_id, member in list(members.items()):
+        if not _in_window(member['birthDate'], window):
+            remove(patient_id)
+
+    # Patients who have aged into the range
+    for low, high in _entering(checkpoint.window, window):
+        for patient_id, patient, condition in search({**birthdate_params(low, high), **include}):
+            add(patient_id, patient, condition)
+
+    # Conditions that changed. Not filtered by code, so a condition that stopped matching is seen too
+    for patient_id, patient, condition in search({**birthdate_params(*window), **since, **include}, filtered=False):
+        if matches(condition):
+            add(patient_id, patient, condition)
+        elif patient_id in members:
+            recheck.add(patient_id)
+
+    # Patients in the window that changed. The window keeps the search to the cohort's ages on a
+    # server shared with other cohorts
+    low, high = window
+    for page in client.search_pages('Patient', {'birthdate': [f'le{high}', f'gt{low}'], **since}, page_size=page_size):
+        clock.page(page)
+        for entry in page.get('entry', []):
+            patient = entry['resource']
+            if patient.get('resourceType') != 'Patient':
+                continue
+            patient_id = patient['id']
+            if patient_id in members:
+                if not _in_window(patient.get('birthDate', ''), window):
+                    remove(patient_id)
+                    continue
+                member = members[patient_id]
+                condition = {'code': {'coding': [{'display': member['condition']}]}}
+                details = patient_details(client, patient_id, patient, condition, default_email)
+                if details is None:
+                    remove(patient_id)
+                elif {**details, 'birthDate': patient['birthDate']} != member:
+                    members[patient_id] = {**details, 'birthDate': patient['birthDate']}
+                    if patient_id in added:
+                        added[patient_id] = members[patient_id]
+                    else:
+                        updated[patient_id] = members[patient_id]
+            elif _in_window(patient.get('birthDate', ''), window):
+                recheck.add(patient_id)
+
+    # Patients whose conditions have to be looked at again, RECHECK_BATCH_SIZE patients per search
+    def conditions_of(patient_ids: List[str]) -> Tuple[List[str], Dict[str, Tuple[str, Dict, Dict]]]:
+        found: Dict[str, Tuple[str, Dict, Dict]] = {}
+        subjects = {'subject': ','.join(f'Patient/{patient_id}' for patient_id in patient_ids)}
+        for match in iter_condition_matches(client, {**subjects, **include}, matches, max_in_flight=1,
+                                            page_size=page_size, prefetch=False, on_page=clock.page):
+            found.setdefault(match[0], match)
+        return patient_ids, found
+
+    recheck = sorted(recheck)
+    chunks = [recheck[i:i + RECHECK_BATCH_SIZE] for i in range(0, len(recheck), RECHECK_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as pool:
+        for patient_ids, found in pool.map(conditions_of, chunks):
+            for patient_id in patient_ids:
+                if patient_id in found:
+                    add(*found[patient_id])
+                else:
+                    remove(patient_id)
+
+    CohortCheckpoint(criteria, window, clock.checkpoint(checkpoint.last_updated), members).save(path)
+    return RefreshResult([_public(m) for m in added.values()], [_public(m) for m in removed.values()],
+                         [_public(m) for m in updated.values()], len(members), False,
+                         client.request_count - requests_before)
+
+
+def _public(member: Dict) -> Dict:
+    # The patient dictionary without the birthDate that is only kept for the checkpoint
+    return {key: value for key, value in member.items() if key != 'birthDate'}
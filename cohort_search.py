@@ -0,0 +1,301 @@
+import datetime
+import itertools
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dateutil.relativedelta import relativedelta
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import fhir_client
+from condition_codes import condition_search_params, lookup_condition_codes
+from fhir_client import FhirClient, included_resources, DEFAULT_MAX_IN_FLIGHT, DEFAULT_PAGE_SIZE
+from patient_record import PatientRecord
+
+# Number of birthdate shards of a cohort search that are searched at the same time. 1 searches
+# the whole birthdate window in one search
+DEFAULT_SEARCH_WORKERS = int(os.getenv("COHORT_SEARCH_WORKERS", "1"))
+# A shard whose search matches more conditions than this is split in two before it is read
+DEFAULT_MAX_SHARD_RESULTS = 5000
+# Matches waiting to be yielded by a sharded search, per worker
+_SHARD_QUEUE_SIZE = 256
+
+
+def birthdate_window(min_age: int, max_age: int) -> Tuple[str, str]:
+    '''
+    Converts an age range into the (min_birthdate, max_birthdate) window of patients that are
+    at least min_age and at most max_age years old today. min_birthdate is exclusive.
+    '''
+    today = datetime.date.today()
+    max_birthdate = today - relativedelta(years=min_age)
+    max_birthdate = max_birthdate.strftime('%Y-%m-%d')
+
+    min_birthdate = today - relativedelta(years=max_age + 1)
+    min_birthdate = min_birthdate.strftime('%Y-%m-%d')
+    return min_birthdate, max_birthdate
+
+
+def split_birthdate_window(min_birthdate: str, max_birthdate: str, shards: int) -> List[Tuple[str, str]]:
+    '''
+    Splits the birthdate window (min_birthdate, max_birthdate] into at most `shards` consecutive
+    windows spanning about the same number of days, with the same exclusive lower bounds.
+    '''
+    low = datetime.date.fromisoformat(min_birthdate).toordinal()
+    high = datetime.date.fromisoformat(max_birthdate).toordinal()
+    shards = max(1, min(shards, high - low))
+    bounds = [datetime.date.fromordinal(low + (high - low) * i // shards).isoformat() for i in range(shards + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def condition_matcher(conditions: Iterable[str]) -> Callable[[Dict], bool]:
+    '''
+    Returns a check of whether a Condition resource has any of the conditions: a known SNOMED
+    code of one of them, or a display name that contains one of them.
+    '''
+    conditions = [condition.lower() for condition in conditions]
+    codes = {code for condition in conditions for code in lookup_condition_codes(condition)}
+
+    def matches(resource: Dict) -> bool:
+        return 'code' in resource and any(
+            coding.get('code') in codes or any(c in coding.get('display', '').lower() for c in conditions)
+            for coding in resource['code'].get('coding', []))
+    return matches
+
+
+def patient_details(client: FhirClient, patient_id: str, patient: Dict, condition: Dict,
+                    default_email: Optional[str] = None) -> Optional[Dict[str, Union[str, int, None]]]:
+    '''
+    Builds the patient dictionary of get_patients_between_ages_and_condition from a Patient resource
+    and the matching Condition resource. Returns None for patients without the contact details
+    (telecom and maritalStatus) that outreach needs.
+    '''
+    record = PatientRecord.from_resource(patient)
+    if not record.contactable:
+        return None
+    return record.to_dict(client.patient_url(patient_id), condition['code']['coding'][0]['display'], default_email)
+
+
+def iter_condition_matches(client: FhirClient, params: Dict, matches: Callable[[Dict], bool],
+                           filter_params: Optional[List[Dict]] = None, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                           page_size: int = DEFAULT_PAGE_SIZE, prefetch: bool = True,
+                           on_page: Optional[Callable[[Dict], None]] = None) -> Iterator[Tuple[str, Dict, Dict]]:
+    '''
+    Runs a Condition search page by page and yields (patient id, Patient, Condition) for every
+    Condition that matches, as soon as the patients of its page have been resolved.
+
+    filter_params are alternative sets of extra search parameters that narrow the search on the
+    server (e.g. from condition_search_params). The search is run with each of them and the
+    results are merged, each Condition yielded once. A server that doesn't support one answers
+    with an OperationOutcome instead of a Bundle, in which case the search is repeated without
+    any of them; matches is applied to every Condition either way. on_page is called with every
+    Bundle of the search.
+    '''
+    seen = set()
+    for extra in filter_params or [None]:
+        pages = client.search_pages('Condition', {**params, **extra} if extra else params,
+                                    page_size=page_size, prefetch=prefetch)
+        first_page = next(pages, None)
+        if extra and (first_page or {}).get('resourceType') != 'Bundle':
+            pages.close()
+            pages = client.search_pages('Condition', params, page_size=page_size, prefetch=prefetch)
+            yield from _page_matches(client, pages, matches, seen, max_in_flight, on_page)
+            return
+        pages = itertools.chain([first_page] if first_page else [], pages)
+        yield from _page_matches(client, pages, matches, seen, max_in_flight, on_page)
+
+
+def _page_matches(client: FhirClient, pages: Iterable[Dict], matches: Callable[[Dict], bool], seen: set,
+                  max_in_flight: int, on_page: Optional[Callable[[Dict], None]]) -> Iterator[Tuple[str, Dict, Dict]]:
+    for page in pages:
+        if on_page:
+            on_page(page)
+        # Filter out the included patients, the conditions that don't match and the ones an earlier
+        # filter already found. The server should already have filtered them, but the check is
+        # cheap and keeps the results right on servers that ignore the code parameters
+        conditions = [entry['resource'] for entry in page.get('entry', [])
+                      if entry['resource']['resourceType'] == 'Condition' and entry['resource']['id'] not in seen
+                      and matches(entry['resource'])]
+        seen.update(cond['id'] for cond in conditions)
+
+        # Get patient data for each condition. Patients included in the search Bundle are used as they are,
+        # any others are requested once each in batch Bundles, at most max_in_flight at a time
+        patient_ids = [cond['subject']['reference'].split('/')[1] for cond in conditions]
+        resolved = client.resolve_patients(patient_ids, known=included_resources(page, 'Patient'), max_in_flight=max_in_flight)
+        for cond, patient_id in zip(conditions, patient_ids):
+            if patient_id in resolved:
+                yield patient_id, resolved[patient_id], cond
+
+
+class _ShardTooLarge(Exception):
+    def __init__(self, total: int):
+        super().__init__(total)
+        self.total = total
+
+
+def iter_sharded_condition_matches(client: FhirClient, params: Dict, matches: Callable[[Dict], bool],
+                                   min_birthdate: str, max_birthdate: str,
+                                   workers: int = DEFAULT_SEARCH_WORKERS, shards: Optional[int] = None,
+                                   max_shard_results: int = DEFAULT_MAX_SHARD_RESULTS,
+                                   **kwargs) -> Iterator[Tuple[str, Dict, Dict]]:
+    '''
+    The parallel form of iter_condition_matches for a search over the birthdate window
+    (min_birthdate, max_birthdate]: the window is split into `shards` (default: workers) birthdate
+    windows, which are searched at the same time, at most `workers` at a time.
+
+    A shard whose first page reports (Bundle.total) more than max_shard_results matching
+    conditions is split into total / max_shard_results shards instead of being read, and these
+    are split again if they are still too large (down to a single day), so one dense age band
+    doesn't leave the other workers idle. The matches of
+    all the shards are yielded as they arrive, in no particular order, and each Condition only
+    once: patients whose birthDate is only given to the month or year can match the windows on
+    both sides of a boundary. The other keyword arguments are passed to iter_condition_matches.
+    '''
+    workers = max(1, workers)
+    results: queue.Queue = queue.Queue(maxsize=_SHARD_QUEUE_SIZE * workers)
+    stop = threading.Event()
+    lock = threading.Lock()
+    done = object()
+    pending = 0
+
+    def put(item) -> bool:
+        # Waits for room in the queue, unless the caller has stopped reading
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def submit(windows: List[Tuple[str, str]]) -> None:
+        nonlocal pending
+        with lock:
+            pending += len(windows)
+        for window in windows:
+            pool.submit(search_shard, window)
+
+    def search_shard(window: Tuple[str, str]) -> None:
+        nonlocal pending
+        low, high = window
+        splittable = len(split_birthdate_window(low, high, 2)) > 1
+        first_page = True
+
+        def check_size(page: Dict) -> None:
+            nonlocal first_page
+            if first_page and splittable and page.get('total', 0) > max_shard_results:
+                raise _ShardTooLarge(page['total'])
+            first_page = False
+
+        try:
+            shard_params = {**params, 'subject.birthdate': [f'le{high}', f'gt{low}']}
+            for match in iter_condition_matches(client, shard_params, matches, on_page=check_size, **kwargs):
+                if not put(match):
+                    return
+        except _ShardTooLarge as e:
+            if not stop.is_set():
+                submit(split_birthdate_window(low, high, -(-e.total // max_shard_results)))
+        except Exception as e:
+            put(e)
+        finally:
+            with lock:
+                pending -= 1
+                finished = pending == 0
+            if finished:
+                put(done)
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    seen = set()
+    try:
+        submit(split_birthdate_window(min_birthdate, max_birthdate, shards or workers))
+        while True:
+            item = results.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            if item[2]['id'] not in seen:
+                seen.add(item[2]['id'])
+                yield item
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_patients_between_ages_and_condition(min_age: int, max_age: int, condition: str,
+                                             default_email: Optional[str] = None,
+                                             max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                                             page_size: int = DEFAULT_PAGE_SIZE,
+                                             prefetch: bool = True,
+                                             server_filter: bool = True,
+                                             client: Optional[FhirClient] = None,
+                                             index=None, workers: int = DEFAULT_SEARCH_WORKERS,
+                                             shards: Optional[int] = None,
+                                             max_shard_results: int = DEFAULT_MAX_SHARD_RESULTS) -> Iterator[Dict[str, Union[str, int, None]]]:
+    '''
+    Searches the FHIR server page by page and yields each patient who is between the ages and has
+    the condition as soon as the page they are on has been resolved. This is the streaming form of
+    get_patients_between_ages_and_condition; see that function for the patient dictionary layout.
+
+    Parameters:
+    min_age (int): The minimum age to filter patients by.
+    max_age (int): The maximum age to filter patients by.
+    condition (str): Only patients with a condition whose name contains this text are returned.
+    default_email (str): The email address to use for patients who don't have one.
+    max_in_flight (int): The maximum number of Patient requests sent to the server at the same time.
+    page_size (int): The number of conditions requested per search page.
+    prefetch (bool): Fetch the next search page while the current one is being filtered.
+    server_filter (bool): Ask the server to filter by condition (code:text=, and code= for known
+    SNOMED codes) rather than downloading every condition in the age range. Falls back to
+    filtering here if the server refuses.
+    client (FhirClient): The FHIR client to search with. Defaults to the shared fhir_client.client.
+    index (PatientIndex): A local patient index to answer from instead of the server (see
+    patient_index). Defaults to the index at PATIENT_INDEX_PATH, if one is configured.
+    workers (int): Split the birthdate window into shards and search this many at the same time
+    (see iter_sharded_condition_matches). The patients then arrive in no particular order.
+    shards (int): The number of shards the window is split into at first. Defaults to workers.
+    max_shard_results (int): Shards that match more conditions than this are split in two.
+    '''
+    # Imported here as patient_index builds on this module
+    import patient_index
+    index = index or patient_index.default_index()
+    if index is not None:
+        yield from index.query(min_age, max_age, condition, default_email)
+        return
+
+    client = client or fhir_client.client
+    min_birthdate, max_birthdate = birthdate_window(min_age, max_age)
+
+    # Get conditions. _include=Condition:subject asks the server to return the patient of each
+    # condition in the same Bundle, so they don't have to be fetched one at a time afterwards
+    params = {
+        'subject.birthdate': [f'le{max_birthdate}', f'gt{min_birthdate}'],
+        '_include': 'Condition:subject',
+    }
+    options = dict(filter_params=condition_search_params(condition) if server_filter else None,
+                   max_in_flight=max_in_flight, page_size=page_size, prefetch=prefetch)
+    if workers > 1:
+        # The birthdate window is split into shards that are searched in parallel
+        matches = iter_sharded_condition_matches(client, {'_include': params['_include']}, condition_matcher([condition]),
+                                                 min_birthdate, max_birthdate, workers=workers, shards=shards,
+                                                 max_shard_results=max_shard_results, **options)
+    else:
+        matches = iter_condition_matches(client, params, condition_matcher([condition]), **options)
+    for patient_id, patient, cond in matches:
+        details = patient_details(client, patient_id, patient, cond, default_email)
+        if details:
+            yield details
+
+
+def iter_patients_between_ages_and_conditions(min_age: int, max_age: int, conditions: Iterable[str],
+                                              **kwargs) -> Iterator[Dict[str, Union[str, int, None]]]:
+    '''
+    Searches for the patients between the ages with any of the conditions, one condition after the
+    other, and yields each patient once, with the first of the conditions they were found with.
+    The keyword arguments are the same as for iter_patients_between_ages_and_condition.
+    '''
+    seen = set()
+    for condition in conditions:
+        for patient in iter_patients_between_ages_and_condition(min_age, max_age, condition, **kwargs):
+            if patient['patient_url'] not in seen:
+                seen.add(patient['patient_url'])
+                yield patient
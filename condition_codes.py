@@ -0,0 +1,128 @@
+from typing import Dict, List
+
+# SNOMED CT system URI used in FHIR token searches (code=system|code)
+SNOMED_SYSTEM = "http://snomed.info/sct"
+
+# SNOMED CT display names and codes for the conditions that come up most often in the (Synthea
+# generated) data on the public FHIR servers. This lets a free-text condition from the LLM, e.g.
+# "Hyperglycemia", be turned into codes for a server-side search without a terminology server.
+SNOMED_CONDITIONS = [
+    ("80394007", "Hyperglycemia (disorder)"),
+    ("15777000", "Prediabetes"),
+    ("44054006", "Diabetes mellitus type 2 (disorder)"),
+    ("127013003", "Diabetic renal disease (disorder)"),
+    ("90781000119102", "Microalbuminuria due to type 2 diabetes mellitus (disorder)"),
+    ("157141000119108", "Proteinuria due to type 2 diabetes mellitus (disorder)"),
+    ("368581000119106", "Neuropathy due to type 2 diabetes mellitus (disorder)"),
+    ("422034002", "Diabetic retinopathy associated with type II diabetes mellitus (disorder)"),
+    ("1551000119108", "Nonproliferative diabetic retinopathy due to type 2 diabetes mellitus (disorder)"),
+    ("237602007", "Metabolic syndrome X (disorder)"),
+    ("162864005", "Body mass index 30+ - obesity (finding)"),
+    ("55822004", "Hyperlipidemia"),
+    ("302870006", "Hypertriglyceridemia (disorder)"),
+    ("38341003", "Hypertension"),
+    ("59621000", "Essential hypertension (disorder)"),
+    ("22298006", "Myocardial infarction (disorder)"),
+    ("399211009", "History of myocardial infarction (situation)"),
+    ("53741008", "Coronary Heart Disease"),
+    ("49436004", "Atrial Fibrillation"),
+    ("88805009", "Chronic congestive heart failure (disorder)"),
+    ("230690007", "Stroke"),
+    ("431855005", "Chronic kidney disease stage 1 (disorder)"),
+    ("431856006", "Chronic kidney disease stage 2 (disorder)"),
+    ("433144002", "Chronic kidney disease stage 3 (disorder)"),
+    ("431857002", "Chronic kidney disease stage 4 (disorder)"),
+    ("46177005", "End-stage renal disease (disorder)"),
+    ("10509002", "Acute bronchitis (disorder)"),
+    ("195662009", "Acute viral pharyngitis (disorder)"),
+    ("43878008", "Streptococcal sore throat (disorder)"),
+    ("444814009", "Viral sinusitis (disorder)"),
+    ("75498004", "Acute bacterial sinusitis (disorder)"),
+    ("40055000", "Chronic sinusitis (disorder)"),
+    ("65363002", "Otitis media"),
+    ("233604007", "Pneumonia (disorder)"),
+    ("840539006", "COVID-19"),
+    ("195967001", "Asthma"),
+    ("233678006", "Childhood asthma"),
+    ("185086009", "Chronic obstructive bronchitis (disorder)"),
+    ("87433001", "Pulmonary emphysema (disorder)"),
+    ("367498001", "Seasonal allergic rhinitis"),
+    ("64859006", "Osteoporosis (disorder)"),
+    ("69896004", "Rheumatoid arthritis"),
+    ("239873007", "Osteoarthritis of knee"),
+    ("201834006", "Localized, primary osteoarthritis of the hand"),
+    ("26929004", "Alzheimer's disease (disorder)"),
+    ("230265002", "Familial Alzheimer's disease of early onset (disorder)"),
+    ("84757009", "Epilepsy"),
+    ("128613002", "Seizure disorder"),
+    ("271737000", "Anemia (disorder)"),
+    ("68496003", "Polyp of colon"),
+    ("713197008", "Recurrent rectal polyp"),
+    ("363406005", "Malignant neoplasm of colon"),
+    ("93761005", "Primary malignant neoplasm of colon"),
+    ("94260004", "Secondary malignant neoplasm of colon"),
+    ("109838007", "Overlapping malignant neoplasm of colon"),
+    ("254837009", "Malignant neoplasm of breast (disorder)"),
+    ("126906006", "Neoplasm of prostate"),
+    ("254637007", "Non-small cell lung cancer (disorder)"),
+    ("24079001", "Atopic dermatitis"),
+    ("40275004", "Contact dermatitis"),
+    ("72892002", "Normal pregnancy"),
+    ("19169002", "Miscarriage in first trimester"),
+    ("62106007", "Concussion with no loss of consciousness"),
+    ("44465007", "Sprain of ankle"),
+    ("70704007", "Sprain of wrist"),
+    ("16114001", "Fracture of ankle"),
+    ("58150001", "Fracture of clavicle"),
+    ("65966004", "Fracture of forearm"),
+]
+
+
+def _normalize(display: str) -> str:
+    # Lower case and drop the semantic tag, e.g. "Hyperglycemia (disorder)" -> "hyperglycemia"
+    display = display.lower().strip()
+    if display.endswith(")") and " (" in display:
+        display = display[:display.rindex(" (")]
+    return display
+
+
+# Normalized display name -> SNOMED codes
+CONDITION_CODE_INDEX: Dict[str, List[str]] = {}
+for _code, _display in SNOMED_CONDITIONS:
+    CONDITION_CODE_INDEX.setdefault(_normalize(_display), []).append(_code)
+
+
+def lookup_condition_codes(condition: str) -> List[str]:
+    '''
+    Turns a free-text condition into the SNOMED codes of the known conditions whose display
+    name contains it, without any network calls. An exact display name match wins over
+    substring matches.
+
+    Example usage:
+    >>> lookup_condition_codes("Hyperglycemia")
+    ['80394007']
+
+    Returns:
+    A list of SNOMED codes, empty if the condition is not in the index.
+    '''
+    condition = _normalize(condition)
+    if not condition:
+        return []
+    if condition in CONDITION_CODE_INDEX:
+        return list(CONDITION_CODE_INDEX[condition])
+    return [code for display, codes in CONDITION_CODE_INDEX.items() if condition in display for code in codes]
+
+
+def condition_search_params(condition: str) -> List[Dict[str, str]]:
+    '''
+    Returns the Condition search parameters that filter on the server by condition, as
+    alternatives to search with one after the other and merge: a code:text= search, which finds
+    the conditions named like it whatever their code, and a code= token list when the condition
+    resolves to known SNOMED codes, which also finds codings whose display names it differently.
+    The index only adds to what the text search finds, so a code missing from it loses nothing.
+    '''
+    params = [{'code:text': condition}]
+    codes = lookup_condition_codes(condition)
+    if codes:
+        params.append({'code': ','.join(f'{SNOMED_SYSTEM}|{code}' for code in codes)})
+    return params
@@ -0,0 +1,160 @@
+import json
+import sqlite3
+import threading
+import time
+from email.utils import format_datetime
+from datetime import datetime
+from typing import Dict, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# How long a cached resource is used without asking the server whether it has changed
+DEFAULT_TTL = 24 * 60 * 60
+# Size of the cache on disk before the least recently used resources are evicted
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Query parameters that change how a response is formatted but not what it contains
+IGNORED_PARAMS = {"_pretty", "_format"}
+
+
+def normalize_url(url: str) -> str:
+    '''
+    Normalizes a FHIR URL into a cache key: lower case scheme and host, formatting
+    parameters such as _pretty dropped and the remaining parameters sorted.
+    '''
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in IGNORED_PARAMS)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), urlencode(query), ""))
+
+
+def last_modified_of(resource: Dict) -> Optional[str]:
+    '''
+    Turns a resource's meta.lastUpdated into an HTTP date for If-Modified-Since, for
+    servers that don't send a Last-Modified header.
+    '''
+    last_updated = resource.get("meta", {}).get("lastUpdated")
+    if not last_updated:
+        return None
+    try:
+        return format_datetime(datetime.fromisoformat(last_updated.replace("Z", "+00:00")), usegmt=True)
+    except ValueError:
+        return None
+
+
+class CacheEntry(NamedTuple):
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fresh: bool
+
+    def resource(self) -> Dict:
+        return json.loads(self.body)
+
+
+class FhirCache:
+    '''
+    A persistent cache of FHIR resource reads, stored in a sqlite database.
+
+    Entries are keyed by the normalized URL. An entry younger than ttl seconds is used without
+    contacting the server. An older one is revalidated with If-None-Match (its ETag) or
+    If-Modified-Since (its Last-Modified / meta.lastUpdated), so an unchanged resource only
+    costs a 304 response. Once the cache is larger than max_bytes the least recently used
+    entries are evicted.
+
+    stats counts hits (fresh entries), revalidated (304 responses), misses, evictions and
+    bytes_saved (the size of the bodies that didn't have to be downloaded).
+    '''
+
+    def __init__(self, path: str, ttl: float = DEFAULT_TTL, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0, "evictions": 0, "bytes_saved": 0}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def lookup(self, url: str) -> Optional[CacheEntry]:
+        '''
+        Returns the cached response for url, or None if there isn't one. A fresh entry counts as a
+        hit; a stale one must be revalidated and recorded with revalidated() or store().
+        '''
+        key = normalize_url(url)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body, etag, last_modified, fetched_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            body, etag, last_modified, fetched_at = row
+            fresh = now - fetched_at < self.ttl
+            if fresh:
+                self.stats["hits"] += 1
+                self.stats["bytes_saved"] += len(body)
+            return CacheEntry(body, etag, last_modified, fresh)
+
+    def revalidated(self, url: str, entry: CacheEntry) -> None:
+        '''
+        Records that the server answered 304 Not Modified for a stale entry, making it fresh again.
+        '''
+        with self._lock:
+            self._db.execute("UPDATE responses SET fetched_at = ? WHERE key = ?", (time.time(), normalize_url(url)))
+            self.stats["revalidated"] += 1
+            self.stats["bytes_saved"] += len(entry.body)
+
+    def store(self, url: str, body: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None) -> None:
+        key = normalize_url(url)
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, body, etag, last_modified, now, now, len(body)))
+            self._size += len(body) - (old[0] if old else 0)
+            self._evict()
+
+    def store_resource(self, url: str, resource: Dict, etag: Optional[str] = None) -> None:
+        '''
+        Stores a resource that didn't come with its own response headers, e.g. an entry of a
+        batch-response, taking the ETag from meta.versionId if needed.
+        '''
+        version = resource.get("meta", {}).get("versionId")
+        self.store(url, json.dumps(resource).encode(),
+                   etag=etag or (f'W/"{version}"' if version else None),
+                   last_modified=last_modified_of(resource))
+
+    def _evict(self) -> None:
+        # Drop the least recently used entries until the cache fits in max_bytes again
+        while self._size > self.max_bytes:
+            rows = self._db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed_at LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= size
+                self.stats["evictions"] += 1
+                if self._size <= self.max_bytes:
+                    break
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._size = 0
+
+    def size(self) -> int:
+        return self._size
@@ -0,0 +1,400 @@
+import os
+import threading
+import time
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from fhir_cache import CacheEntry, FhirCache, DEFAULT_TTL, last_modified_of
+from tracing import tracer
+
+# orjson decodes FHIR JSON several times faster than the json module; it is optional
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    import json
+    orjson = None
+    loads = json.loads
+
+# The FHIR R4 server used by all of the scripts. Override it with the FHIR_BASE_URL
+# environment variable to point at a local server (e.g. the benchmark stub).
+FHIR_BASE_URL = os.getenv("FHIR_BASE_URL", "https://hapi.fhir.org/baseR4").rstrip("/")
+
+# Default number of Patient requests that are allowed to be in flight at once
+DEFAULT_MAX_IN_FLIGHT = 8
+# Upper bound on the connection pool, and therefore on the useful max_in_flight
+MAX_POOL_SIZE = 64
+# Number of Patient reads packed into one FHIR batch Bundle
+BATCH_SIZE = 100
+# Number of search results requested per page (the _count search parameter)
+DEFAULT_PAGE_SIZE = 100
+# Seconds to wait for the server to accept a connection and to send a response
+DEFAULT_TIMEOUT = (10, 120)
+# Number of times a request is retried after a connection error, 429 or 5xx response
+DEFAULT_MAX_RETRIES = 5
+# Retries wait backoff_factor * 2 ** (retry - 1) seconds, unless the server sends Retry-After
+DEFAULT_BACKOFF_FACTOR = 0.5
+# Number of recent request timings kept by a client
+MAX_TIMINGS = 10000
+
+# Persistent cache of Patient reads, so repeat runs only download the patients that changed.
+# Set FHIR_CACHE_PATH to an empty string to turn it off.
+FHIR_CACHE_PATH = os.getenv("FHIR_CACHE_PATH", ".fhir_cache.sqlite3")
+
+# Time spent opening connections by the current thread's request; see _TimedConnectionMixin
+_connect_time = threading.local()
+
+
+class _TimedConnectionMixin:
+    # Records how long opening each new connection took, so connect time can be
+    # reported separately from waiting for and downloading the response
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_time.seconds = getattr(_connect_time, 'seconds', 0.0) + time.perf_counter() - start
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
+
+
+def _resource_of(url: str, base_url: str) -> str:
+    # The resource type a request is for, to name its span: Condition, Patient, ... A next page
+    # link of the server's own form (e.g. ?_getpages=...) has none, so it is named after that
+    path = url[len(base_url):] if url.startswith(base_url) else url.split("://", 1)[-1].partition("/")[2]
+    resource = path.lstrip("/").split("?", 1)[0].split("/", 1)[0]
+    return resource or "page"
+
+
+class RequestTiming(NamedTuple):
+    '''
+    How long one request took. connect is the time spent opening new connections (0 when a
+    kept-alive connection was reused), wait the rest of the time until the response headers
+    arrived, and transfer the time spent downloading the body. size is the decoded body size.
+    '''
+    method: str
+    url: str
+    status: int
+    connect: float
+    wait: float
+    transfer: float
+    size: int
+
+    @property
+    def total(self) -> float:
+        return self.connect + self.wait + self.transfer
+
+
+class FhirClient:
+    '''
+    A client for a FHIR R4 server, shared by everything that talks to it.
+
+    The client owns one pooled requests session, so connections are kept alive and reused across
+    requests and threads. It asks for gzip-compressed, unformatted JSON, retries connection errors,
+    429 and 5xx responses with exponential backoff (waiting for Retry-After when the server sends
+    it), and keeps the timing of recent requests in timings.
+
+    Example usage:
+    >>> client = FhirClient("http://localhost:8080/fhir")
+    >>> client.fetch_patients(["1", "2", "3"])
+    >>> client.timing_summary()
+    '''
+
+    def __init__(self, base_url: str = FHIR_BASE_URL, cache: Optional[FhirCache] = None,
+                 pool_size: int = MAX_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 max_retries: int = DEFAULT_MAX_RETRIES, backoff_factor: float = DEFAULT_BACKOFF_FACTOR):
+        self.base_url = base_url.rstrip("/")
+        self.cache = cache
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.timings: Deque[RequestTiming] = deque(maxlen=MAX_TIMINGS)
+        self._request_count = 0
+        self._lock = threading.Lock()
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # Batch Bundles are POSTed but only read, so they are as safe to retry as a GET
+            allowed_methods=frozenset({"GET", "POST"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = _TimedHTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept": "application/fhir+json", "Accept-Encoding": "gzip"})
+
+    @property
+    def request_count(self) -> int:
+        return self._request_count
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._request_count = 0
+            self.timings.clear()
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        '''
+        Sends a request to the server, counting it and recording its timing. url may be absolute
+        (e.g. a Bundle's next link) or relative to base_url. With stream=True the body is left
+        for the caller to read, and only the time until the headers arrived is recorded.
+        '''
+        if not url.startswith(("http://", "https://")):
+            url = f"{self.base_url}/{url}" if url else self.base_url
+        _connect_time.seconds = 0.0
+        with tracer.span(f"FHIR {method} {_resource_of(url, self.base_url)}") as span:
+            start = time.perf_counter()
+            r = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            total = time.perf_counter() - start
+            # r.elapsed runs from sending the request until the response headers were parsed
+            connect = _connect_time.seconds
+            timing = RequestTiming(method, r.url, r.status_code, connect, max(r.elapsed.total_seconds() - connect, 0.0),
+                                   max(total - r.elapsed.total_seconds(), 0.0),
+                                   0 if kwargs.get("stream") else len(r.content))
+            span.set(url=r.url, status=r.status_code).add("fhir.requests").add("fhir.bytes", timing.size)
+        with self._lock:
+            self._request_count += 1
+            self.timings.append(timing)
+        return r
+
+    def timing_summary(self) -> Dict[str, float]:
+        '''
+        Totals of the recorded request timings: the number of requests, seconds spent connecting,
+        waiting and transferring, and the bytes received.
+        '''
+        timings = list(self.timings)
+        return {
+            "requests": len(timings),
+            "connect": sum(t.connect for t in timings),
+            "wait": sum(t.wait for t in timings),
+            "transfer": sum(t.transfer for t in timings),
+            "bytes": sum(t.size for t in timings),
+        }
+
+    def patient_url(self, patient_id: str) -> str:
+        # Link to a patient for people to open in a browser, hence _pretty
+        return f"{self.base_url}/Patient/{patient_id}?_pretty=true"
+
+    def search(self, resource_type: str, params: Dict) -> Dict:
+        '''
+        Runs a FHIR search and returns the decoded searchset Bundle. List values in params
+        are sent as repeated parameters, e.g. {'subject.birthdate': ['le2000-01-01', 'gt1990-01-01']}.
+        '''
+        return loads(self.request("GET", resource_type, params=params).content)
+
+    def search_pages(self, resource_type: str, params: Dict, page_size: Optional[int] = DEFAULT_PAGE_SIZE,
+                     prefetch: bool = False) -> Iterator[Dict]:
+        '''
+        Runs a FHIR search and yields every page of results, following the Bundle's next link
+        until the server has no more pages. Only the current page is held in memory.
+
+        Parameters:
+        resource_type (str): The resource type to search, e.g. 'Condition'.
+        params (Dict): The search parameters, as for search().
+        page_size (int): Sent as _count. None leaves the page size up to the server.
+        prefetch (bool): Request the next page in the background while the caller works on the current one.
+        '''
+        if page_size:
+            params = {**params, '_count': page_size}
+        fetch_page = lambda url: loads(self.request("GET", url).content)
+
+        if not prefetch:
+            bundle = self.search(resource_type, params)
+            while bundle is not None:
+                yield bundle
+                url = next_page_url(bundle)
+                bundle = fetch_page(url) if url else None
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            bundle = self.search(resource_type, params)
+            while bundle is not None:
+                url = next_page_url(bundle)
+                next_bundle = pool.submit(fetch_page, url) if url else None
+                yield bundle
+                bundle = next_bundle.result() if next_bundle else None
+
+    def search_entries(self, resource_type: str, params: Dict, page_size: Optional[int] = DEFAULT_PAGE_SIZE,
+                       prefetch: bool = False) -> Iterator[Dict]:
+        '''
+        Yields the entries of every page of a FHIR search as each page arrives.
+        '''
+        for bundle in self.search_pages(resource_type, params, page_size, prefetch):
+            yield from bundle.get('entry', [])
+
+    def fetch_patient(self, patient_id: str) -> Dict:
+        '''
+        Fetches a single Patient resource from the FHIR server and returns the decoded JSON.
+        A fresh copy in the cache is returned without a request, and a stale one is revalidated.
+        '''
+        url = f"{self.base_url}/Patient/{patient_id}"
+        entry = self.cache.lookup(url) if self.cache else None
+        if entry and entry.fresh:
+            return entry.resource()
+
+        r = self.request("GET", url, headers=_conditional_headers(entry))
+        if entry and r.status_code == 304:
+            self.cache.revalidated(url, entry)
+            return entry.resource()
+        patient = loads(r.content)
+        if self.cache and r.ok:
+            self.cache.store(url, r.content, r.headers.get('ETag'), r.headers.get('Last-Modified') or last_modified_of(patient))
+        return patient
+
+    def fetch_patients(self, patient_ids: Iterable[str], max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> List[Dict]:
+        '''
+        Fetches many Patient resources, keeping at most max_in_flight requests open at once.
+
+        Parameters:
+        patient_ids (Iterable[str]): The logical ids of the patients to fetch.
+        max_in_flight (int): The maximum number of concurrent requests. 1 fetches serially.
+
+        Returns:
+        A list of Patient resources in the same order as patient_ids.
+        '''
+        patient_ids = list(patient_ids)
+        max_in_flight = max(1, min(max_in_flight, self.pool_size, len(patient_ids) or 1))
+        if max_in_flight == 1:
+            return [self.fetch_patient(patient_id) for patient_id in patient_ids]
+
+        # ThreadPoolExecutor.map yields results in submission order, so the output lines
+        # up with patient_ids no matter which request finishes first
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            return list(pool.map(self.fetch_patient, patient_ids))
+
+    def fetch_patients_batch(self, patient_ids: List[str]) -> Dict[str, Dict]:
+        '''
+        Reads up to BATCH_SIZE patients with a single FHIR batch Bundle (a POST of many GETs).
+        Patients with a fresh copy in the cache are not requested, stale copies are revalidated
+        with ifNoneMatch, and the batch falls back to one GET per patient if the server rejects it.
+
+        Returns:
+        A dictionary of Patient resources keyed by id. Patients the server could not return are left out.
+        '''
+        patients = {}
+        cached = {}
+        for patient_id in patient_ids:
+            entry = self.cache.lookup(f"{self.base_url}/Patient/{patient_id}") if self.cache else None
+            if entry and entry.fresh:
+                patients[patient_id] = entry.resource()
+            else:
+                cached[patient_id] = entry
+        patient_ids = list(cached)
+        if not patient_ids:
+            return patients
+
+        entries = []
+        for patient_id in patient_ids:
+            request = {"method": "GET", "url": f"Patient/{patient_id}"}
+            if cached[patient_id] and cached[patient_id].etag:
+                request["ifNoneMatch"] = cached[patient_id].etag
+            entries.append({"request": request})
+        bundle = {"resourceType": "Bundle", "type": "batch", "entry": entries}
+        r = self.request("POST", "", json=bundle, headers={"Content-Type": "application/fhir+json"})
+        response = loads(r.content) if r.ok else {}
+        if response.get('type') != 'batch-response':
+            patients.update({patient['id']: patient for patient in self.fetch_patients(patient_ids, max_in_flight=1)
+                             if patient.get('resourceType') == 'Patient'})
+            return patients
+
+        # The entries of a batch-response are in the same order as the requests
+        for patient_id, entry in zip(patient_ids, response.get('entry', [])):
+            url = f"{self.base_url}/Patient/{patient_id}"
+            status = entry.get('response', {}).get('status', '')
+            resource = entry.get('resource', {})
+            if status.startswith('304') and cached[patient_id]:
+                self.cache.revalidated(url, cached[patient_id])
+                patients[patient_id] = cached[patient_id].resource()
+            elif status.startswith('2') and resource.get('resourceType') == 'Patient':
+                patients[resource['id']] = resource
+                if self.cache:
+                    self.cache.store_resource(url, resource, etag=entry['response'].get('etag'))
+        return patients
+
+    def resolve_patients(self, patient_ids: Iterable[str], known: Optional[Dict[str, Dict]] = None,
+                         max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> Dict[str, Dict]:
+        '''
+        Resolves a list of patient ids to Patient resources with as few requests as possible.
+
+        Patients already in known (e.g. from a search with _include=Condition:subject) are not
+        requested again but are added to the cache, so later reads of them don't go to the
+        server either. Each remaining id is requested only once however often it repeats, and
+        the rest are read in chunks of BATCH_SIZE with FHIR batch Bundles, at most max_in_flight
+        Bundles at a time.
+
+        Returns:
+        A dictionary of Patient resources keyed by id.
+        '''
+        resolved = dict(known or {})
+        if self.cache:
+            for patient_id, patient in resolved.items():
+                self.cache.store_resource(f"{self.base_url}/Patient/{patient_id}", patient)
+        missing = list(dict.fromkeys(patient_id for patient_id in patient_ids if patient_id not in resolved))
+        chunks = [missing[i:i + BATCH_SIZE] for i in range(0, len(missing), BATCH_SIZE)]
+        if not chunks:
+            return resolved
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_in_flight, self.pool_size, len(chunks)))) as pool:
+            for patients in pool.map(self.fetch_patients_batch, chunks):
+                resolved.update(patients)
+        return resolved
+
+
+def next_page_url(bundle: Dict) -> Optional[str]:
+    return next((link['url'] for link in bundle.get('link', []) if link.get('relation') == 'next'), None)
+
+
+def included_resources(bundle: Dict, resource_type: str) -> Dict[str, Dict]:
+    '''
+    Returns the resources of the given type that a search Bundle carries because of
+    _include, keyed by their logical id.
+    '''
+    return {
+        entry['resource']['id']: entry['resource']
+        for entry in bundle.get('entry', [])
+        if entry.get('resource', {}).get('resourceType') == resource_type
+        and entry.get('search', {}).get('mode', 'include') == 'include'
+    }
+
+
+def _conditional_headers(entry: Optional[CacheEntry]) -> Dict[str, str]:
+    # Headers that let the server answer 304 Not Modified if a stale cached resource hasn't changed
+    headers = {}
+    if entry and entry.etag:
+        headers['If-None-Match'] = entry.etag
+    if entry and entry.last_modified:
+        headers['If-Modified-Since'] = entry.last_modified
+    return headers
+
+
+# The client shared by all of the scripts
+client = FhirClient(
+    FHIR_BASE_URL,
+    cache=FhirCache(FHIR_CACHE_PATH, ttl=float(os.getenv("FHIR_CACHE_TTL", DEFAULT_TTL))) if FHIR_CACHE_PATH else None,
+)
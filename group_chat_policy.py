@@ -0,0 +1,235 @@
+import hashlib
+import re
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from llm_cache import LLMUsage, llm_usage
+
+# Characters per token, for estimating the size of a prompt without downloading a tokenizer
+CHARS_PER_TOKEN = 4
+# Number of recent messages an agent sees in full, unless its HistoryPolicy says otherwise
+DEFAULT_KEEP_LAST = 6
+# Characters of each older message kept in the rolling summary
+DEFAULT_SUMMARY_CHARS = 200
+# The start of the message that stands in for the older messages
+SUMMARY_PREFIX = "Summary of the earlier conversation:"
+
+_CODE_BLOCK = re.compile(r"```[\w-]*\n")
+_EXECUTION_FAILED = re.compile(r"exitcode: [1-9]|execution failed|Traceback \(most recent call last\)", re.I)
+
+
+def estimate_tokens(messages: Iterable[Dict]) -> int:
+    return sum(len(str(m.get("content") or "")) for m in messages) // CHARS_PER_TOKEN
+
+
+def has_code(message: Dict) -> bool:
+    '''
+    Whether a message holds a code block for the executor.
+    '''
+    return bool(_CODE_BLOCK.search(str(message.get("content") or "")))
+
+
+def execution_failed(message: Dict) -> bool:
+    '''
+    Whether a message is the executor's report of code that failed.
+    '''
+    return bool(_EXECUTION_FAILED.search(str(message.get("content") or "")))
+
+
+def mentions(*words: str) -> Callable[[Dict], bool]:
+    '''
+    A check of whether a message contains any of the words (ignoring case).
+    '''
+    pattern = re.compile("|".join(re.escape(w) for w in words), re.I)
+    return lambda message: bool(pattern.search(str(message.get("content") or "")))
+
+
+class Transition(NamedTuple):
+    '''
+    An edge of a group chat's speaker graph: after `source` speaks, `target` speaks next if
+    `when` is None or returns True for the message `source` just sent.
+    '''
+    source: str
+    target: str
+    when: Optional[Callable[[Dict], bool]] = None
+
+
+class HistoryPolicy(NamedTuple):
+    '''
+    How much of the conversation an agent is sent when it replies: the first message (the task),
+    a rolling summary of the messages in between, and the last keep_last messages in full.
+    '''
+    keep_last: int = DEFAULT_KEEP_LAST
+    summary_chars: int = DEFAULT_SUMMARY_CHARS
+
+
+class ChatSavings:
+    '''
+    What a group chat saved by choosing speakers by rule and compacting each agent's history:
+    the speaker selections made without an LLM call, with the prompt tokens they would have
+    sent, and per agent the prompt tokens of its replies before and after compaction.
+    '''
+
+    def __init__(self):
+        self.rule_selections = 0
+        self.llm_selections = 0
+        self.selection_tokens_saved = 0
+        self.history: Dict[str, List[int]] = {}
+
+    def record_history(self, agent: str, before: int, after: int) -> None:
+        totals = self.history.setdefault(agent, [0, 0, 0])
+        totals[0] += 1
+        totals[1] += before
+        totals[2] += after
+
+    @property
+    def history_tokens_saved(self) -> int:
+        return sum(before - after for _, before, after in self.history.values())
+
+    def report(self, seconds_per_selection: Optional[float] = None, usage: LLMUsage = llm_usage,
+               selection_step: str = "speaker_selection", chat_step: str = "group_chat") -> str:
+        '''
+        The savings as a table. Unless seconds_per_selection is given, the time saved by each
+        rule-based selection is the mean latency of the LLM speaker selections recorded in usage
+        (or, if every selection was made by rule, of the chat's replies).
+        '''
+        seconds = seconds_per_selection
+        if seconds is None:
+            seconds = usage[selection_step].mean_latency or usage[chat_step].mean_latency
+        lines = [f"Speaker selection: {self.rule_selections} by rule, {self.llm_selections} by LLM; "
+                 f"~{self.selection_tokens_saved} prompt tokens and ~{self.rule_selections * seconds:.1f}s saved",
+                 f"{'agent':<20} {'replies':>7} {'tokens before':>14} {'tokens after':>13} {'saved':>8}"]
+        for agent, (replies, before, after) in sorted(self.history.items()):
+            lines.append(f"{agent:<20} {replies:>7} {before:>14} {after:>13} {before - after:>8}")
+        lines.append(f"{'total':<20} {'':>7} {'':>14} {'':>13} {self.history_tokens_saved:>8}")
+        return "\n".join(lines)
+
+
+class SpeakerGraph:
+    '''
+    A GroupChat speaker_selection_method that picks the next speaker from a declarative graph of
+    transitions instead of asking the LLM. The transitions from the last speaker are tried in
+    order and the first one whose condition holds for its message wins. If none does (or the
+    speaker has no transitions), the choice is left to `fallback`, one of GroupChat's own
+    selection methods ("auto" asks the LLM, as before).
+
+    Example usage:
+    >>> graph = SpeakerGraph([Transition("Admin", "planner"), Transition("planner", "Critic")])
+    >>> groupchat = GroupChat(agents, messages=[], speaker_selection_method=graph)
+    '''
+
+    def __init__(self, transitions: Iterable[Transition], fallback: str = "auto",
+                 savings: Optional[ChatSavings] = None):
+        self.transitions: Dict[str, List[Transition]] = {}
+        for transition in transitions:
+            self.transitions.setdefault(transition.source, []).append(transition)
+        self.fallback = fallback
+        self.savings = savings or ChatSavings()
+
+    def __call__(self, last_speaker, groupchat):
+        message = groupchat.messages[-1] if groupchat.messages else {}
+        for transition in self.transitions.get(last_speaker.name, []):
+            if transition.when is None or transition.when(message):
+                self.savings.rule_selections += 1
+                # The selection prompt lists every agent's role and carries the whole conversation
+                self.savings.selection_tokens_saved += (estimate_tokens(groupchat.messages) +
+                                                        len(groupchat.select_speaker_msg(groupchat.agents)) // CHARS_PER_TOKEN)
+                return groupchat.agent_by_name(transition.target)
+        self.savings.llm_selections += 1
+        return self.fallback
+
+    def check(self, agents) -> None:
+        '''
+        Raises ValueError if a transition names an agent that isn't in the chat.
+        '''
+        names = {agent.name for agent in agents}
+        unknown = {name for ts in self.transitions.values() for t in ts for name in (t.source, t.target)} - names
+        if unknown:
+            raise ValueError(f"The speaker graph names agents that aren't in the chat: {', '.join(sorted(unknown))}")
+
+
+class RollingSummary:
+    '''
+    An autogen MessageTransform that bounds the history an agent is sent: the first message and
+    the last keep_last are kept, and the ones between are replaced by a single message listing
+    who said what, each cut to summary_chars characters. The summary of a message is built once
+    and reused on later turns, as the window rolls forward.
+    '''
+
+    def __init__(self, agent: str, policy: HistoryPolicy = HistoryPolicy(), savings: Optional[ChatSavings] = None):
+        self.agent = agent
+        self.policy = policy
+        self.savings = savings
+        self._lines: Dict[str, str] = {}
+
+    def _summarize(self, message: Dict) -> str:
+        content = " ".join(str(message.get("content") or "").split())
+        key = hashlib.sha1(f"{message.get('name')}\0{content}".encode()).hexdigest()
+        line = self._lines.get(key)
+        if line is None:
+            limit = self.policy.summary_chars
+            text = content if len(content) <= limit else content[:limit].rsplit(" ", 1)[0] + " ..."
+            line = self._lines[key] = f"- {message.get('name') or message.get('role')}: {text}"
+        return line
+
+    def apply_transform(self, messages: List[Dict]) -> List[Dict]:
+        keep_last = max(1, self.policy.keep_last)
+        if len(messages) <= keep_last + 2:
+            return messages
+        older, recent = messages[1:-keep_last], messages[-keep_last:]
+        # A function or tool result has to follow the call it answers
+        while recent[0].get("role") in ("tool", "function") and older:
+            recent.insert(0, older.pop())
+        if not older:
+            return messages
+        summary = {"role": "user", "content": SUMMARY_PREFIX + "\n" +
+                   "\n".join(self._summarize(m) for m in older)}
+        compacted = [messages[0], summary, *recent]
+        if self.savings:
+            self.savings.record_history(self.agent, estimate_tokens(messages), estimate_tokens(compacted))
+        return compacted
+
+    def get_logs(self, pre_transform_messages: List[Dict], post_transform_messages: List[Dict]) -> Tuple[str, bool]:
+        before, after = estimate_tokens(pre_transform_messages), estimate_tokens(post_transform_messages)
+        return (f"Compacted {len(pre_transform_messages)} messages of ~{before} tokens to "
+                f"{len(post_transform_messages)} of ~{after} tokens for {self.agent}",
+                len(post_transform_messages) < len(pre_transform_messages))
+
+
+def compact_history(agents, policies: Dict[str, HistoryPolicy], savings: Optional[ChatSavings] = None) -> None:
+    '''
+    Adds a RollingSummary of its policy to each agent named in policies, so every reply the agent
+    makes is based on a bounded history rather than on the whole conversation.
+    '''
+    # Imported here as it pulls in the autogen contrib package
+    from autogen.agentchat.contrib.capabilities.transform_messages import TransformMessages
+    for agent in agents:
+        if agent.name in policies:
+            TransformMessages(transforms=[RollingSummary(agent.name, policies[agent.name], savings)],
+                              verbose=False).add_to_agent(agent)
+
+
+# The speaker graph of the hospitalgpt.py group chat: the plan is reviewed, the criteria are
+# defined, the code is written and run (and fixed while it fails) and the emails are written
+HOSPITAL_TRANSITIONS = [
+    Transition("Admin", "hospital_planner"),
+    Transition("hospital_planner", "Critic"),
+    Transition("Critic", "hospital_planner", when=mentions("revise", "missing", "does not include", "doesn't include")),
+    Transition("Critic", "epidemiologist"),
+    Transition("epidemiologist", "data_analyst"),
+    Transition("data_analyst", "Executor", when=has_code),
+    # Without code the analyst is asking something or has given up on fixing its code
+    Transition("data_analyst", "Admin"),
+    Transition("Executor", "data_analyst", when=execution_failed),
+    Transition("Executor", "outreach_admin"),
+    Transition("outreach_admin", "Admin"),
+]
+
+# The history each agent of the hospitalgpt.py group chat is sent. The data analyst needs its
+# last code and the executor's result; the outreach admin only the patients it is given
+HOSPITAL_HISTORY = {
+    "hospital_planner": HistoryPolicy(keep_last=6),
+    "Critic": HistoryPolicy(keep_last=4),
+    "epidemiologist": HistoryPolicy(keep_last=4),
+    "data_analyst": HistoryPolicy(keep_last=4),
+    "outreach_admin": HistoryPolicy(keep_last=2),
+}
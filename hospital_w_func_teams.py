@@ -1,14 +1,23 @@
+from dotenv import load_dotenv
+# The project modules read their settings from the environment when they are imported
+load_dotenv()
 from autogen import AssistantAgent, UserProxyAgent, GroupChat, GroupChatManager, config_list_from_json
-import requests
-import datetime
-from dateutil.relativedelta import relativedelta
-from typing import List, Optional, Dict, Union
+from cohort_criteria import CohortCriteria, CriteriaStore, define_criteria, parse_criteria
+from cohort_search import iter_patients_between_ages_and_condition, iter_patients_between_ages_and_conditions
+from fhir_client import DEFAULT_MAX_IN_FLIGHT
+from llm_cache import CachedOpenAI, agent_cache, llm_usage
+from outreach_emails import generate_emails, generate_templated_emails, GenerationStats, DEFAULT_MAX_CONCURRENCY, EMAIL_BASE_URL, MODEL_DI
+from outreach_pipeline import run_outreach_pipeline
+from outreach_sinks import open_sink, OutputSink, DEFAULT_OUTPUT
+from patient_record import DEFAULT_EMAIL
+from run_journal import RunJournal
+from tracing import traced, tracer
+from typing import Iterator, List, Optional, Dict, Union
+import functools
+import time
 from openai import OpenAI
-from dotenv import load_dotenv
 import os
 
-load_dotenv()
-
 # Here is the OpenAI details that will be used for the group chat. We use GPT-4 as you need 
 # a powerful model to handle a complex conversation
 openai_config_list = config_list_from_json(
@@ -20,14 +29,26 @@ openai_config_list = config_list_from_json(
 
 # Here is the Mixtral details that will be used for generating the emails to users. 
 # We use Mixtral as it is much cheaper and can easily handle the task of writing an email.
-openai_client = OpenAI(
+# Completions are cached in .llm_cache.sqlite3 (see llm_cache), so a re-run doesn't pay for them again.
+openai_client = CachedOpenAI(OpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
-    base_url="https://api.deepinfra.com/v1/openai",
-)
+    base_url=EMAIL_BASE_URL,
+), step="outreach_emails")
+
+# Criteria are remembered per proposal in .cohort_criteria.json
+criteria_store = CriteriaStore()
+
+
+@functools.lru_cache(maxsize=None)
+def criteria_client() -> CachedOpenAI:
+    '''
+    The same GPT-4 deployment, called directly for the single structured completion that defines
+    the criteria of a new proposal. Built on first use, so the module can be imported without
+    an OAI_CONFIG_LIST.
+    '''
+    return CachedOpenAI(OpenAI(api_key=openai_config_list[0].get("api_key"),
+                               base_url=openai_config_list[0].get("base_url")), step="define_criteria")
 
-# This is where we store the list of patient details that are
-# returned from the FHIR server. We use this list when generating outreach emails
-patients = []
 
 
 """
@@ -35,9 +56,10 @@ STEP 1:
 Define the cohort criteria. This involves a group chat between the admin and the epidemiologist.
 We also include a critic who will review the criteria and ensure it meets the required fields.
 """
+@traced()
 def define_cohort_information(target_cohort) -> str:
     gpt4_config_define = {
-        "cache_seed": 42,  # change the cache_seed for different trials
+        **agent_cache("define_criteria"),  # shares the completion cache and usage of the direct calls
         "temperature": 0,
         "config_list": openai_config_list,
         "timeout": 120,
@@ -96,14 +118,52 @@ def define_cohort_information(target_cohort) -> str:
     
     return user_proxy.last_message()["content"]
 
+"""
+STEP 1 (fast path):
+Proposals that have been seen before, or that spell out the criteria themselves, skip the group chat
+completely, and a new proposal takes a single structured GPT-4 call. The group chat above is only
+used if that call doesn't return valid criteria.
+"""
+@traced()
+def define_cohort_criteria(target_cohort: str) -> Union[CohortCriteria, str]:
+    start = time.perf_counter()
+    # Stored and spelled out criteria don't need GPT-4, new proposals do
+    client, model = (criteria_client(), openai_config_list[0]["model"]) if openai_config_list else (None, "gpt-4")
+    criteria, source = define_criteria(target_cohort, client, model, criteria_store)
+    if criteria is None:
+        if not openai_config_list:
+            raise ValueError("OAI_CONFIG_LIST has no gpt-4 entry, which is needed to define the criteria of a new proposal")
+        # Fall back to the group chat and read the criteria from its answer if they can be
+        # parsed, otherwise pass the answer on as it is
+        answer = define_cohort_information(target_cohort)
+        criteria, source = parse_criteria(answer), "group chat"
+        if criteria is None:
+            print(f"Defined the cohort criteria in {time.perf_counter() - start:.1f}s ({source})")
+            return answer
+        criteria_store.put(target_cohort, criteria)
+    print(f"Defined the cohort criteria in {time.perf_counter() - start:.1f}s ({source}): {criteria}")
+    return criteria
+
 """
 STEP 2: 
 Once the definition of the cohort criteria is complete, we can start the data analysis. This
 involves using a defined function to search for patients within a FHIR R4 API server.
 """
-def find_patients(criteria: str) -> None:
+@traced()
+def find_patients(criteria: Union[CohortCriteria, str], max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> Iterator[Dict[str, Union[str, int, None]]]:
+    # Criteria that are already structured, or that can be parsed, are mapped straight onto the
+    # search. The patients are returned lazily, so they can be streamed into email writing while
+    # the search is still running
+    if isinstance(criteria, str):
+        criteria = parse_criteria(criteria) or criteria
+    if isinstance(criteria, CohortCriteria):
+        return iter_patients_between_ages_and_conditions(criteria.min_age, criteria.max_age, criteria.conditions,
+                                                         default_email=DEFAULT_EMAIL, max_in_flight=max_in_flight)
+
+    # Otherwise the criteria are ambiguous, so GPT-4 reads them and calls the search function
+    found: List[Dict[str, Union[str, int, None]]] = []
     gpt4_config_data = {
-    "cache_seed": 42,  # change the cache_seed for different trials
+    **agent_cache("find_patients"),  # shares the completion cache and usage of the direct calls
     "temperature": 0,
     "functions": [
         {
@@ -149,7 +209,8 @@ def find_patients(criteria: str) -> None:
                 "content", "").rstrip().endswith("TERMINATE"),
         human_input_mode="TERMINATE",
         function_map={
-                "get_patients_between_ages_and_condition": get_patients_between_ages_and_condition,
+                "get_patients_between_ages_and_condition": functools.partial(get_patients_between_ages_and_condition,
+                                                                             max_in_flight=max_in_flight, found=found),
         },
         )
 
@@ -164,14 +225,10 @@ def find_patients(criteria: str) -> None:
         llm_config=gpt4_config_data,
     )
 
-    #user_proxy.initiate_chat(
-    #   data_analyst, message=f"{cohort_definition}")
-
-    ## Injecting in some text in order to find an actual patient to match the criteria
     user_proxy.initiate_chat(
-    data_analyst, message=f"patients aged between 100 and 105 with Hyperglycemia")
+       data_analyst, message=f"{criteria}")
 
-    return
+    return iter(found)
 
 """
 STEP 2.1: 
@@ -179,102 +236,109 @@ This is a helper function to get the patient details from a FHIR R4 API server b
 on the patient's birthdate and the condition name.
 This function is used by the data analyst.
 """
-def get_patients_between_ages_and_condition(min_age: int, max_age: int, condition: str) -> List[Dict[str, Union[str, int, None]]]:
-    today = datetime.date.today()
-    max_birthdate = today - relativedelta(years=min_age)
-    max_birthdate = max_birthdate.strftime('%Y-%m-%d')
-
-    min_birthdate = today - relativedelta(years=max_age + 1)
-    min_birthdate = min_birthdate.strftime('%Y-%m-%d')
-
-    # Get conditions
-    r = requests.get(f'https://hapi.fhir.org/baseR4/Condition?_pretty=true&subject.birthdate=le{max_birthdate}&subject.birthdate=gt{min_birthdate}')
-    conditions = r.json()
-        
-    # Check if conditions is empty
-    if 'entry' not in conditions or not conditions['entry']:
-        # Handle the empty conditions case, you can return an empty list or raise an exception
+@traced()
+def get_patients_between_ages_and_condition(min_age: int, max_age: int, condition: str, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                                            found: Optional[List] = None) -> Union[List[Dict[str, Union[str, int, None]]], str]:
+    # Read every page of the search, resolving the patients of each page as it arrives
+    matches = list(iter_patients_between_ages_and_condition(min_age, max_age, condition,
+                                                            default_email=DEFAULT_EMAIL,
+                                                            max_in_flight=max_in_flight))
+    # Keep the patients for find_patients to return, since the chat only passes them to GPT-4
+    if found is not None:
+        found.extend(matches)
+
+    # Check if any patients were found
+    if not matches:
+        # Handle the empty case, you can return an empty list or raise an exception
         return "No patients match the given criteria"
-    
-    # Filter out the conditions where the 'code' key does not exist
-    entries = [entry for entry in conditions['entry'] if 'code' in entry['resource']]
-    # Filter by condition
-    filtered_conditions = [entry for entry in entries
-        if any(condition.lower() in cond['display'].lower() for cond in entry['resource']['code']['coding'])]
-    # Get patient data for each condition
-    for cond in filtered_conditions:
-      patient_id = cond['resource']['subject']['reference'].split('/')[1]
-      r = requests.get(f'https://hapi.fhir.org/baseR4/Patient/{patient_id}?_pretty=true')
-      patient = r.json()
-
-      if 'telecom' in patient and 'maritalStatus' in patient:
-          full_name = patient['name'][0]['given'][0] + " " + patient['name'][0]['family']
-          email = next((t['value'] for t in patient['telecom'] if t['system'] == 'email'), "test@test.com")
-
-          # Check for 'type' key in each identifier before accessing its value
-          mrn = next((i['value'] for i in patient['identifier'] if 'type' in i and i['type']['text'] == 'Medical Record Number'), None)
-          patient_age = relativedelta(datetime.datetime.now(), datetime.datetime.strptime(patient['birthDate'], '%Y-%m-%d')).years
-          patient_condition = cond['resource']['code']['coding'][0]['display']
-          # Get postal code
-          postal_code = patient['address'][0]['postalCode'] if 'address' in patient and patient['address'] else None
-
-          patients.append(
-              {
-                  'patient_url': f"https://hapi.fhir.org/baseR4/Patient/{patient_id}?_pretty=true",
-                  'full_name': full_name,
-                  'age': patient_age,
-                  'postal_code': postal_code,
-                  'MRN': mrn,
-                  'email': email,
-                  'condition': patient_condition
-              }
-          )
-    return patients
+    return matches
 
 """
 STEP 3: 
 This is a function which generates the emails for the patients.
 """
-def write_outreach_emails(patient_details: List, user_proposal: str) -> None:
-    MODEL_DI = "mistralai/Mixtral-8x7B-Instruct-v0.1"
+@traced()
+def write_outreach_emails(patient_details: List, user_proposal: str, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                          requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                          templated: bool = False, personalize: bool = False,
+                          output: str = DEFAULT_OUTPUT, output_format: Optional[str] = None,
+                          journal: Optional[RunJournal] = None) -> None:
     # Check if patient_details has any values before continuing
     if not patient_details:
         print("No patients found")
         return
-    for patient in patient_details:
-        chat_completion = openai_client.chat.completions.create(
-            model=MODEL_DI,
-            messages=[{"role": "user", "content": "Write an email to the patient named " + patient["full_name"] + 
-                       " to arrange a screening based on the following  " +user_proposal+ 
-                       "because they have previously had " + patient["condition"] + "."}],
-            stream=False,
-            # top_p=0.5,
-        )
+    # The emails are written concurrently, up to max_concurrency at a time, and each one is saved as
+    # soon as its completion arrives. A patient whose completion keeps failing is reported and skipped.
+    # With templated=True one email is written per condition and filled in with each patient's name
+    # (and optionally personalized for each patient afterwards) instead of one completion per patient.
+    # The emails are saved to out.csv by default; see outreach_sinks.open_sink for the other formats,
+    # including the original one text file per patient.
+    # With a journal, the emails written by an earlier run that died are saved again and only the
+    # remaining patients are written.
+    stats = GenerationStats()
+    generate = generate_templated_emails if templated else generate_emails
+    options = {"personalize": personalize} if templated else {}
+    with open_sink(output, output_format) as sink:
+        if journal:
+            journal.replay(sink)
+            patient_details = list(journal.pending(patient_details))
+        for result in generate(openai_client, patient_details, user_proposal, model=MODEL_DI,
+                               max_concurrency=max_concurrency, requests_per_minute=requests_per_minute,
+                               tokens_per_minute=tokens_per_minute, stats=stats, **options):
+            save_outreach_email(sink, result, journal)
+
+    print(stats.report())
+    return
 
-        # Write each individuals email into a text file. Call the file with the patient MRN and add the name, MRN, postcode and email
-        # address into the start of the text file
-        with open(f"{patient['MRN']}.txt", "w") as f:
-            f.write(f"Name: {patient['full_name']}\n")
-            f.write(f"MRN: {patient['MRN']}\n")
-            f.write(f"Postcode: {patient['postal_code']}\n")
-            f.write(f"Email: {patient['email']}\n")
-            f.write("\n")
-            f.write(f"Patient: {patient['patient_url']}\n")
-            f.write(chat_completion.choices[0].message.content)
-            f.write("\n")
-            f.write("-----------------------------------------")
-            
 
-        
-        
-    return
+@traced()
+def stream_outreach_emails(found_patients, user_proposal: str, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                           requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                           templated: bool = False, personalize: bool = False,
+                           output: str = DEFAULT_OUTPUT, output_format: Optional[str] = None,
+                           journal: Optional[RunJournal] = None):
+    # The streaming form of write_outreach_emails: the search, the email completions and the file
+    # writing run at the same time, joined by bounded queues, and each stage reports its throughput
+    stats = GenerationStats()
+    with open_sink(output, output_format) as sink:
+        if journal:
+            journal.replay(sink)
+            found_patients = journal.pending(found_patients)
+        pipeline_stats = run_outreach_pipeline(openai_client, found_patients, user_proposal,
+                                               functools.partial(save_outreach_email, sink, journal=journal),
+                                               model=MODEL_DI, max_concurrency=max_concurrency,
+                                               requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute,
+                                               templated=templated, personalize=personalize, stats=stats)
+    print(pipeline_stats.report())
+    print(stats.report())
+    return pipeline_stats
+
+
+def save_outreach_email(sink: OutputSink, result, journal: Optional[RunJournal] = None) -> None:
+    if result.content is None:
+        print(f"Failed to write the email for {result.patient['full_name']} after {result.attempts} attempts: {result.error}")
+    with tracer.span("save_outreach_email") as span:
+        sink.write(result)
+        span.add("emails.saved").add("emails.bytes", len((result.content or "").encode()))
+        # Only journaled once it is saved, so a resumed run never skips an email that was lost
+        if journal and result.content is not None:
+            journal.record_email(result.patient, result.content)
 
 
 # Define the diagnostic screening we wish to perform
 user_proposal = "Find patients for colonoscopy screening"
+# The run is journaled in .run_journals/, so if it dies it resumes where it stopped: the criteria,
+# the patients already found and the emails already written are not asked for again
+journal = RunJournal.open(user_proposal)
+if journal.resumed:
+    print(f"Resuming the run from {journal.path}: {len(journal.patients)} patients found"
+          f"{' (search complete)' if journal.cohort_complete else ''}, {len(journal.emails)} emails written")
 # Define the cohort information based on the user's proposal
-criteria_definition = define_cohort_information(user_proposal)
-# Find the patients based on the criteria
-find_patients(criteria_definition)
-# Write the emails to the patients
-write_outreach_emails(patients, user_proposal)
+criteria_definition = journal.criteria or journal.record_criteria(define_cohort_criteria(user_proposal))
+# Find the patients based on the criteria and write each patient's email as soon as the search finds them
+stream_outreach_emails(journal.cohort(lambda: find_patients(criteria_definition)), user_proposal, journal=journal)
+journal.finish()
+# LLM calls, tokens, latency and cache hits of each step
+print(llm_usage.report())
+# Where the run's time went: the steps, FHIR requests, LLM calls and file writes that took longest
+print(tracer.report())
@@ -1,4 +1,11 @@
+from dotenv import load_dotenv
+load_dotenv()
 from autogen import AssistantAgent, UserProxyAgent, GroupChat, GroupChatManager, config_list_from_json
+from group_chat_policy import ChatSavings, SpeakerGraph, compact_history, HOSPITAL_HISTORY, HOSPITAL_TRANSITIONS
+from llm_cache import agent_cache, llm_usage
+from query_library import CRITERIA_INSTRUCTION, QueryLibrary, QueryReuse
+from tracing import tracer
+from warm_executor import WarmPythonExecutor
 
 openai_config_list = config_list_from_json(
     "OAI_CONFIG_LIST",
@@ -15,14 +22,14 @@ mixtral_config_list = config_list_from_json(
 )
 
 gpt4_config = {
-    "cache_seed": 42,  # change the cache_seed for different trials
+    **agent_cache("group_chat"),  # completions are cached in .llm_cache.sqlite3; see llm_cache
     "temperature": 0,
     "config_list": openai_config_list,
     "timeout": 120,
 }
 
 mixtral_config = {
-    "cache_seed": 42,  # change the cache_seed for different trials
+    **agent_cache("outreach_emails"),
     "temperature": 0,
     "config_list": mixtral_config_list,
     "timeout": 120,
@@ -83,25 +90,35 @@ data_analyst = AssistantAgent(
     If the error can't be fixed or if the task is not solved even after the code is executed successfully, 
     analyze the problem, revisit your assumption, collect additional info you need, and think of a different approach to try. 
     Save the output to a file called patients.csv.
-    """,
+    """ + CRITERIA_INSTRUCTION,
     llm_config=gpt4_config,
 )
 
+# The executor runs the code in a worker process that stays up for the whole chat, so each run
+# doesn't start a new interpreter and import requests again
+warm_executor = WarmPythonExecutor(work_dir="groupchat")
 executor = UserProxyAgent(
     name="Executor",
     system_message="""
         Executor. Execute the code written by the data analyst and report the result.
     """,
     human_input_mode="NEVER",
-    code_execution_config={"last_n_messages": 3, "work_dir": "groupchat"},
+    code_execution_config={"last_n_messages": 3, "executor": warm_executor},
 )
 
+# Queries that ran successfully are kept in .query_library.json by their criteria. Once the
+# epidemiologist has given the criteria, the data analyst answers with the stored query instead
+# of writing a new one, and it stops fixing code that has failed 3 times in a row
+query_reuse = QueryReuse(QueryLibrary())
+query_reuse.attach(data_analyst, warm_executor)
+
 outreach_admin = AssistantAgent(
     name="outreach_admin",
     system_message="""
     Outreach administrator. You are an expert in the healthcare system. You take the list of patients the patients.csv file and create a personalized 
     email to send to each patient. 
-    You output a csv file called out.csv which contains the patient ids, names, email addresses and the text of the email you just created.
+    You output a csv file called out.csv which contains the patient ids, names, email addresses and the text of the email you just created,
+    with the columns MRN, full_name, email, postal_code, condition, patient_url and email_text.
     """,
     llm_config=mixtral_config,
 )
@@ -115,15 +132,33 @@ critic = AssistantAgent(
     llm_config=gpt4_config,
 )
 
-# Create groupchat
-groupchat = GroupChat(
-    agents=[user_proxy, planner, epidemiologist, data_analyst, executor, outreach_admin, critic], messages=[])
-manager = GroupChatManager(groupchat=groupchat, llm_config=gpt4_config)
-
-
-user_proxy.initiate_chat(
-    manager,
-    message="""
-    Contact all the patients that need a colonoscopy screening.
-    """,
-)
\ No newline at end of file
+# Create groupchat. The next speaker is picked from a fixed graph of transitions (see
+# group_chat_policy.HOSPITAL_TRANSITIONS) without an LLM call; GPT-4 is only asked when no rule
+# applies. Each agent is sent the task, a summary of the older messages and its last few messages
+# instead of the whole conversation.
+chat_savings = ChatSavings()
+agents = [user_proxy, planner, epidemiologist, data_analyst, executor, outreach_admin, critic]
+speaker_graph = SpeakerGraph(HOSPITAL_TRANSITIONS, savings=chat_savings)
+speaker_graph.check(agents)
+compact_history(agents, HOSPITAL_HISTORY, chat_savings)
+groupchat = GroupChat(agents=agents, messages=[], speaker_selection_method=speaker_graph)
+manager = GroupChatManager(groupchat=groupchat, llm_config={**gpt4_config, **agent_cache("speaker_selection")})
+
+
+with tracer.span("group_chat", agents=len(agents)) as chat_span:
+    user_proxy.initiate_chat(
+        manager,
+        message="""
+        Contact all the patients that need a colonoscopy screening.
+        """,
+    )
+    chat_span.add("chat.turns", len(groupchat.messages))
+
+# LLM calls, tokens, latency and cache hits of each step, and what the speaker graph and the
+# history compaction saved
+print(llm_usage.report())
+print(chat_savings.report())
+print(query_reuse.report())
+# Where the chat's time went: the LLM calls of each agent, the code executions and the FHIR requests
+print(tracer.report())
+warm_executor.close()
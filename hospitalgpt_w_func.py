@@ -1,8 +1,10 @@
-from autogen import AssistantAgent, UserProxyAgent, GroupChat, GroupChatManager, config_list_from_json
-import requests
-import datetime
-from dateutil.relativedelta import relativedelta
-from typing import List, Optional, Dict, Union
+from dotenv import load_dotenv
+load_dotenv()
+from autogen import AssistantAgent, UserProxyAgent, config_list_from_json
+from cohort_search import iter_patients_between_ages_and_condition
+from fhir_client import DEFAULT_MAX_IN_FLIGHT
+from llm_cache import agent_cache, llm_usage
+from typing import List, Dict, Union
 
 
 openai_config_list = config_list_from_json(
@@ -13,7 +15,7 @@ openai_config_list = config_list_from_json(
 )
 
 gpt4_config = {
-    "cache_seed": 42,  # change the cache_seed for different trials
+    **agent_cache("find_patients"),  # completions are cached in .llm_cache.sqlite3; see llm_cache
     "temperature": 0,
     "functions": [
         {
@@ -53,52 +55,9 @@ gpt4_config = {
 }
 
 
-def get_patients_between_ages_and_condition(min_age: int, max_age: int, condition: str) -> List[Dict[str, Union[str, int, None]]]:
-    today = datetime.date.today()
-    max_birthdate = today - relativedelta(years=min_age)
-    max_birthdate = max_birthdate.strftime('%Y-%m-%d')
-
-    min_birthdate = today - relativedelta(years=max_age + 1)
-    min_birthdate = min_birthdate.strftime('%Y-%m-%d')
-    
-    # Get conditions
-    r = requests.get(f'https://hapi.fhir.org/baseR4/Condition?_pretty=true&subject.birthdate=le{max_birthdate}&subject.birthdate=gt{min_birthdate}')
-    conditions = r.json()
-    # Filter out the conditions where the 'code' key does not exist
-    entries = [entry for entry in conditions['entry'] if 'code' in entry['resource']]
-    # Filter by condition
-    filtered_conditions = [entry for entry in entries
-        if any(condition.lower() in cond['display'].lower() for cond in entry['resource']['code']['coding'])]
-    patients = []
-    # Get patient data for each condition
-    for cond in filtered_conditions:
-      patient_id = cond['resource']['subject']['reference'].split('/')[1]
-      r = requests.get(f'https://hapi.fhir.org/baseR4/Patient/{patient_id}?_pretty=true')
-      patient = r.json()
-      
-      if 'telecom' in patient and 'maritalStatus' in patient:
-          full_name = patient['name'][0]['given'][0] + " " + patient['name'][0]['family']
-          email = next((t['value'] for t in patient['telecom'] if t['system'] == 'email'), None)
-
-          # Check for 'type' key in each identifier before accessing its value
-          mrn = next((i['value'] for i in patient['identifier'] if 'type' in i and i['type']['text'] == 'Medical Record Number'), None)
-          patient_age = relativedelta(datetime.datetime.now(), datetime.datetime.strptime(patient['birthDate'], '%Y-%m-%d')).years
-          patient_condition = cond['resource']['code']['coding'][0]['display']
-          # Get postal code
-          postal_code = patient['address'][0]['postalCode'] if 'address' in patient and patient['address'] else None
-            
-          patients.append(
-              {
-                  'patient_url': f"https://hapi.fhir.org/baseR4/Patient/{patient_id}?_pretty=true",
-                  'full_name': full_name,
-                  'age': patient_age,
-                  'postal_code': postal_code,
-                  'MRN': mrn,
-                  'email': email,
-                  'condition': patient_condition
-              }
-          )
-    return patients
+def get_patients_between_ages_and_condition(min_age: int, max_age: int, condition: str, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> List[Dict[str, Union[str, int, None]]]:
+    # Read every page of the search, resolving the patients of each page as it arrives
+    return list(iter_patients_between_ages_and_condition(min_age, max_age, condition, max_in_flight=max_in_flight))
 
 
 user_proxy = UserProxyAgent(
@@ -121,3 +80,5 @@ data_analyst = AssistantAgent(
 user_proxy.initiate_chat(
     data_analyst, message="Find all the patients aged between 100 and 105 with Hyperglycemia")
 
+# LLM calls, tokens, latency and cache hits
+print(llm_usage.report())
@@ -0,0 +1,355 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+from typing import Any, Deque, Dict, NamedTuple, Optional, Tuple
+
+from tracing import tracer
+
+# Persistent cache of LLM completions, so a re-run or a retried step makes no API calls for the
+# prompts it has already sent. Set LLM_CACHE_PATH to an empty string to turn it off.
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".llm_cache.sqlite3")
+# Size of the cache on disk before the least recently used completions are evicted
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+# Number of recent calls kept by LLMUsage
+MAX_CALLS = 10000
+
+
+def completion_key(params: Dict[str, Any]) -> str:
+    '''
+    The cache key of a completion request: the model and a hash of the messages and the other
+    parameters, e.g. "gpt-4:3f2a...". Requests that differ in any parameter get different keys.
+    '''
+    body = json.dumps(params, sort_keys=True, default=str)
+    return f"{params.get('model', '')}:{hashlib.sha256(body.encode()).hexdigest()}"
+
+
+class LLMCall(NamedTuple):
+    '''
+    One completion: the pipeline step it was made for, how long it took (including waiting for
+    the cache), its tokens and whether it came from the cache, in which case no tokens were spent.
+    '''
+    step: str
+    model: str
+    seconds: float
+    prompt_tokens: int
+    completion_tokens: int
+    cached: bool
+
+
+class StepUsage:
+    '''
+    The completions of one pipeline step added up. Tokens of cached completions are counted in
+    tokens_saved rather than in prompt_tokens and completion_tokens.
+    '''
+
+    def __init__(self, step: str):
+        self.step = step
+        self.calls = 0
+        self.cached = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.tokens_saved = 0
+        self.seconds = 0.0
+
+    def add(self, call: LLMCall) -> None:
+        self.calls += 1
+        self.seconds += call.seconds
+        if call.cached:
+            self.cached += 1
+            self.tokens_saved += call.prompt_tokens + call.completion_tokens
+        else:
+            self.prompt_tokens += call.prompt_tokens
+            self.completion_tokens += call.completion_tokens
+
+    @property
+    def api_calls(self) -> int:
+        return self.calls - self.cached
+
+    @property
+    def mean_latency(self) -> float:
+        return self.seconds / self.calls if self.calls else 0.0
+
+
+class LLMUsage:
+    '''
+    Records every completion made through complete(), a CachedOpenAI client or an agent's
+    AgentCache, and adds them up per pipeline step. calls keeps the most recent MAX_CALLS.
+
+    Example usage:
+    >>> CachedOpenAI(openai_client, step="emails").chat.completions.create(model=MODEL_DI, messages=[...])
+    >>> print(llm_usage.report())
+    '''
+
+    def __init__(self):
+        self.calls: Deque[LLMCall] = deque(maxlen=MAX_CALLS)
+        self.steps: Dict[str, StepUsage] = {}
+        self._lock = threading.Lock()
+
+    def record(self, call: LLMCall) -> None:
+        with self._lock:
+            self.calls.append(call)
+            self.steps.setdefault(call.step, StepUsage(call.step)).add(call)
+        # Every LLM call passes through here, so this is where they are traced
+        tracer.record(f"LLM {call.step}", call.seconds, {"llm.calls": 1, "llm.cached": int(call.cached),
+                                                         "llm.prompt_tokens": call.prompt_tokens,
+                                                         "llm.completion_tokens": call.completion_tokens},
+                      model=call.model, cached=call.cached)
+
+    def __getitem__(self, step: str) -> StepUsage:
+        return self.steps.get(step) or StepUsage(step)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.steps.clear()
+
+    def report(self) -> str:
+        lines = [f"{'step':<20} {'calls':>6} {'cached':>7} {'prompt tok':>11} {'completion tok':>15} "
+                 f"{'tok saved':>10} {'mean s':>7}"]
+        for s in list(self.steps.values()):
+            lines.append(f"{s.step:<20} {s.calls:>6} {s.cached:>7} {s.prompt_tokens:>11} {s.completion_tokens:>15} "
+                         f"{s.tokens_saved:>10} {s.mean_latency:>7.2f}")
+        return "\n".join(lines)
+
+
+def _tokens(completion) -> Tuple[int, int]:
+    usage = getattr(completion, "usage", None)
+    return (getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
+
+
+class CompletionCache:
+    '''
+    A persistent cache of chat completions, stored in a sqlite database, shared by the direct
+    OpenAI client calls (see CachedOpenAI) and the autogen agents (see for_step()).
+
+    Completions are kept whole (pickled), keyed by completion_key, so a hit returns the same
+    object the API did. Once the cache is larger than max_bytes the least recently used
+    completions are evicted. stats counts hits, misses and evictions.
+
+    Only open cache files you created: loading a completion unpickles it.
+    '''
+
+    def __init__(self, path: str = LLM_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES,
+                 usage: Optional[LLMUsage] = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.usage = usage if usage is not None else llm_usage
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS completions_accessed_at ON completions (accessed_at)")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return default
+            self._db.execute("UPDATE completions SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self.stats["hits"] += 1
+        try:
+            return pickle.loads(row[0])
+        except Exception:
+            # Written by an incompatible version of the client library
+            return default
+
+    def set(self, key: str, value: Any) -> None:
+        try:
+            body = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+        with self._lock:
+            old = self._db.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                             (key, body, time.time(), len(body)))
+            self._size += len(body) - (old[0] if old else 0)
+            self._evict()
+
+    def _evict(self) -> None:
+        # Drop the least recently used completions until the cache fits in max_bytes again
+        while self._size > self.max_bytes:
+            rows = self._db.execute("SELECT key, size FROM completions ORDER BY accessed_at LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self._size -= size
+                self.stats["evictions"] += 1
+                if self._size <= self.max_bytes:
+                    break
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM completions")
+            self._size = 0
+
+    def size(self) -> int:
+        return self._size
+
+    def for_step(self, step: str) -> "AgentCache":
+        '''
+        The cache for the agents of one pipeline step, to put in their llm_config as "cache"
+        (in place of cache_seed). Their completions are recorded in usage under the step.
+        '''
+        return AgentCache(self, step)
+
+
+class AgentCache:
+    '''
+    A CompletionCache as autogen's cache interface (get, set and a context manager), recording
+    each completion in the cache's usage. autogen looks the request up with get and, on a miss,
+    calls set with the response once it has arrived, from the same thread; the time between
+    the two is the call's latency.
+    '''
+
+    def __init__(self, cache: CompletionCache, step: str):
+        self.cache = cache
+        self.step = step
+        self._pending = threading.local()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        start = time.perf_counter()
+        value = self.cache.get(_agent_key(key), None)
+        if value is None:
+            self._pending.start = start
+            return default
+        self.cache.usage.record(LLMCall(self.step, getattr(value, "model", "") or "", time.perf_counter() - start,
+                                        *_tokens(value), cached=True))
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        start = getattr(self._pending, "start", None)
+        self._pending.start = None
+        self.cache.set(_agent_key(key), value)
+        if start is not None:
+            self.cache.usage.record(LLMCall(self.step, getattr(value, "model", "") or "",
+                                            time.perf_counter() - start, *_tokens(value), cached=False))
+
+    def close(self) -> None:
+        # The cache outlives each completion; autogen closes it after every call
+        pass
+
+    def __enter__(self) -> "AgentCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+    def __deepcopy__(self, memo) -> "AgentCache":
+        # llm_config dicts are copied by the agents; every copy must share the one cache
+        return self
+
+
+def _agent_key(key: str) -> str:
+    # autogen's keys are the JSON of the whole request; store them hashed like completion_key
+    try:
+        params = json.loads(key)
+    except ValueError:
+        params = {}
+    model = params.get("model", "") if isinstance(params, dict) else ""
+    return f"{model}:{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def complete(openai_client, step: str = "default", cache: Optional[CompletionCache] = None,
+             usage: Optional[LLMUsage] = None, **params) -> Any:
+    '''
+    Requests a chat completion through the cache: a request made before (to the same endpoint)
+    returns the stored completion without an API call. Every call is recorded in usage under the
+    step. Errors are raised as from openai_client.chat.completions.create, and failed requests
+    aren't cached.
+
+    Parameters:
+    openai_client: An OpenAI (or OpenAI-compatible) client.
+    step (str): The pipeline step the completion is for, e.g. "emails".
+    cache (CompletionCache): The cache to use, or None to only record the call.
+    usage (LLMUsage): Defaults to the cache's usage, or the shared usage.
+    params: The arguments of chat.completions.create, e.g. model and messages.
+    '''
+    usage = usage if usage is not None else (cache.usage if cache is not None else llm_usage)
+    start = time.perf_counter()
+    key = completion_key({**params, "base_url": str(getattr(openai_client, "base_url", ""))})
+    completion = cache.get(key) if cache is not None else None
+    cached = completion is not None
+    if not cached:
+        completion = openai_client.chat.completions.create(**params)
+        if cache is not None:
+            cache.set(key, completion)
+    usage.record(LLMCall(step, params.get("model", ""), time.perf_counter() - start, *_tokens(completion), cached))
+    return completion
+
+
+class CachedOpenAI:
+    '''
+    Wraps an OpenAI client so that chat.completions.create goes through complete(), with the
+    shared default_cache() unless another cache is given. Everything else is passed through to
+    the wrapped client, so it can be used wherever the client is.
+
+    Example usage:
+    >>> openai_client = CachedOpenAI(OpenAI(), step="emails")
+    >>> openai_client.chat.completions.create(model=MODEL_DI, messages=[...])
+    '''
+
+    def __init__(self, openai_client, step: str = "default", cache: Optional[CompletionCache] = None,
+                 usage: Optional[LLMUsage] = None):
+        self.client = openai_client
+        self.step = step
+        self.cache = cache if cache is not None else default_cache()
+        self.usage = usage
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **params) -> Any:
+        return complete(self.client, self.step, self.cache, self.usage, **params)
+
+    def for_step(self, step: str) -> "CachedOpenAI":
+        return CachedOpenAI(self.client, step, self.cache, self.usage)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client, name)
+
+
+def agent_cache(step: str) -> Dict[str, Any]:
+    '''
+    The llm_config entries that make a step's autogen agents use the shared cache, in place of
+    cache_seed. With the cache turned off (LLM_CACHE_PATH empty) the agents don't cache either.
+
+    Example usage:
+    >>> gpt4_config = {**agent_cache("define_criteria"), "temperature": 0, "config_list": config_list}
+    '''
+    cache = default_cache()
+    return {"cache": cache.for_step(step)} if cache is not None else {"cache_seed": None}
+
+
+# Completions made by all of the scripts, per step
+llm_usage = LLMUsage()
+
+_default_cache: Optional[CompletionCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache() -> Optional[CompletionCache]:
+    '''
+    The cache at LLM_CACHE_PATH shared by all of the scripts, opened on first use, or None if
+    LLM_CACHE_PATH is empty.
+    '''
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None and LLM_CACHE_PATH:
+            _default_cache = CompletionCache(LLM_CACHE_PATH)
+        return _default_cache
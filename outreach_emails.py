@@ -0,0 +1,299 @@
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+# Model used to write the outreach emails
+MODEL_DI = "mistralai/Mixtral-8x7B-Instruct-v0.1"
+# OpenAI-compatible endpoint serving MODEL_DI
+EMAIL_BASE_URL = os.getenv("EMAIL_BASE_URL", "https://api.deepinfra.com/v1/openai")
+# Default number of completions requested at the same time
+DEFAULT_MAX_CONCURRENCY = 8
+# Default number of patients queued for generate_emails on top of the completions in flight
+DEFAULT_MAX_PENDING = 64
+# Default number of extra attempts for a patient whose completion fails
+DEFAULT_MAX_RETRIES = 3
+# Seconds to wait before the first retry; doubled for every retry after that
+RETRY_BACKOFF = 1.0
+# Tokens a completion is assumed to use on top of its prompt when budgeting tokens per minute
+EXPECTED_COMPLETION_TOKENS = 400
+# Placeholder the model writes where the patient's name goes in a template email
+NAME_SLOT = "[PATIENT_NAME]"
+
+
+class RateLimiter:
+    '''
+    Limits how many requests and tokens are sent per minute, shared by all worker threads.
+
+    Both budgets refill continuously, so up to a minute's worth can be spent in a burst and
+    after that requests are spaced out evenly. A limit of None means no limit.
+    '''
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = requests_per_minute or 0.0
+        self._tokens = tokens_per_minute or 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0) -> None:
+        '''
+        Blocks until one request of the given number of tokens fits within both limits.
+        '''
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed = now - self._updated
+                self._updated = now
+                wait = 0.0
+                if self.requests_per_minute:
+                    self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+                    wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute:
+                    self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+                if wait <= 0:
+                    if self.requests_per_minute:
+                        self._requests -= 1
+                    if self.tokens_per_minute:
+                        self._tokens -= tokens
+                    return
+            time.sleep(wait)
+
+
+class GenerationStats:
+    '''
+    Counts for one run of email generation: the emails written and failed, the completions
+    requested (including retries), the tokens they used as reported by the API and the wall
+    time, so runs in different modes can be compared.
+    '''
+
+    def __init__(self):
+        self.emails = 0
+        self.failed = 0
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, llm_calls: int = 0, emails: int = 0, failed: int = 0,
+            prompt_tokens: int = 0, completion_tokens: int = 0) -> None:
+        with self._lock:
+            self.llm_calls += llm_calls
+            self.emails += emails
+            self.failed += failed
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def add_usage(self, completion) -> None:
+        # Token counts of a chat completion, if the API reported them
+        usage = getattr(completion, "usage", None)
+        if usage:
+            self.add(prompt_tokens=usage.prompt_tokens or 0, completion_tokens=usage.completion_tokens or 0)
+
+    @property
+    def calls_saved(self) -> int:
+        # Compared with one completion per patient
+        return max(0, self.emails + self.failed - self.llm_calls)
+
+    def report(self) -> str:
+        return (f"Wrote {self.emails} emails ({self.failed} failed) with {self.llm_calls} LLM calls "
+                f"({self.calls_saved} saved, {self.prompt_tokens + self.completion_tokens} tokens) in {self.seconds:.1f}s")
+
+
+class EmailResult(NamedTuple):
+    '''
+    The outcome of writing one patient's email. content is None and error is set if every attempt failed.
+    '''
+    patient: Dict
+    content: Optional[str]
+    error: Optional[Exception]
+    attempts: int
+    latency: float
+
+
+def email_prompt(patient: Dict, user_proposal: str) -> str:
+    return ("Write an email to the patient named " + patient["full_name"] +
+            " to arrange a screening based on the following  " + user_proposal +
+            "because they have previously had " + patient["condition"] + ".")
+
+
+def template_prompt(condition: str, user_proposal: str) -> str:
+    return ("Write an email to the patient named " + NAME_SLOT +
+            " to arrange a screening based on the following  " + user_proposal +
+            "because they have previously had " + condition + ". Write " + NAME_SLOT +
+            " exactly where the patient's name should appear.")
+
+
+def personalize_prompt(email: str, patient: Dict) -> str:
+    return ("Rewrite the following email so that it reads as if it was written personally for " +
+            patient["full_name"] + ". Keep the content, facts and length the same.\n\n" + email)
+
+
+def render_template(template: str, patient: Dict) -> str:
+    return template.replace(NAME_SLOT, patient["full_name"])
+
+
+def is_template(content: Optional[str]) -> bool:
+    # A template the model wrote without NAME_SLOT would give every patient the same unnamed email
+    return content is not None and NAME_SLOT in content
+
+
+def complete(openai_client, prompt: str, model: str, rate_limiter: Optional[RateLimiter],
+             max_retries: int, stats: Optional[GenerationStats]) -> Tuple[Optional[str], Optional[Exception], int]:
+    '''
+    Requests one completion of a prompt, retrying with exponential backoff, and counts it in stats.
+    Returns (content, error, attempts); content is None if every attempt failed.
+    '''
+    error = None
+    for attempt in range(1, max_retries + 2):
+        if rate_limiter:
+            rate_limiter.acquire(len(prompt) // 4 + EXPECTED_COMPLETION_TOKENS)
+        if stats:
+            stats.add(llm_calls=1)
+        try:
+            chat_completion = openai_client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                stream=False,
+                # top_p=0.5,
+            )
+            if stats:
+                stats.add_usage(chat_completion)
+            return chat_completion.choices[0].message.content, None, attempt
+        except Exception as e:
+            error = e
+            if attempt <= max_retries:
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+    return None, error, max_retries + 1
+
+
+def email_result(patient: Dict, content: Optional[str], error: Optional[Exception], attempts: int, start: float,
+                 stats: Optional[GenerationStats]) -> EmailResult:
+    '''
+    The EmailResult of a patient whose email took from `start` until now, counted in stats.
+    '''
+    if stats:
+        stats.add(emails=content is not None, failed=content is None)
+    return EmailResult(patient, content, error, attempts, time.perf_counter() - start)
+
+
+def write_email(openai_client, patient: Dict, user_proposal: str, model: str = MODEL_DI,
+                rate_limiter: Optional[RateLimiter] = None, max_retries: int = DEFAULT_MAX_RETRIES,
+                stats: Optional[GenerationStats] = None) -> EmailResult:
+    '''
+    Asks the model for one patient's email, retrying with exponential backoff if the request fails.
+    Never raises; a failure is returned in the EmailResult.
+    '''
+    start = time.perf_counter()
+    content, error, attempts = complete(openai_client, email_prompt(patient, user_proposal), model,
+                                        rate_limiter, max_retries, stats)
+    return email_result(patient, content, error, attempts, start, stats)
+
+
+def personalize_email(openai_client, patient: Dict, email: str, model: str = MODEL_DI,
+                      rate_limiter: Optional[RateLimiter] = None, max_retries: int = DEFAULT_MAX_RETRIES,
+                      stats: Optional[GenerationStats] = None) -> EmailResult:
+    '''
+    Asks the model to personalize an email rendered from a template. Falls back to the rendered
+    email if the model can't be reached, since that is still a complete email.
+    '''
+    start = time.perf_counter()
+    content, error, attempts = complete(openai_client, personalize_prompt(email, patient), model,
+                                        rate_limiter, max_retries, stats)
+    return email_result(patient, content if content is not None else email, None, attempts, start, stats)
+
+
+def generate_emails(openai_client, patients: Iterable[Dict], user_proposal: str, model: str = MODEL_DI,
+                    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                    requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                    max_retries: int = DEFAULT_MAX_RETRIES, max_pending: int = DEFAULT_MAX_PENDING,
+                    stats: Optional[GenerationStats] = None) -> Iterator[EmailResult]:
+    '''
+    Writes the outreach email of every patient, with up to max_concurrency completions in flight.
+
+    Results are yielded as soon as each completion finishes, so a slow or failing patient doesn't hold
+    up the others, and each patient is retried on its own up to max_retries times. Patients are
+    read from `patients` as the completions finish, with at most max_concurrency + max_pending
+    submitted at a time, so memory doesn't grow with the size of the cohort.
+
+    Parameters:
+    openai_client: An OpenAI (or OpenAI-compatible) client.
+    patients (Iterable[Dict]): The patients, as returned by get_patients_between_ages_and_condition.
+    user_proposal (str): The screening the patients are invited to.
+    model (str): The model that writes the emails.
+    max_concurrency (int): The maximum number of completions requested at the same time.
+    requests_per_minute (float): Optional limit on the completions requested per minute.
+    tokens_per_minute (float): Optional limit on the (estimated) tokens used per minute.
+    max_retries (int): The number of extra attempts for a patient whose completion fails.
+    max_pending (int): The number of patients queued on top of the completions in flight.
+    stats (GenerationStats): Optional counters to update as the emails are written.
+    '''
+    start = time.perf_counter()
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute) if requests_per_minute or tokens_per_minute else None
+    window = max(1, max_concurrency) + max(0, max_pending)
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as pool:
+        futures = set()
+        for patient in patients:
+            if len(futures) >= window:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            futures.add(pool.submit(write_email, openai_client, patient, user_proposal, model, rate_limiter,
+                                    max_retries, stats))
+        for future in as_completed(futures):
+            yield future.result()
+    if stats:
+        stats.seconds += time.perf_counter() - start
+
+
+def generate_templated_emails(openai_client, patients: Iterable[Dict], user_proposal: str, model: str = MODEL_DI,
+                              max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                              requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                              max_retries: int = DEFAULT_MAX_RETRIES, personalize: bool = False,
+                              stats: Optional[GenerationStats] = None) -> Iterator[EmailResult]:
+    '''
+    Writes the outreach emails from templates: one completion per distinct condition, with a
+    NAME_SLOT placeholder that is filled in locally for each patient with that condition. This
+    takes O(conditions) completions instead of O(patients). If the model leaves NAME_SLOT out of
+    a template, the emails of that condition are written one completion per patient instead.
+    The parameters are the same as for generate_emails.
+
+    Parameters:
+    personalize (bool): Also run a per-patient pass that rewrites each rendered email for its
+    patient. This costs one completion per patient again, but they are short edits.
+    '''
+    start = time.perf_counter()
+    groups: Dict[str, List[Dict]] = {}
+    for patient in patients:
+        groups.setdefault(patient["condition"], []).append(patient)
+
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute) if requests_per_minute or tokens_per_minute else None
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as pool:
+        templates = {pool.submit(complete, openai_client, template_prompt(condition, user_proposal), model,
+                                 rate_limiter, max_retries, stats): condition
+                     for condition in groups}
+        per_patient = []
+        for future in as_completed(templates):
+            template, error, attempts = future.result()
+            for patient in groups[templates[future]]:
+                if template is None:
+                    yield email_result(patient, None, error, attempts, start, stats)
+                elif not is_template(template):
+                    per_patient.append(pool.submit(write_email, openai_client, patient, user_proposal, model,
+                                                   rate_limiter, max_retries, stats))
+                elif personalize:
+                    per_patient.append(pool.submit(personalize_email, openai_client, patient,
+                                                   render_template(template, patient), model,
+                                                   rate_limiter, max_retries, stats))
+                else:
+                    yield email_result(patient, render_template(template, patient), None, attempts, start, stats)
+        for future in as_completed(per_patient):
+            yield future.result()
+    if stats:
+        stats.seconds += time.perf_counter() - start
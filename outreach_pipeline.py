@@ -0,0 +1,276 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, List, Optional
+
+from outreach_emails import (
+    DEFAULT_MAX_CONCURRENCY, DEFAULT_MAX_RETRIES, MODEL_DI, EmailResult, GenerationStats, RateLimiter,
+    complete, email_result, is_template, personalize_email, render_template, template_prompt, write_email,
+)
+
+# Default number of items each queue between two stages holds before the stage feeding it waits
+DEFAULT_QUEUE_SIZE = 64
+# How often a blocked stage checks whether the pipeline has been stopped, in seconds
+_POLL_INTERVAL = 0.1
+# Put on a queue after the last item
+_DONE = object()
+
+
+class StageStats:
+    '''
+    Throughput and queue depth of one pipeline stage.
+
+    items is the number of items the stage has passed on, busy the seconds spent working on
+    them (summed over the stage's threads) and the depths are sampled from the stage's input
+    queue every time an item is taken from it. A full input queue means the stage is the
+    bottleneck; an empty one means it is waiting for the stage before it.
+    '''
+
+    def __init__(self, name: str, inbox: Optional[queue.Queue] = None):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self._inbox = inbox
+        self._depth_total = 0
+        self._depth_samples = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        self.started = time.perf_counter()
+
+    def finish(self) -> None:
+        self.finished = time.perf_counter()
+
+    def sample_depth(self) -> None:
+        if self._inbox is None:
+            return
+        depth = self._inbox.qsize()
+        with self._lock:
+            self.max_depth = max(self.max_depth, depth)
+            self._depth_total += depth
+            self._depth_samples += 1
+
+    def add(self, busy: float, items: int = 1) -> None:
+        with self._lock:
+            self.items += items
+            self.busy += busy
+
+    @property
+    def depth(self) -> int:
+        return self._inbox.qsize() if self._inbox is not None else 0
+
+    @property
+    def mean_depth(self) -> float:
+        return self._depth_total / self._depth_samples if self._depth_samples else 0.0
+
+    @property
+    def seconds(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.seconds if self.seconds else 0.0
+
+    def report(self) -> str:
+        return (f"{self.name}: {self.items} items in {self.seconds:.1f}s ({self.throughput:.1f}/s, "
+                f"busy {self.busy:.1f}s), input queue depth max {self.max_depth} mean {self.mean_depth:.1f}")
+
+
+class PipelineStats:
+    '''
+    The StageStats of a run of run_outreach_pipeline, in stage order, and the time the first
+    email was written.
+    '''
+
+    def __init__(self, stages: List[StageStats]):
+        self.stages = stages
+        self.started = time.perf_counter()
+        self.first_output: Optional[float] = None
+
+    def __getitem__(self, name: str) -> StageStats:
+        return next(stage for stage in self.stages if stage.name == name)
+
+    @property
+    def time_to_first_output(self) -> Optional[float]:
+        return self.first_output - self.started if self.first_output is not None else None
+
+    def report(self) -> str:
+        return "\n".join(stage.report() for stage in self.stages)
+
+
+class _TemplateCache:
+    # One template email per condition, written by the first worker that needs it. Workers that
+    # need the same condition meanwhile wait for that completion instead of requesting another.
+
+    def __init__(self, openai_client, user_proposal: str, model: str, rate_limiter: Optional[RateLimiter],
+                 max_retries: int, stats: Optional[GenerationStats]):
+        self._args = (openai_client, user_proposal, model, rate_limiter, max_retries, stats)
+        self._templates: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, condition: str):
+        with self._lock:
+            future = self._templates.get(condition)
+            owner = future is None
+            if owner:
+                future = self._templates[condition] = Future()
+        if owner:
+            openai_client, user_proposal, model, rate_limiter, max_retries, stats = self._args
+            future.set_result(complete(openai_client, template_prompt(condition, user_proposal), model,
+                                       rate_limiter, max_retries, stats))
+        return future.result()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    # Blocks while the queue is full, which is what holds back a stage that runs ahead of the
+    # next one. Returns False without putting the item if the pipeline is stopped meanwhile.
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def run_outreach_pipeline(openai_client, patients: Iterable[Dict], user_proposal: str,
+                          write: Callable[[EmailResult], None], model: str = MODEL_DI,
+                          max_concurrency: int = DEFAULT_MAX_CONCURRENCY, queue_size: int = DEFAULT_QUEUE_SIZE,
+                          requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                          max_retries: int = DEFAULT_MAX_RETRIES, templated: bool = False, personalize: bool = False,
+                          stats: Optional[GenerationStats] = None) -> PipelineStats:
+    '''
+    Writes the outreach email of every patient as the patients are found, instead of waiting for
+    the whole cohort first.
+
+    The work runs in three stages joined by bounded queues: a search thread that reads patients
+    from `patients` (typically iter_patients_between_ages_and_condition, so the FHIR crawl runs
+    in it), max_concurrency email threads that request the completions, and the calling thread,
+    which passes every EmailResult to `write` as it arrives. When a stage falls behind, the queue
+    in front of it fills up and the stages before it wait, so at most about 2 * queue_size +
+    max_concurrency patients are held in memory whatever the size of the cohort.
+
+    Parameters:
+    openai_client: An OpenAI (or OpenAI-compatible) client.
+    patients (Iterable[Dict]): The patients, as yielded by iter_patients_between_ages_and_condition.
+    user_proposal (str): The screening the patients are invited to.
+    write (Callable): Called with every EmailResult, including failed ones, in the calling thread.
+    queue_size (int): The number of items each queue between two stages holds.
+    templated (bool): Write one email per condition and fill in each patient's name, as in
+    generate_templated_emails (including its fallback for templates without the name slot).
+    personalize also rewrites each rendered email for its patient.
+    The other parameters are the same as for generate_emails.
+
+    Returns:
+    The PipelineStats of the run. An exception raised by the search or by `write` stops the
+    pipeline and is raised again here.
+    '''
+    patient_queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+    result_queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+    search_stage, email_stage, write_stage = (StageStats("search"), StageStats("email", patient_queue),
+                                              StageStats("write", result_queue))
+    pipeline_stats = PipelineStats([search_stage, email_stage, write_stage])
+    stop = threading.Event()
+    errors: List[BaseException] = []
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute) if requests_per_minute or tokens_per_minute else None
+    templates = _TemplateCache(openai_client, user_proposal, model, rate_limiter, max_retries, stats) if templated else None
+
+    def search() -> None:
+        search_stage.start()
+        try:
+            iterator = iter(patients)
+            while True:
+                start = time.perf_counter()
+                patient = next(iterator, _DONE)
+                if patient is _DONE:
+                    break
+                search_stage.add(time.perf_counter() - start)
+                if not _put(patient_queue, patient, stop):
+                    break
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            search_stage.finish()
+            _put(patient_queue, _DONE, stop)
+
+    def email(patient: Dict) -> EmailResult:
+        if not templated:
+            return write_email(openai_client, patient, user_proposal, model, rate_limiter, max_retries, stats)
+        start = time.perf_counter()
+        template, error, attempts = templates.get(patient["condition"])
+        if template is None:
+            return email_result(patient, None, error, attempts, start, stats)
+        if not is_template(template):
+            return write_email(openai_client, patient, user_proposal, model, rate_limiter, max_retries, stats)
+        if personalize:
+            return personalize_email(openai_client, patient, render_template(template, patient), model,
+                                     rate_limiter, max_retries, stats)
+        return email_result(patient, render_template(template, patient), None, attempts, start, stats)
+
+    def email_worker() -> None:
+        while True:
+            patient = _get(patient_queue, stop)
+            if patient is _DONE:
+                # Leave the marker for the other workers
+                _put(patient_queue, _DONE, stop)
+                return
+            email_stage.sample_depth()
+            start = time.perf_counter()
+            result = email(patient)
+            email_stage.add(time.perf_counter() - start)
+            if not _put(result_queue, result, stop):
+                return
+
+    def close_results(workers: List[threading.Thread]) -> None:
+        for worker in workers:
+            worker.join()
+        email_stage.finish()
+        _put(result_queue, _DONE, stop)
+
+    email_stage.start()
+    workers = [threading.Thread(target=email_worker, daemon=True) for _ in range(max(1, max_concurrency))]
+    threads = [threading.Thread(target=search, daemon=True), *workers,
+               threading.Thread(target=close_results, args=(workers,), daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    write_stage.start()
+    try:
+        while True:
+            result = _get(result_queue, stop)
+            if result is _DONE:
+                break
+            write_stage.sample_depth()
+            start = time.perf_counter()
+            write(result)
+            write_stage.add(time.perf_counter() - start)
+            if pipeline_stats.first_output is None:
+                pipeline_stats.first_output = time.perf_counter()
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        write_stage.finish()
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if stats:
+        stats.seconds += time.perf_counter() - pipeline_stats.started
+    if errors:
+        raise errors[0]
+    return pipeline_stats
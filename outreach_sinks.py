@@ -0,0 +1,227 @@
+import csv
+import io
+import json
+import os
+from typing import Dict, List, Optional
+
+from outreach_emails import EmailResult
+
+# Where write_outreach_emails saves the emails by default; the out.csv the outreach admin produces
+DEFAULT_OUTPUT = "out.csv"
+# Default number of emails buffered before they are written to the file in one go
+DEFAULT_BATCH_SIZE = 500
+# Columns of the CSV output, in order. email_text is the text of the email itself
+CSV_COLUMNS = ["MRN", "full_name", "email", "postal_code", "condition", "patient_url", "email_text"]
+# Suffix of the file a batch sink writes to until it is closed and renamed into place
+PARTIAL_SUFFIX = ".partial"
+
+
+def patient_id(patient: Dict) -> Optional[str]:
+    '''
+    The FHIR id of a patient dictionary, taken from its patient_url.
+    '''
+    url = patient.get("patient_url") or ""
+    if "/Patient/" not in url:
+        return None
+    return url.split("/Patient/")[-1].split("?")[0] or None
+
+
+def email_record(result: EmailResult) -> Dict[str, Optional[str]]:
+    patient = result.patient
+    return {
+        "MRN": patient.get("MRN"),
+        "full_name": patient.get("full_name"),
+        "email": patient.get("email"),
+        "postal_code": patient.get("postal_code"),
+        "condition": patient.get("condition"),
+        "patient_url": patient.get("patient_url"),
+        "email_text": result.content,
+    }
+
+
+class OutputSink:
+    '''
+    Where the generated outreach emails go. write is called with every EmailResult; the ones
+    whose email could not be written are only counted in failed. Use a sink as a context
+    manager: it is closed when the block ends and aborted if the block raises, so an
+    interrupted run never leaves output that looks complete.
+    '''
+
+    def __init__(self):
+        self.written = 0
+        self.failed = 0
+
+    def write(self, result: EmailResult) -> None:
+        if result.content is None:
+            self.failed += 1
+            return
+        self._write(result)
+        self.written += 1
+
+    def _write(self, result: EmailResult) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def abort(self) -> None:
+        pass
+
+    def __enter__(self) -> "OutputSink":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class BatchFileSink(OutputSink):
+    '''
+    Appends the emails to a single file, one record each, in batches of batch_size.
+
+    The records go to `path` + PARTIAL_SUFFIX, which is synced to disk and renamed to `path`
+    only when the sink is closed, so `path` either holds the complete output of a run or is
+    left as it was. An aborted run leaves the partial file behind for inspection.
+    '''
+
+    def __init__(self, path: str, batch_size: int = DEFAULT_BATCH_SIZE):
+        super().__init__()
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.flushes = 0
+        self._buffer: List[str] = []
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(path + PARTIAL_SUFFIX, "w", encoding="utf-8", newline="")
+        header = self._header()
+        if header:
+            self._file.write(header)
+
+    def _header(self) -> str:
+        return ""
+
+    def _format(self, result: EmailResult) -> str:
+        raise NotImplementedError
+
+    def _write(self, result: EmailResult) -> None:
+        self._buffer.append(self._format(result))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._file.write("".join(self._buffer))
+            self._file.flush()
+            self._buffer.clear()
+            self.flushes += 1
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.path + PARTIAL_SUFFIX, self.path)
+
+    def abort(self) -> None:
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+class JsonlSink(BatchFileSink):
+    '''
+    Writes one JSON object per email, with the CSV_COLUMNS as keys.
+    '''
+
+    def _format(self, result: EmailResult) -> str:
+        return json.dumps(email_record(result), ensure_ascii=False) + "\n"
+
+
+class CsvSink(BatchFileSink):
+    '''
+    Writes a CSV file with a header row and one row per email, in CSV_COLUMNS order.
+    '''
+
+    def _header(self) -> str:
+        return self._row(CSV_COLUMNS)
+
+    def _format(self, result: EmailResult) -> str:
+        record = email_record(result)
+        return self._row([record[column] for column in CSV_COLUMNS])
+
+    @staticmethod
+    def _row(values: List) -> str:
+        line = io.StringIO()
+        csv.writer(line).writerow(["" if value is None else value for value in values])
+        return line.getvalue()
+
+
+class TextFileSink(OutputSink):
+    '''
+    Writes each email to its own text file in `directory`, named after the patient's MRN, with
+    the patient's details at the top. This is the original layout of the outreach emails.
+
+    Each file is written under a temporary name and renamed into place. Patients without an
+    MRN are named after their FHIR id instead, and a name that was already used in this run
+    gets a numbered suffix rather than overwriting the earlier email.
+    '''
+
+    def __init__(self, directory: str = "."):
+        super().__init__()
+        self.directory = directory
+        self._names = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def _file_name(self, patient: Dict) -> str:
+        stem = patient.get("MRN") or f"patient-{patient_id(patient) or 'unknown'}"
+        name, n = stem, 1
+        while name in self._names:
+            n += 1
+            name = f"{stem}-{n}"
+        self._names.add(name)
+        return os.path.join(self.directory, f"{name}.txt")
+
+    def _write(self, result: EmailResult) -> None:
+        patient = result.patient
+        path = self._file_name(patient)
+        with open(path + PARTIAL_SUFFIX, "w", encoding="utf-8") as f:
+            f.write(f"Name: {patient['full_name']}\n")
+            f.write(f"MRN: {patient['MRN']}\n")
+            f.write(f"Postcode: {patient['postal_code']}\n")
+            f.write(f"Email: {patient['email']}\n")
+            f.write("\n")
+            f.write(f"Patient: {patient['patient_url']}\n")
+            f.write(result.content)
+            f.write("\n")
+            f.write("-----------------------------------------")
+        os.replace(path + PARTIAL_SUFFIX, path)
+
+
+# Output formats by name
+SINKS = {
+    "csv": CsvSink,
+    "jsonl": JsonlSink,
+    "text": TextFileSink,
+}
+
+
+def open_sink(path: str = DEFAULT_OUTPUT, format: Optional[str] = None, **kwargs) -> OutputSink:
+    '''
+    Opens the output sink for `path`. The format is one of SINKS; if it isn't given it is taken
+    from the extension of `path` (.csv or .jsonl), and any other path is used as the directory
+    of per-patient text files. Extra keyword arguments go to the sink, e.g. batch_size.
+
+    Example usage:
+    >>> with open_sink("out.csv") as sink:
+    ...     for result in generate_emails(client, patients, user_proposal):
+    ...         sink.write(result)
+    '''
+    if format is None:
+        extension = os.path.splitext(path)[1].lower().lstrip(".")
+        format = extension if extension in SINKS and extension != "text" else "text"
+    if format not in SINKS:
+        raise ValueError(f"Unknown output format {format!r}, expected one of {', '.join(SINKS)}")
+    return SINKS[format](path, **kwargs)
@@ -0,0 +1,305 @@
+import datetime
+import gzip
+import os
+import pickle
+from array import array
+from bisect import bisect_right
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import bulk_export
+import fhir_client
+from fhir_client import loads
+from cohort_search import birthdate_window
+from condition_codes import lookup_condition_codes
+from patient_record import PatientRecord
+
+# An index file to answer cohort searches from instead of the FHIR server; empty means none
+PATIENT_INDEX_PATH = os.getenv("PATIENT_INDEX_PATH", "")
+
+
+class _StringColumn:
+    # A column of optional strings stored back to back in one buffer, so a million of them take
+    # a few megabytes instead of a Python object each
+    def __init__(self):
+        self._data = bytearray()
+        self._ends = array('Q')
+        self._null = bytearray()
+
+    def append(self, value: Optional[str]) -> None:
+        if value is not None:
+            self._data += value.encode()
+        self._ends.append(len(self._data))
+        self._null.append(value is None)
+
+    def __getitem__(self, row: int) -> Optional[str]:
+        if self._null[row]:
+            return None
+        start = self._ends[row - 1] if row else 0
+        return self._data[start:self._ends[row]].decode()
+
+    def __len__(self) -> int:
+        return len(self._ends)
+
+    def nbytes(self) -> int:
+        return len(self._data) + self._ends.itemsize * len(self._ends) + len(self._null)
+
+
+def _age(birth: datetime.date, today: datetime.date) -> int:
+    # Whole years between the dates, as relativedelta(today, birth).years
+    return today.year - birth.year - ((today.month, today.day) < (birth.month, birth.day))
+
+
+class PatientIndex:
+    '''
+    An in-memory, columnar index of patients and their conditions that answers the age and
+    condition queries of get_patients_between_ages_and_condition without the FHIR server.
+
+    Each patient is a row: the birthdate is stored as a date ordinal in an array, and the
+    details the patient dictionary needs are stored in compact string columns. Condition codes
+    are interned, and each code has a posting list of the patients with it, sorted by birthdate.
+    That way a query is a binary search for the birthdate window in the posting list of each
+    matching code, and only the patients it returns are turned into dictionaries.
+
+    Build it with add_patient and add_condition (from a bulk $export or a crawl, in any order),
+    then call finish before querying. Only patients with the contact details outreach needs are
+    indexed, the same patients the FHIR search would return.
+
+    Example usage:
+    >>> index = PatientIndex.from_ndjson(["Patient.ndjson"], ["Condition.ndjson"], base_url)
+    >>> index.query(50, 70, "Myocardial")
+    '''
+
+    def __init__(self, base_url: str = ""):
+        self.base_url = base_url.rstrip("/")
+        self.ids = _StringColumn()
+        self.births = array('i')
+        self.names = _StringColumn()
+        self.mrns = _StringColumn()
+        self.emails = _StringColumn()
+        self.postal_codes = _StringColumn()
+        # Interned condition codings ((code, display) pairs) and, once finished, their posting lists
+        self.codes: List[Tuple[Tuple[str, str], ...]] = []
+        self._code_ids: Dict[Tuple[Tuple[str, str], ...], int] = {}
+        self._postings: List[array] = []
+        self._posting_births: List[array] = []
+        # Only needed while the index is built
+        self._rows: Optional[Dict[str, int]] = {}
+        self._pending = [array('i'), array('i')]
+        self._unresolved: List = []
+
+    def __len__(self) -> int:
+        return len(self.births)
+
+    def add_patient(self, patient: Dict) -> bool:
+        '''
+        Adds a Patient resource. Returns False if it lacks the details outreach needs. A patient
+        already in the index (a crawl includes it with each page of its conditions) is skipped.
+        '''
+        record = PatientRecord.from_resource(patient)
+        if not record.contactable or not record.birth_date:
+            return False
+        if record.id in self._rows:
+            return True
+        self._rows[record.id] = len(self.births)
+        self.ids.append(record.id)
+        self.births.append(record.birthday().toordinal())
+        self.names.append(record.full_name)
+        self.emails.append(record.email)
+        self.mrns.append(record.mrn)
+        self.postal_codes.append(record.postal_code)
+        return True
+
+    def add_condition(self, condition: Dict) -> None:
+        '''
+        Adds a Condition resource. Its patient may be added before or after it.
+        '''
+        codings = condition.get('code', {}).get('coding', [])
+        if not codings or 'subject' not in condition:
+            return
+        patient_id = condition['subject']['reference'].split('/')[-1]
+        key = tuple((coding.get('code', ''), coding.get('display', '')) for coding in codings)
+        code_id = self._code_ids.get(key)
+        if code_id is None:
+            code_id = self._code_ids[key] = len(self.codes)
+            self.codes.append(key)
+        row = self._rows.get(patient_id)
+        if row is None:
+            self._unresolved.append((patient_id, code_id))
+        else:
+            self._pending[0].append(row)
+            self._pending[1].append(code_id)
+
+    def finish(self) -> "PatientIndex":
+        '''
+        Builds the posting lists. Conditions whose patient was never added are dropped.
+        '''
+        rows, codes = self._pending
+        for patient_id, code_id in self._unresolved:
+            row = self._rows.get(patient_id)
+            if row is not None:
+                rows.append(row)
+                codes.append(code_id)
+        by_code: List[set] = [set() for _ in self.codes]
+        for row, code_id in zip(rows, codes):
+            by_code[code_id].add(row)
+        births = self.births
+        self._postings = [array('i', sorted(members, key=births.__getitem__)) for members in by_code]
+        self._posting_births = [array('i', (births[row] for row in posting)) for posting in self._postings]
+        self._rows, self._pending, self._unresolved = None, [array('i'), array('i')], []
+        return self
+
+    def matching_codes(self, condition: str) -> List[int]:
+        '''
+        The interned codings a free-text condition matches, as in cohort_search.condition_matcher:
+        one of its SNOMED codes, or a display name that contains it.
+        '''
+        snomed = set(lookup_condition_codes(condition))
+        text = condition.lower()
+        return [code_id for code_id, codings in enumerate(self.codes)
+                if any(code in snomed or text in display.lower() for code, display in codings)]
+
+    def patient(self, row: int, condition: str = "", default_email: Optional[str] = None,
+                today: Optional[datetime.date] = None) -> Dict[str, Union[str, int, None]]:
+        '''
+        The patient dictionary of a row, naming the condition it was found for.
+        '''
+        today = today or datetime.date.today()
+        patient_id = self.ids[row]
+        return {
+            'patient_url': f"{self.base_url}/Patient/{patient_id}?_pretty=true",
+            'full_name': self.names[row],
+            'age': _age(datetime.date.fromordinal(self.births[row]), today),
+            'postal_code': self.postal_codes[row],
+            'MRN': self.mrns[row],
+            'email': self.emails[row] or default_email,
+            'condition': condition,
+        }
+
+    def _ranges(self, min_age: int, max_age: int, condition: str) -> Iterator[Tuple[int, int, int]]:
+        # (code, start, end) of the slice of each matching posting list in the birthdate window
+        min_birthdate, max_birthdate = birthdate_window(min_age, max_age)
+        low = datetime.date.fromisoformat(min_birthdate).toordinal()
+        high = datetime.date.fromisoformat(max_birthdate).toordinal()
+        for code_id in self.matching_codes(condition):
+            births = self._posting_births[code_id]
+            # birthdate > min_birthdate and birthdate <= max_birthdate
+            yield code_id, bisect_right(births, low), bisect_right(births, high)
+
+    def count(self, min_age: int, max_age: int, condition: str) -> int:
+        '''
+        The number of patients a query would return, without building their dictionaries.
+        '''
+        ranges = list(self._ranges(min_age, max_age, condition))
+        if len(ranges) == 1:
+            return ranges[0][2] - ranges[0][1]
+        return len({row for code_id, start, end in ranges for row in self._postings[code_id][start:end]})
+
+    def query(self, min_age: int, max_age: int, condition: str,
+              default_email: Optional[str] = None) -> Iterator[Dict[str, Union[str, int, None]]]:
+        '''
+        Yields the patient dictionary of every patient between the ages with the condition, in
+        the layout of get_patients_between_ages_and_condition.
+        '''
+        today = datetime.date.today()
+        seen = set()
+        for code_id, start, end in self._ranges(min_age, max_age, condition):
+            # The patient dictionary names the first coding, as the FHIR search does
+            display = self.codes[code_id][0][1]
+            for row in self._postings[code_id][start:end]:
+                if row not in seen:
+                    seen.add(row)
+                    yield self.patient(row, display, default_email, today)
+
+    def nbytes(self) -> int:
+        '''
+        The approximate memory taken by the columns and posting lists.
+        '''
+        columns = [self.ids, self.names, self.mrns, self.emails, self.postal_codes]
+        postings = sum(p.itemsize * len(p) for p in self._postings + self._posting_births)
+        return sum(c.nbytes() for c in columns) + self.births.itemsize * len(self.births) + postings
+
+    def save(self, path: str) -> None:
+        '''
+        Saves the finished index to a file, written under a temporary name and renamed into place.
+        '''
+        if self._rows is not None:
+            raise ValueError("Call finish() before saving the index")
+        with open(path + ".partial", "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".partial", path)
+
+    @staticmethod
+    def load(path: str) -> "PatientIndex":
+        # Only load index files you built yourself: they are pickles
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    @classmethod
+    def from_resources(cls, resources: Iterable[Dict], base_url: str = "") -> "PatientIndex":
+        '''
+        Builds an index from a stream of Patient and Condition resources (other types are skipped).
+        '''
+        index = cls(base_url)
+        for resource in resources:
+            resource_type = resource.get('resourceType')
+            if resource_type == 'Patient':
+                index.add_patient(resource)
+            elif resource_type == 'Condition':
+                index.add_condition(resource)
+        return index.finish()
+
+    @classmethod
+    def from_ndjson(cls, patient_paths: Iterable[str], condition_paths: Iterable[str],
+                    base_url: str = "") -> "PatientIndex":
+        '''
+        Builds an index from the NDJSON files of a FHIR bulk $export, plain or gzipped, reading
+        them one line at a time.
+        '''
+        return cls.from_resources(read_ndjson([*patient_paths, *condition_paths]), base_url)
+
+    @classmethod
+    def from_export(cls, client=None, manifest=None) -> "PatientIndex":
+        '''
+        Builds an index from a Bulk Data export of the server's patients and conditions (see
+        bulk_export), streaming the files. A new export is run unless the manifest of a
+        completed one is given.
+        '''
+        client = client or fhir_client.client
+        manifest = manifest or bulk_export.export(client)
+        return cls.from_resources(bulk_export.iter_export(client, manifest), client.base_url)
+
+    @classmethod
+    def from_search(cls, client, params: Optional[Dict] = None, page_size: int = 1000) -> "PatientIndex":
+        '''
+        Builds an index by crawling Condition?_include=Condition:subject on the server, e.g. when
+        it doesn't support bulk $export.
+        '''
+        params = {**(params or {}), '_include': 'Condition:subject'}
+        return cls.from_resources((entry['resource'] for entry in client.search_entries('Condition', params, page_size)),
+                                  client.base_url)
+
+
+def read_ndjson(paths: Iterable[str]) -> Iterator[Dict]:
+    '''
+    Yields the resources in NDJSON files one line at a time, so no file is loaded whole.
+    Files ending in .gz are decompressed as they are read.
+    '''
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield loads(line)
+
+
+_default_index: Optional[PatientIndex] = None
+
+
+def default_index() -> Optional[PatientIndex]:
+    '''
+    The index at PATIENT_INDEX_PATH, loaded once, or None if no index is configured.
+    '''
+    global _default_index
+    if _default_index is None and PATIENT_INDEX_PATH:
+        _default_index = PatientIndex.load(PATIENT_INDEX_PATH)
+    return _default_index
@@ -0,0 +1,81 @@
+import datetime
+from dataclasses import dataclass
+from typing import Dict, Optional, Union
+
+from fhir_client import loads
+
+# The email address the scripts use for patients who don't have one
+DEFAULT_EMAIL = "test@test.com"
+# identifier.type.text of a patient's Medical Record Number
+MRN_TYPE = "Medical Record Number"
+
+
+@dataclass(slots=True)
+class PatientRecord:
+    '''
+    The fields of a Patient resource that outreach uses, taken out of the resource as soon as it
+    is decoded so the rest of it can be dropped. email and mrn are None if the patient has none.
+    contactable is False for patients without the contact details (telecom and maritalStatus)
+    that outreach needs; get_patients_between_ages_and_condition leaves them out, so only their
+    id and birth_date are read.
+    '''
+    id: str
+    full_name: str
+    birth_date: str
+    email: Optional[str]
+    mrn: Optional[str]
+    postal_code: Optional[str]
+    contactable: bool
+
+    @classmethod
+    def from_resource(cls, patient: Dict) -> "PatientRecord":
+        contactable = 'telecom' in patient and 'maritalStatus' in patient
+        if not contactable:
+            # Left out of every cohort, so nothing else is read: these are often the incomplete records
+            return cls(patient.get('id', ''), "", patient.get('birthDate', ''), None, None, None, False)
+        name = (patient.get('name') or [{}])[0]
+        email = mrn = None
+        for telecom in patient.get('telecom', ()):
+            if telecom.get('system') == 'email':
+                email = telecom.get('value')
+                break
+        for identifier in patient.get('identifier', ()):
+            if identifier.get('type', {}).get('text') == MRN_TYPE:
+                mrn = identifier.get('value')
+                break
+        address = patient.get('address')
+        full_name = " ".join(part for part in ((name.get('given') or [""])[0], name.get('family', "")) if part)
+        return cls(patient['id'], full_name, patient.get('birthDate', ''), email, mrn,
+                   address[0].get('postalCode') if address else None, True)
+
+    @classmethod
+    def from_json(cls, data: Union[bytes, str]) -> "PatientRecord":
+        '''
+        Decodes a Patient resource (with orjson if it is installed) and keeps only the record.
+        '''
+        return cls.from_resource(loads(data))
+
+    def birthday(self) -> datetime.date:
+        # A birthDate may be just a year, or a year and month: the missing parts are taken as 1
+        return datetime.date(int(self.birth_date[:4]), int(self.birth_date[5:7] or 1), int(self.birth_date[8:10] or 1))
+
+    def age(self, today: Optional[datetime.date] = None) -> int:
+        # Whole years since the birthdate, as relativedelta(today, birth_date).years
+        today = today or datetime.date.today()
+        birthday = self.birthday()
+        return today.year - birthday.year - ((today.month, today.day) < (birthday.month, birthday.day))
+
+    def to_dict(self, patient_url: str, condition: str, default_email: Optional[str] = None,
+                today: Optional[datetime.date] = None) -> Dict[str, Union[str, int, None]]:
+        '''
+        The patient dictionary of get_patients_between_ages_and_condition.
+        '''
+        return {
+            'patient_url': patient_url,
+            'full_name': self.full_name,
+            'age': self.age(today),
+            'postal_code': self.postal_code,
+            'MRN': self.mrn,
+            'email': self.email or default_email,
+            'condition': condition,
+        }
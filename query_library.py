@@ -0,0 +1,209 @@
+import datetime
+import json
+import os
+import re
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from cohort_criteria import CohortCriteria, parse_criteria, states_criteria
+from group_chat_policy import SUMMARY_PREFIX, execution_failed, has_code
+from warm_executor import PYTHON_LANGUAGES
+
+# Where the cohort queries that ran successfully are kept. Set QUERY_LIBRARY_PATH to an empty
+# string to only keep them for the current run
+QUERY_LIBRARY_PATH = os.getenv("QUERY_LIBRARY_PATH", ".query_library.json")
+# Number of failed executions in a row after which the data analyst stops trying to fix its code
+DEFAULT_MAX_FIX_ATTEMPTS = 3
+
+# Queries are parameterized on a line assigning the criteria, which the data analyst is asked to
+# start its code with
+CRITERIA_INSTRUCTION = ('Start the code with a single line assigning the criteria, in the form '
+                        'CRITERIA = {"min_age": 50, "max_age": 70, "conditions": ["Osteoporosis"]}, '
+                        'and read them from CRITERIA.')
+_CRITERIA_LINE = re.compile(r"^CRITERIA\s*=\s*\{.*\}[ \t]*$", re.M)
+_PLACEHOLDER = "CRITERIA = {criteria}"
+
+
+def criteria_key(criteria: CohortCriteria) -> str:
+    # The whole criteria, normalized: "50-70:hyperglycemia|prediabetes"
+    conditions = "|".join(sorted({c.strip().lower() for c in criteria.conditions}))
+    return f"{criteria.min_age}-{criteria.max_age}:{conditions}"
+
+
+class QuerySnippet(NamedTuple):
+    '''
+    One version of the query for a set of criteria. A parameterized query has its criteria line
+    replaced by a placeholder, which is rendered with the criteria it is reused for (the same
+    ages and conditions, possibly written in another order or case).
+    '''
+    version: int
+    code: str
+    parameterized: bool
+    criteria: Dict
+    created: str
+    runs: int = 1
+    failures: int = 0
+
+    def render(self, criteria: CohortCriteria) -> str:
+        if not self.parameterized:
+            return self.code
+        return self.code.replace(_PLACEHOLDER, "CRITERIA = " + json.dumps(criteria.to_dict()), 1)
+
+
+def parameterize(code: str) -> Tuple[str, bool]:
+    '''
+    Replaces the code's CRITERIA line with the placeholder. Returns the code and whether it had one.
+    '''
+    template, found = _CRITERIA_LINE.subn(lambda m: _PLACEHOLDER, code, count=1)
+    return template, bool(found)
+
+
+class QueryLibrary:
+    '''
+    The cohort queries that ran successfully, keyed by their criteria (the age range and the
+    conditions, lower case and sorted), with every version kept. It is stored in a JSON file at
+    `path` (or only in memory if path is empty), rewritten atomically whenever it changes, like CriteriaStore.
+
+    Example usage:
+    >>> library = QueryLibrary()
+    >>> snippet = library.lookup(criteria)
+    >>> code = snippet.render(criteria) if snippet else write_new_code(criteria)
+    '''
+
+    def __init__(self, path: str = QUERY_LIBRARY_PATH):
+        self.path = path
+        self._snippets: Dict[str, List[QuerySnippet]] = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for key, versions in json.load(f).items():
+                    self._snippets[key] = [QuerySnippet(**version) for version in versions]
+
+    def lookup(self, criteria: CohortCriteria) -> Optional[QuerySnippet]:
+        '''
+        The newest version for the criteria that hasn't failed, if there is one.
+        '''
+        return next((s for s in reversed(self._snippets.get(criteria_key(criteria), [])) if not s.failures), None)
+
+    def store(self, criteria: CohortCriteria, code: str) -> QuerySnippet:
+        '''
+        Records code that found the patients for the criteria. The same code counts as another
+        run of its version, different code becomes a new version.
+        '''
+        template, parameterized = parameterize(code)
+        with self._lock:
+            versions = self._snippets.setdefault(criteria_key(criteria), [])
+            for i, snippet in enumerate(versions):
+                if snippet.code == template:
+                    versions[i] = snippet = snippet._replace(runs=snippet.runs + 1, failures=0)
+                    break
+            else:
+                snippet = QuerySnippet(len(versions) + 1, template, parameterized, criteria.to_dict(),
+                                       datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"))
+                versions.append(snippet)
+            self._save()
+        return snippet
+
+    def record_failure(self, criteria: CohortCriteria, snippet: QuerySnippet) -> None:
+        '''
+        Marks a version that failed when it was reused, so it isn't offered again unless the same
+        code is written and runs successfully once more.
+        '''
+        with self._lock:
+            versions = self._snippets.get(criteria_key(criteria), [])
+            for i, s in enumerate(versions):
+                if s.version == snippet.version:
+                    versions[i] = s._replace(failures=s.failures + 1)
+            self._save()
+
+    def _save(self) -> None:
+        if self.path:
+            with open(self.path + ".partial", "w", encoding="utf-8") as f:
+                json.dump({key: [s._asdict() for s in versions] for key, versions in self._snippets.items()}, f, indent=1)
+            os.replace(self.path + ".partial", self.path)
+
+    def __len__(self) -> int:
+        return sum(len(versions) for versions in self._snippets.values())
+
+
+class QueryReuse:
+    '''
+    Connects a QueryLibrary to the data analyst and the executor of a group chat:
+    - once the criteria appear in the conversation (in a form parse_criteria reads), the data
+      analyst answers with the stored query for them instead of asking the LLM for new code.
+      Criteria that carry more than parse_criteria reads (a negation, a medication, the
+      patients' sex) are left to the LLM, and its code isn't stored;
+    - code that the executor runs successfully is stored for the criteria, and a stored query
+      that fails is marked so the analyst writes a new one;
+    - after max_fix_attempts failed executions in a row the analyst stops trying to fix the code
+      and says so, instead of going round the fix-up loop until the chat runs out of turns.
+
+    Example usage:
+    >>> reuse = QueryReuse(QueryLibrary())
+    >>> reuse.attach(data_analyst, warm_executor)
+    '''
+
+    def __init__(self, library: QueryLibrary, max_fix_attempts: int = DEFAULT_MAX_FIX_ATTEMPTS):
+        self.library = library
+        self.max_fix_attempts = max_fix_attempts
+        self.criteria: Optional[CohortCriteria] = None
+        self.failures = 0
+        self.reused = 0
+        self.stored = 0
+        self.gave_up = 0
+        self._offered: Optional[QuerySnippet] = None
+
+    def attach(self, data_analyst, executor) -> None:
+        '''
+        Registers the reuse with the data analyst (ahead of its LLM reply) and the executor
+        (a WarmPythonExecutor, or any code executor with an on_result callback).
+        '''
+        from autogen import Agent
+        data_analyst.register_reply([Agent, None], self._reply, position=0)
+        executor.on_result = self._executed
+
+    def _find_criteria(self, messages: List[Dict]) -> Optional[CohortCriteria]:
+        for message in reversed(messages):
+            content = str(message.get("content") or "")
+            # The rolling summary cuts messages short, so criteria are only read from whole ones
+            if content and not has_code(message) and not content.startswith(SUMMARY_PREFIX):
+                criteria = parse_criteria(content)
+                if criteria or states_criteria(content):
+                    return criteria
+        return self.criteria
+
+    def _reply(self, recipient, messages=None, sender=None, config=None):
+        messages = messages or []
+        self.criteria = self._find_criteria(messages)
+        if messages and execution_failed(messages[-1]) and self.failures >= self.max_fix_attempts:
+            self.gave_up += 1
+            self.failures = 0
+            return True, (f"The query has failed {self.max_fix_attempts} times in a row, so I am not trying again. "
+                          "The error is above; the criteria or the FHIR server need to be checked first.")
+        if self.criteria is None or self._offered is not None or (messages and execution_failed(messages[-1])):
+            return False, None
+        snippet = self.library.lookup(self.criteria)
+        if snippet is None:
+            return False, None
+        self._offered = snippet
+        self.reused += 1
+        return True, (f"This query found the patients for these criteria before (version {snippet.version}, "
+                      f"{snippet.runs} successful runs):\n```python\n{snippet.render(self.criteria)}\n```")
+
+    def _executed(self, code_blocks, result) -> None:
+        offered, self._offered = self._offered, None
+        if result.exit_code != 0:
+            self.failures += 1
+            if offered is not None and self.criteria is not None:
+                self.library.record_failure(self.criteria, offered)
+            return
+        self.failures = 0
+        code = "\n".join(block.code for block in code_blocks if block.language.lower() in PYTHON_LANGUAGES)
+        if code and self.criteria is not None:
+            self.library.store(self.criteria, code)
+            if offered is None:
+                self.stored += 1
+
+    def report(self) -> str:
+        return (f"Query library: {self.reused} queries reused, {self.stored} new queries stored, "
+                f"gave up {self.gave_up} times ({len(self.library)} versions in the library)")
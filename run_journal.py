@@ -0,0 +1,172 @@
+import json
+import os
+import threading
+from typing import Callable, Dict, Iterable, Iterator, Union
+
+from cohort_criteria import CohortCriteria, normalize_proposal
+from outreach_emails import EmailResult
+from outreach_sinks import CSV_COLUMNS
+
+# Where the journal of each proposal's run is kept
+RUN_JOURNAL_DIR = os.getenv("RUN_JOURNAL_DIR", ".run_journals")
+# Number of records written between syncs of the journal to disk
+DEFAULT_SYNC_EVERY = 50
+
+
+class RunJournal:
+    '''
+    A durable record of one outreach run, so a run that dies can be resumed where it stopped
+    instead of starting over: the cohort criteria, every patient the search found (and whether
+    the search finished) and the text of every email written.
+
+    The journal is a JSON lines file that is only ever appended to. Each record is flushed as
+    it is written and the file is synced to disk every sync_every records, so a crash loses at
+    most the record being written; a torn last line is ignored when the journal is read back.
+    Opening an existing journal loads its state, unless the run it records finished.
+
+    Example usage:
+    >>> journal = RunJournal.open(user_proposal)
+    >>> criteria = journal.criteria or journal.record_criteria(define_cohort_criteria(user_proposal))
+    >>> for patient in journal.cohort(lambda: find_patients(criteria)):
+    ...     ...
+    '''
+
+    def __init__(self, path: str, sync_every: int = DEFAULT_SYNC_EVERY):
+        self.path = path
+        self.sync_every = max(1, sync_every)
+        self.criteria: Union[CohortCriteria, str, None] = None
+        self.patients: Dict[str, Dict] = {}
+        self.cohort_complete = False
+        self.emails: Dict[str, str] = {}
+        self.done = False
+        self.resumed = False
+        self._unsynced = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+        if self.done:
+            # A finished run is not resumed; the proposal is run again from scratch
+            self._reset()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a" if self.resumed else "w", encoding="utf-8")
+
+    @classmethod
+    def open(cls, proposal: str, directory: str = RUN_JOURNAL_DIR, resume: bool = True,
+             sync_every: int = DEFAULT_SYNC_EVERY) -> "RunJournal":
+        '''
+        The journal of a proposal's run, in `directory`. resume=False discards an unfinished run.
+        '''
+        name = normalize_proposal(proposal).replace(" ", "_")[:100] or "run"
+        path = os.path.join(directory, f"{name}.jsonl")
+        if not resume and os.path.exists(path):
+            os.remove(path)
+        return cls(path, sync_every)
+
+    def _reset(self) -> None:
+        self.criteria, self.patients, self.cohort_complete = None, {}, False
+        self.emails, self.done, self.resumed = {}, False, False
+
+    def _load(self) -> None:
+        end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete record")
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record was torn by a crash; it is cut off so the next ones follow a whole line
+                    os.truncate(self.path, end)
+                    break
+                end += len(line)
+                kind = record.get("type")
+                if kind == "criteria":
+                    criteria = record["criteria"]
+                    self.criteria = CohortCriteria.from_dict(criteria) if isinstance(criteria, dict) else criteria
+                elif kind == "patient":
+                    self.patients[record["patient"]["patient_url"]] = record["patient"]
+                elif kind == "cohort_complete":
+                    self.cohort_complete = True
+                elif kind == "email":
+                    self.emails[record["patient_url"]] = record["content"]
+                elif kind == "done":
+                    self.done = True
+        self.resumed = True
+
+    def _append(self, record: Dict, sync: bool = False) -> None:
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            self._unsynced += 1
+            if sync or self._unsynced >= self.sync_every:
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+
+    def record_criteria(self, criteria: Union[CohortCriteria, str]) -> Union[CohortCriteria, str]:
+        '''
+        Records the criteria of the run and returns them.
+        '''
+        self.criteria = criteria
+        value = criteria.to_dict() if isinstance(criteria, CohortCriteria) else criteria
+        self._append({"type": "criteria", "criteria": value}, sync=True)
+        return criteria
+
+    def cohort(self, search: Callable[[], Iterable[Dict]]) -> Iterator[Dict]:
+        '''
+        Yields the patients of the run. The patients recorded before come first; then, unless
+        the search had finished, search() is run again and the patients it finds that weren't
+        recorded yet are recorded and yielded.
+        '''
+        yield from list(self.patients.values())
+        if self.cohort_complete:
+            return
+        for patient in search():
+            url = patient["patient_url"]
+            if url not in self.patients:
+                with self._lock:
+                    self.patients[url] = patient
+                self._append({"type": "patient", "patient": patient})
+                yield patient
+        self.cohort_complete = True
+        self._append({"type": "cohort_complete"}, sync=True)
+
+    def record_email(self, patient: Dict, content: str) -> None:
+        self.emails[patient["patient_url"]] = content
+        self._append({"type": "email", "patient_url": patient["patient_url"], "content": content})
+
+    def has_email(self, patient: Dict) -> bool:
+        return patient["patient_url"] in self.emails
+
+    def pending(self, patients: Iterable[Dict]) -> Iterator[Dict]:
+        '''
+        The patients whose email hasn't been written yet.
+        '''
+        return (patient for patient in patients if patient["patient_url"] not in self.emails)
+
+    def replay(self, sink) -> int:
+        '''
+        Writes the emails recorded before into an output sink, since output that was still being
+        written when the run died is discarded. Returns the number of emails written.
+
+        An email whose patient isn't in the journal's cohort (e.g. one found by the group chat's
+        own search) is written with the patient's url only, which a TextFileSink names
+        patient-<id>.
+        '''
+        unknown = dict.fromkeys(column for column in CSV_COLUMNS if column != "email_text")
+        for url, content in self.emails.items():
+            sink.write(EmailResult(self.patients.get(url) or {**unknown, "patient_url": url}, content, None, 0, 0.0))
+        return len(self.emails)
+
+    def finish(self) -> None:
+        '''
+        Records that the run finished, so the next run of the proposal starts from scratch.
+        '''
+        self._append({"type": "done"}, sync=True)
+        self.done = True
+        self.close()
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
@@ -0,0 +1,22 @@
+import os
+
+# The modules read their settings when they are imported: keep the tests off the on-disk caches
+# and indexes of a local run
+os.environ["FHIR_CACHE_PATH"] = ""
+os.environ["PATIENT_INDEX_PATH"] = ""
+
+import pytest
+
+from benchmarks.stub_fhir_server import StubFhirServer
+from fhir_client import FhirClient
+
+
+@pytest.fixture
+def stub():
+    with StubFhirServer(n_patients=200) as server:
+        yield server
+
+
+@pytest.fixture
+def client(stub):
+    return FhirClient(stub.base_url)
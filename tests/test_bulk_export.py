@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+import bulk_export
+from benchmarks.stub_fhir_server import StubFhirServer
+from bulk_export import BulkExportError, export, iter_ndjson, start_export, wait_for_export
+from fhir_client import FhirClient
+
+
+def export_files(server, client):
+    manifest = export(client, poll_interval=0.05)
+    return [url for resource_type in ("Patient", "Condition") for url in manifest.urls(resource_type)]
+
+
+@pytest.mark.parametrize("gzip_files, accept_encoding", [
+    (True, "gzip"),       # stored .ndjson.gz blobs
+    (False, "gzip"),      # gzipped in transit
+    (False, "identity"),  # plain NDJSON
+])
+@pytest.mark.parametrize("chunk_size", [7, 1 << 16])
+def test_iter_ndjson_reads_every_resource(monkeypatch, gzip_files, accept_encoding, chunk_size):
+    # Chunks of 7 bytes split lines, and gzip members, at every possible place
+    monkeypatch.setattr(bulk_export, "CHUNK_SIZE", chunk_size)
+    with StubFhirServer(n_patients=50, export_file_size=20, export_gzip_files=gzip_files) as server:
+        client = FhirClient(server.base_url)
+        client.session.headers["Accept-Encoding"] = accept_encoding
+        urls = export_files(server, client)
+        assert all(url.endswith(".ndjson.gz") == gzip_files for url in urls)
+
+        resources = [resource for url in urls for resource in iter_ndjson(client, url)]
+
+    assert [r["id"] for r in resources] == list(server.patients) + [c["id"] for c in server.conditions]
+    assert resources[0] == server.patients["0"]
+
+
+def test_iter_ndjson_raises_for_a_missing_file():
+    with StubFhirServer(n_patients=5) as server:
+        client = FhirClient(server.base_url)
+        with pytest.raises(BulkExportError):
+            list(iter_ndjson(client, f"{server.base_url}/$export-file/404/Patient-0.ndjson"))
+
+
+def test_wait_for_export_polls_as_often_as_retry_after_asks():
+    with StubFhirServer(n_patients=5, export_delay=1.5, export_retry_after=1) as server:
+        client = FhirClient(server.base_url)
+        status_url = start_export(client)
+        start = time.monotonic()
+        # A poll_interval this long would time out: only Retry-After gets the manifest in time
+        manifest = wait_for_export(client, status_url, poll_interval=60, timeout=10)
+        assert time.monotonic() - start < 5
+        assert manifest.urls("Patient")
+        # The kick-off and two or three status requests
+        assert 3 <= server.request_count <= 4
+
+
+def test_wait_for_export_deletes_the_job_when_it_times_out():
+    with StubFhirServer(n_patients=5, export_delay=60, export_retry_after=1) as server:
+        client = FhirClient(server.base_url)
+        status_url = start_export(client)
+        assert server.exports
+        with pytest.raises(BulkExportError, match="did not finish"):
+            wait_for_export(client, status_url, timeout=2.5)
+        assert not server.exports
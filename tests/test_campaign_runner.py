@@ -0,0 +1,24 @@
+from campaign_runner import Campaign, merge_searches
+from cohort_criteria import CohortCriteria
+
+
+def campaign(min_age, max_age, *conditions):
+    result = Campaign(f"c{min_age}-{max_age}", "")
+    result.criteria = CohortCriteria(min_age, max_age, conditions)
+    return result
+
+
+def ranges(searches):
+    return sorted((s.condition.lower(), s.min_age, s.max_age, len(s.campaigns)) for s in searches)
+
+
+def test_overlapping_and_touching_ranges_share_a_search():
+    searches = merge_searches([campaign(20, 50, "Hyperglycemia"), campaign(40, 70, "hyperglycemia"),
+                               campaign(71, 80, "Hyperglycemia")])
+    assert ranges(searches) == [("hyperglycemia", 20, 80, 3)]
+
+
+def test_disjoint_ranges_are_searched_separately():
+    young, old = campaign(20, 30, "Hyperglycemia", "Osteoporosis"), campaign(70, 80, "Hyperglycemia")
+    searches = merge_searches([old, young])
+    assert ranges(searches) == [("hyperglycemia", 20, 30, 1), ("hyperglycemia", 70, 80, 1), ("osteoporosis", 20, 30, 1)]
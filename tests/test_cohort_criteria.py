@@ -0,0 +1,57 @@
+import pytest
+
+from cohort_criteria import CohortCriteria, CriteriaStore, define_criteria, parse_criteria, states_criteria
+
+
+def test_parse_criteria_reads_the_sentence_form():
+    assert parse_criteria("Patients aged 50 to 70 with Osteoporosis or Hyperglycemia. TERMINATE") == \
+        CohortCriteria(50, 70, ("Osteoporosis", "Hyperglycemia"))
+
+
+@pytest.mark.parametrize("text", [
+    "Patients aged 50 to 70 with no history of diabetes",
+    "Patients aged 50-70 without diabetes",
+    "Patients aged 50 to 70 who never had diabetes, with hypertension",
+    "Patients aged 50 to 70 with hypertension but not diabetes",
+])
+def test_parse_criteria_leaves_negated_criteria_to_the_llm(text):
+    assert parse_criteria(text) is None
+
+
+@pytest.mark.parametrize("text", [
+    "Male patients aged between 100 and 120 with Myocardial disease. TERMINATE",
+    "Women aged 50 to 70 with Osteoporosis",
+    "Patients aged 40 to 60 who smoke, with Hypertension",
+    "Patients aged 50 to 70 with Diabetes and Hypertension",
+    "Patients aged 50 to 70 with diabetes taking metformin",
+    "Patients aged 50 to 70 with diabetes on insulin",
+])
+def test_parse_criteria_leaves_qualified_criteria_to_the_llm(text):
+    assert parse_criteria(text) is None
+
+
+def test_parse_criteria_reads_a_plain_list_of_conditions():
+    assert parse_criteria("Patients aged between 50 and 70 with Osteoporosis, Hyperglycemia or Polyp of colon.") == \
+        CohortCriteria(50, 70, ("Osteoporosis", "Hyperglycemia", "Polyp of colon"))
+
+
+def test_parse_criteria_leaves_json_with_other_keys_to_the_llm():
+    assert parse_criteria('{"min_age": 50, "max_age": 70, "conditions": ["Osteoporosis"]}') == \
+        CohortCriteria(50, 70, ("Osteoporosis",))
+    assert parse_criteria('{"min_age": 50, "max_age": 70, "conditions": ["Osteoporosis"], "sex": "female"}') is None
+
+
+@pytest.mark.parametrize("text, states", [
+    ("Women aged 50 to 70 with Osteoporosis", True),
+    ('{"min_age": 50, "max_age": 70, "conditions": ["Osteoporosis"], "sex": "female"}', True),
+    ("The plan is not ready yet, with two questions left.", False),
+])
+def test_states_criteria_whether_or_not_they_parse(text, states):
+    assert states_criteria(text) is states
+
+
+def test_define_criteria_does_not_store_negated_criteria():
+    store = CriteriaStore("")
+    criteria, source = define_criteria("Patients aged 50 to 70 with no history of diabetes", None, store=store)
+    assert (criteria, source) == (None, "none")
+    assert len(store) == 0
@@ -0,0 +1,58 @@
+import datetime
+
+from cohort_criteria import CohortCriteria
+from cohort_refresh import _ServerClock, parse_instant, refresh_cohort
+from patient_record import PatientRecord
+
+CRITERIA = CohortCriteria(40, 70, ("Hyperglycemia",))
+
+
+def test_refresh_only_asks_for_the_changed_patients_in_the_birthdate_window(stub, client, tmp_path, monkeypatch):
+    first = refresh_cohort("campaign", CRITERIA, client=client, checkpoint_dir=str(tmp_path))
+    member = first.added[0]
+    member_id = member["patient_url"].split("/Patient/")[1].split("?")[0]
+    stub.update_patient(member_id, telecom=[{"system": "email", "value": "new@example.org"}])
+    too_old = next(i for i in stub.patients if PatientRecord.from_resource(stub.patients[i]).age() > 90)
+    stub.update_patient(too_old)
+
+    patients_seen = []
+    search_pages = client.search_pages
+
+    def spy(resource_type, params, **kwargs):
+        for page in search_pages(resource_type, params, **kwargs):
+            if resource_type == "Patient":
+                patients_seen.extend(entry["resource"]["id"] for entry in page.get("entry", []))
+            yield page
+
+    monkeypatch.setattr(client, "search_pages", spy)
+    result = refresh_cohort("campaign", CRITERIA, client=client, checkpoint_dir=str(tmp_path))
+
+    assert [patient["email"] for patient in result.updated] == ["new@example.org"]
+    assert patients_seen == [member_id]
+
+
+def test_checkpoint_ignores_the_resources_lastupdated_when_the_bundle_has_none():
+    before = datetime.datetime.now(datetime.timezone.utc)
+    clock = _ServerClock()
+    clock.page({"entry": [{"resource": {"meta": {"lastUpdated": "2100-01-01T00:00:00+00:00"}}}]})
+
+    assert clock.checkpoint("2024-01-01T00:00:00+00:00") == "2024-01-01T00:00:00+00:00"
+    assert parse_instant(clock.checkpoint(None)) < before
+
+
+def test_refresh_finds_changes_when_the_server_does_not_report_its_time(stub, client, tmp_path, monkeypatch):
+    search_pages = client.search_pages
+
+    def without_meta(resource_type, params, **kwargs):
+        for page in search_pages(resource_type, params, **kwargs):
+            page.pop("meta", None)
+            yield page
+
+    monkeypatch.setattr(client, "search_pages", without_meta)
+    first = refresh_cohort("campaign", CRITERIA, client=client, checkpoint_dir=str(tmp_path))
+    member_id = first.added[0]["patient_url"].split("/Patient/")[1].split("?")[0]
+    stub.update_patient(member_id, telecom=[{"system": "email", "value": "new@example.org"}])
+    result = refresh_cohort("campaign", CRITERIA, client=client, checkpoint_dir=str(tmp_path))
+
+    assert not result.full
+    assert [patient["email"] for patient in result.updated] == ["new@example.org"]
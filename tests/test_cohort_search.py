@@ -0,0 +1,22 @@
+from benchmarks.stub_fhir_server import concept
+from cohort_search import iter_patients_between_ages_and_condition
+
+
+def patient_urls(client, condition, **kwargs):
+    return sorted(p["patient_url"] for p in iter_patients_between_ages_and_condition(0, 120, condition, client=client, **kwargs))
+
+
+def test_server_filter_finds_the_patients_of_the_substring_match(stub, client):
+    # A hyperglycemia coding that isn't in the local SNOMED index, so only code:text= finds it
+    condition = stub.add_condition("7")
+    condition["code"] = concept("367991000119101", "Hyperglycemia due to type 2 diabetes mellitus (disorder)")
+
+    baseline = patient_urls(client, "Hyperglycemia", server_filter=False)
+    assert any("/Patient/7?" in url for url in baseline)
+    assert patient_urls(client, "Hyperglycemia", server_filter=True) == baseline
+    assert patient_urls(client, "Hyperglycemia", server_filter=True, workers=4) == baseline
+
+
+def test_server_filter_falls_back_to_the_local_match(stub, client):
+    stub.support_code_filter = False
+    assert patient_urls(client, "Osteoporosis", server_filter=True) == patient_urls(client, "Osteoporosis", server_filter=False)
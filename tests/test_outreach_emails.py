@@ -0,0 +1,64 @@
+import threading
+from types import SimpleNamespace
+
+from outreach_emails import NAME_SLOT, generate_emails, generate_templated_emails
+from outreach_pipeline import run_outreach_pipeline
+
+
+class FakeOpenAI:
+    # Answers every chat completion with `reply`, or with the prompt if reply is None
+    def __init__(self, reply=None):
+        self.reply = reply
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, **kwargs):
+        with self._lock:
+            self.calls += 1
+        content = self.reply if self.reply is not None else messages[-1]["content"]
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+
+
+def patients(n):
+    for i in range(n):
+        yield {"patient_url": f"Patient/{i}", "full_name": f"Given{i} Family{i}", "condition": "Hyperglycemia"}
+
+
+def test_generate_emails_writes_one_email_per_patient():
+    results = list(generate_emails(FakeOpenAI(), patients(100), "screening", max_concurrency=4, max_pending=3))
+    assert sorted(int(r.patient["patient_url"].split("/")[1]) for r in results) == list(range(100))
+    assert all(r.content and r.error is None for r in results)
+
+
+def test_generate_emails_reads_the_patients_as_the_completions_finish():
+    # Only a bounded window of the cohort may be read ahead of the results
+    read = []
+    cohort = (read.append(patient) or patient for patient in patients(10000))
+    results = generate_emails(FakeOpenAI(), cohort, "screening", max_concurrency=4, max_pending=6)
+    for _ in range(20):
+        next(results)
+    assert len(read) <= 20 + 4 + 6 + 1
+    results.close()
+
+
+def test_a_template_without_the_name_slot_falls_back_to_one_email_per_patient():
+    # The model ignores the slot in the template and in every email
+    client = FakeOpenAI(reply="Dear patient, please book your screening.")
+    results = list(generate_templated_emails(client, patients(5), "screening"))
+    assert client.calls == 1 + 5
+    assert all(r.content == client.reply for r in results)
+
+
+def test_the_pipeline_falls_back_to_one_email_per_patient_too():
+    client = FakeOpenAI(reply="Dear patient, please book your screening.")
+    results = []
+    run_outreach_pipeline(client, patients(5), "screening", results.append, templated=True)
+    assert client.calls == 1 + 5 and len(results) == 5
+
+
+def test_a_template_with_the_name_slot_is_filled_in_locally():
+    client = FakeOpenAI(reply=f"Dear {NAME_SLOT}, please book your screening.")
+    results = list(generate_templated_emails(client, patients(5), "screening"))
+    assert client.calls == 1
+    assert sorted(r.content for r in results)[0] == "Dear Given0 Family0, please book your screening."
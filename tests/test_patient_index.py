@@ -0,0 +1,32 @@
+import random
+
+from benchmarks.stub_fhir_server import make_condition, make_patient
+from patient_index import PatientIndex
+from patient_record import PatientRecord
+
+
+def test_index_takes_partial_birthdates_as_the_first_of_the_year_or_month():
+    rng = random.Random(0)
+    patients = [make_patient(i, rng) for i in range(3)]
+    patients[0]["birthDate"] = "1950"
+    patients[1]["birthDate"] = "1950-03"
+    resources = patients + [make_condition(i, str(i), rng) for i in range(3)]
+
+    index = PatientIndex.from_resources(resources)
+
+    assert len(index) == 3
+    found = {p["patient_url"]: p["age"] for p in index.query(0, 150, "")}
+    for patient in patients[:2]:
+        assert found[f"/Patient/{patient['id']}?_pretty=true"] == PatientRecord.from_resource(patient).age()
+
+
+def test_index_keeps_one_row_for_a_patient_included_on_several_pages():
+    rng = random.Random(0)
+    patient = make_patient(0, rng)
+    conditions = [make_condition(i, patient["id"], rng) for i in range(2)]
+    resources = [conditions[0], patient, conditions[1], patient]
+
+    index = PatientIndex.from_resources(resources)
+
+    assert len(index) == 1
+    assert len(list(index.query(0, 150, ""))) == 1
@@ -0,0 +1,24 @@
+from cohort_search import iter_patients_between_ages_and_condition
+from patient_record import PatientRecord
+
+NAMELESS = {"resourceType": "Patient", "id": "x", "birthDate": "1950-03-01"}
+
+
+def test_a_nameless_patient_without_contact_details_is_not_contactable():
+    record = PatientRecord.from_resource(NAMELESS)
+    assert (record.id, record.birth_date, record.contactable) == ("x", "1950-03-01", False)
+
+
+def test_a_contactable_patient_without_a_given_name_keeps_the_family_name():
+    patient = {**NAMELESS, "telecom": [], "maritalStatus": {"text": "S"}, "name": [{"family": "Doe"}]}
+    assert PatientRecord.from_resource(patient).full_name == "Doe"
+
+
+def test_nameless_patients_without_contact_details_are_left_out_of_the_cohort(stub, client):
+    everyone = {p["patient_url"] for p in iter_patients_between_ages_and_condition(0, 150, "", client=client)}
+    stub.patients["3"] = {key: value for key, value in stub.patients["3"].items() if key not in ("name", "telecom")}
+    stub._version += 1
+
+    cohort = {p["patient_url"] for p in iter_patients_between_ages_and_condition(0, 150, "", client=client)}
+
+    assert cohort == {url for url in everyone if "/Patient/3?" not in url}
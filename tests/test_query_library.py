@@ -0,0 +1,28 @@
+from cohort_criteria import CohortCriteria
+from query_library import QueryLibrary, QueryReuse
+
+CRITERIA = CohortCriteria(50, 70, ("Osteoporosis", "Hyperglycemia"))
+CODE = 'CRITERIA = {"min_age": 50, "max_age": 70, "conditions": ["Osteoporosis", "Hyperglycemia"]}\nprint(CRITERIA)'
+
+
+def test_library_keys_queries_on_the_whole_criteria():
+    library = QueryLibrary("")
+    library.store(CRITERIA, CODE)
+
+    assert library.lookup(CohortCriteria(50, 70, ("hyperglycemia", "OSTEOPOROSIS"))) is not None
+    assert library.lookup(CohortCriteria(40, 60, ("Osteoporosis", "Hyperglycemia"))) is None
+    assert library.lookup(CohortCriteria(50, 70, ("Osteoporosis",))) is None
+
+
+def test_reuse_leaves_criteria_the_parser_does_not_handle_to_the_llm():
+    library = QueryLibrary("")
+    library.store(CRITERIA, CODE)
+    reuse = QueryReuse(library)
+    plain = {"role": "user", "content": "Patients aged 50 to 70 with Osteoporosis or Hyperglycemia. TERMINATE"}
+    qualified = {"role": "user", "content": "Female patients aged 50 to 70 with Osteoporosis or Hyperglycemia. TERMINATE"}
+
+    assert reuse._reply(None, [qualified]) == (False, None)
+    assert reuse._reply(None, [plain, qualified]) == (False, None)
+    assert reuse.criteria is None
+    handled, reply = reuse._reply(None, [qualified, plain])
+    assert handled and "version 1" in reply
@@ -0,0 +1,36 @@
+import os
+
+from outreach_sinks import CsvSink, TextFileSink
+from run_journal import RunJournal
+
+BASE = "http://fhir.example.org/baseR4"
+MEMBER = {"patient_url": f"{BASE}/Patient/1?_pretty=true", "full_name": "Given1 Family1", "age": 60,
+          "postal_code": "01234", "MRN": "MRN-1", "email": "patient1@example.org", "condition": "Hyperglycemia"}
+
+
+def crashed_run(path):
+    # A run that wrote the email of a cohort member and of a patient the cohort doesn't have
+    journal = RunJournal(path)
+    list(journal.cohort(lambda: [MEMBER]))
+    journal.record_email(MEMBER, "Dear Given1")
+    journal.record_email({"patient_url": f"{BASE}/Patient/2?_pretty=true"}, "Dear patient")
+    journal.close()
+    return RunJournal(path)
+
+
+def test_replay_writes_the_emails_of_patients_missing_from_the_cohort_under_their_id(tmp_path):
+    journal = crashed_run(str(tmp_path / "run.jsonl"))
+    sink = TextFileSink(str(tmp_path / "emails"))
+
+    assert journal.replay(sink) == 2
+    sink.close()
+
+    assert sorted(os.listdir(tmp_path / "emails")) == ["MRN-1.txt", "patient-2.txt"]
+    assert "Dear patient" in (tmp_path / "emails" / "patient-2.txt").read_text()
+
+
+def test_replay_into_a_csv_sink(tmp_path):
+    journal = crashed_run(str(tmp_path / "run.jsonl"))
+    with CsvSink(str(tmp_path / "out.csv")) as sink:
+        journal.replay(sink)
+    assert (tmp_path / "out.csv").read_text().count("Dear") == 2
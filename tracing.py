@@ -0,0 +1,371 @@
+import atexit
+import contextvars
+import functools
+import json
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+# Write every finished span to this JSON lines file. Empty (the default) doesn't write them
+TRACE_PATH = os.getenv("TRACE_PATH", "")
+# Send the spans to an OpenTelemetry collector's OTLP/HTTP endpoint, e.g. http://localhost:4318
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "hospitalgpt")
+# Number of finished spans kept in memory; the report's totals include every span regardless
+MAX_SPANS = 100000
+# Spans sent to the collector per request
+OTLP_BATCH_SIZE = 512
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    '''
+    One timed piece of work: its name, when it started and how long it took, its parent, its
+    attributes (e.g. the URL of a request) and its counters (requests, bytes, tokens, ...).
+    A span's counters are added to its parent's when it ends, so every span carries the totals
+    of the work done inside it.
+    '''
+    __slots__ = ("name", "trace_id", "span_id", "parent", "start_ns", "duration", "attributes", "counters",
+                 "error", "child_seconds", "_start", "_lock")
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.start_ns = time.time_ns()
+        self.duration = 0.0
+        self.attributes = dict(attributes or {})
+        self.counters: Dict[str, float] = {}
+        self.error: Optional[str] = None
+        self.child_seconds = 0.0
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def set(self, **attributes) -> "Span":
+        self.attributes.update(attributes)
+        return self
+
+    def add(self, counter: str, n: float = 1) -> "Span":
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+        return self
+
+    def _finish(self, duration: float) -> None:
+        self.duration = duration
+        if self.parent is not None:
+            with self.parent._lock:
+                self.parent.child_seconds += duration
+                for counter, n in self.counters.items():
+                    self.parent.counters[counter] = self.parent.counters.get(counter, 0) + n
+
+    @property
+    def self_seconds(self) -> float:
+        # Children running in other threads can overlap, so this is never below 0
+        return max(self.duration - self.child_seconds, 0.0)
+
+    def to_dict(self) -> Dict:
+        return {"name": self.name, "trace_id": self.trace_id, "span_id": self.span_id,
+                "parent_id": self.parent.span_id if self.parent else None, "start_ns": self.start_ns,
+                "duration": round(self.duration, 6), "attributes": self.attributes, "counters": self.counters,
+                "error": self.error}
+
+
+class JsonlExporter:
+    '''
+    Appends every finished span to a JSON lines file, one object per span (see Span.to_dict).
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Span]) -> None:
+        lines = "".join(json.dumps(span.to_dict(), default=str) + "\n" for span in spans)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OtlpExporter:
+    '''
+    Sends the spans to an OpenTelemetry collector as OTLP/HTTP JSON ({endpoint}/v1/traces), in
+    batches of OTLP_BATCH_SIZE and whenever the tracer is flushed. Counters are sent as
+    attributes. If the collector can't be reached the spans are dropped, with one warning.
+    '''
+
+    def __init__(self, endpoint: str, service_name: str = SERVICE_NAME):
+        import requests
+        self.url = endpoint.rstrip("/") + ("" if endpoint.rstrip("/").endswith("/v1/traces") else "/v1/traces")
+        self.service_name = service_name
+        self.session = requests.Session()
+        self._pending: List[Span] = []
+        self._lock = threading.Lock()
+        self._warned = False
+
+    def export(self, spans: List[Span]) -> None:
+        with self._lock:
+            self._pending.extend(spans)
+            batch = self._pending if len(self._pending) >= OTLP_BATCH_SIZE else None
+            if batch:
+                self._pending = []
+        if batch:
+            self._send(batch)
+
+    def _span(self, span: Span) -> Dict:
+        attributes = {**span.attributes, **span.counters}
+        body = {"traceId": span.trace_id, "spanId": span.span_id, "name": span.name, "kind": 1,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.start_ns + int(span.duration * 1e9)),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 0}}
+        if span.parent:
+            body["parentSpanId"] = span.parent.span_id
+        return body
+
+    def _send(self, spans: List[Span]) -> None:
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "hospitalgpt.tracing"}, "spans": [self._span(s) for s in spans]}],
+        }]}
+        try:
+            r = self.session.post(self.url, json=payload, timeout=10)
+            r.raise_for_status()
+        except Exception as e:
+            if not self._warned:
+                print(f"Could not send spans to {self.url}: {e}")
+                self._warned = True
+
+    def flush(self) -> None:
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if batch:
+            self._send(batch)
+
+    def close(self) -> None:
+        self.flush()
+
+
+class SpanTotals:
+    '''
+    The spans of one name added up, for the hot spot report.
+    '''
+    __slots__ = ("name", "count", "errors", "seconds", "self_seconds", "counters")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.self_seconds = 0.0
+        self.counters: Dict[str, float] = {}
+
+    def add(self, span: Span) -> None:
+        self.count += 1
+        self.errors += span.error is not None
+        self.seconds += span.duration
+        self.self_seconds += span.self_seconds
+        for counter, n in span.counters.items():
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+
+class Tracer:
+    '''
+    Records spans around the steps of a run and reports where its time went.
+
+    A span's parent is the span open in the same thread (or context) when it starts. Work done in
+    worker threads, where there is no open span, is put under the innermost span still open in
+    the main thread, so it is counted in the step that started it. Finished spans are kept in
+    spans (the last MAX_SPANS), passed to the exporters and added up per name for report().
+
+    Example usage:
+    >>> with tracer.span("find_patients", condition="Hyperglycemia") as span:
+    ...     span.add("patients", len(patients))
+    >>> print(tracer.report())
+    '''
+
+    def __init__(self, exporters: Optional[List] = None):
+        self.exporters = list(exporters or [])
+        self.spans: Deque[Span] = deque(maxlen=MAX_SPANS)
+        self.totals: Dict[str, SpanTotals] = {}
+        self._open: List[Span] = []
+        self._lock = threading.Lock()
+
+    def start(self, name: str, **attributes) -> Span:
+        main = threading.current_thread() is threading.main_thread()
+        parent = _current.get()
+        if parent is None and not main:
+            with self._lock:
+                parent = self._open[-1] if self._open else None
+        span = Span(name, parent, attributes)
+        if main:
+            with self._lock:
+                self._open.append(span)
+        return span
+
+    def end(self, span: Span, error: Optional[BaseException] = None, duration: Optional[float] = None) -> None:
+        '''
+        Ends a span started with start(). duration defaults to the time since it started.
+        '''
+        if error is not None:
+            span.error = f"{type(error).__name__}: {error}"
+        span._finish(time.perf_counter() - span._start if duration is None else duration)
+        with self._lock:
+            if span in self._open:
+                self._open.remove(span)
+            self.spans.append(span)
+            if span.name not in self.totals:
+                self.totals[span.name] = SpanTotals(span.name)
+            self.totals[span.name].add(span)
+        for exporter in self.exporters:
+            exporter.export([span])
+
+    def span(self, name: str, **attributes) -> "_SpanContext":
+        '''
+        A context manager that times a span of work. Exceptions are recorded on the span and raised.
+        '''
+        return _SpanContext(self, name, attributes)
+
+    def record(self, name: str, seconds: float, counters: Optional[Dict[str, float]] = None, **attributes) -> Span:
+        '''
+        Records work that has already finished, e.g. an LLM call timed elsewhere, as a span that
+        ended now and took `seconds`.
+        '''
+        span = self.start(name, **attributes)
+        span.start_ns -= int(seconds * 1e9)
+        span.counters.update(counters or {})
+        self.end(span, duration=seconds)
+        return span
+
+    def flush(self) -> None:
+        for exporter in self.exporters:
+            exporter.flush()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.spans.clear()
+            self.totals.clear()
+
+    def report(self, top: int = 10) -> str:
+        '''
+        The top hot spots: the span names with the most time spent in them, not counting the
+        time of the spans inside them, with their counts, total time and counters (which do
+        include the spans inside them).
+        '''
+        totals = sorted(self.totals.values(), key=lambda t: t.self_seconds, reverse=True)[:top]
+        lines = [f"{'span':<36} {'count':>6} {'self s':>8} {'total s':>8} {'errors':>6}  counters"]
+        for t in totals:
+            counters = ", ".join(f"{k}={v:,.0f}" for k, v in sorted(t.counters.items()))
+            lines.append(f"{t.name[:36]:<36} {t.count:>6} {t.self_seconds:>8.2f} {t.seconds:>8.2f} {t.errors:>6}  {counters}")
+        return "\n".join(lines)
+
+
+class _SpanContext:
+    def __init__(self, tracer: Tracer, name: str, attributes: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self) -> Span:
+        self.span = self.tracer.start(self.name, **self.attributes)
+        self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _current.reset(self.token)
+        self.tracer.end(self.span, exc)
+
+
+def traced(name: Optional[str] = None) -> Callable:
+    '''
+    Decorates a function so every call is a span named after it. If the function returns an
+    iterator (e.g. a lazy search), the span stays open until the iterator is used up and counts
+    the items it yields. Its duration is then the time spent producing the items, not the time
+    the caller spent on them in between.
+
+    Example usage:
+    >>> @traced()
+    ... def find_patients(criteria): ...
+    '''
+    def decorate(func: Callable) -> Callable:
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            span = tracer.start(span_name)
+            token = _current.set(span)
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                tracer.end(span, e)
+                raise
+            finally:
+                _current.reset(token)
+            if isinstance(result, Iterator):
+                return _traced_iterator(span, result, time.perf_counter() - span._start)
+            tracer.end(span)
+            return result
+        return wrapper
+    return decorate
+
+
+def _traced_iterator(span: Span, items: Iterator, busy: float) -> Iterator:
+    error = None
+    try:
+        while True:
+            token = _current.set(span)
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+            finally:
+                busy += time.perf_counter() - start
+                _current.reset(token)
+            span.add("items")
+            yield item
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        tracer.end(span, error if not isinstance(error, GeneratorExit) else None, duration=busy)
+
+
+def span(name: str, **attributes) -> _SpanContext:
+    return tracer.span(name, **attributes)
+
+
+def _default_exporters() -> List:
+    exporters = []
+    if TRACE_PATH:
+        exporters.append(JsonlExporter(TRACE_PATH))
+    if OTLP_ENDPOINT:
+        exporters.append(OtlpExporter(OTLP_ENDPOINT))
+    return exporters
+
+
+# The tracer shared by the whole run, exporting as configured by TRACE_PATH and OTEL_EXPORTER_OTLP_ENDPOINT
+tracer = Tracer(_default_exporters())
+atexit.register(tracer.flush)
@@ -0,0 +1,167 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence
+
+# Modules the worker imports when it starts, so the code it runs doesn't pay for them. The ones
+# that aren't installed are skipped
+WARM_IMPORTS = ("requests", "json", "csv", "datetime", "dateutil.relativedelta", "pandas")
+# Seconds a code block may run before the worker is killed and started again
+DEFAULT_EXECUTION_TIMEOUT = 60
+PYTHON_LANGUAGES = ("python", "py", "python3", "")
+
+
+class WarmPythonExecutor:
+    '''
+    An autogen code executor that runs Python code blocks in a long-lived worker process instead
+    of starting a new interpreter for every block, as LocalCommandLineCodeExecutor does. The
+    worker imports WARM_IMPORTS once when it starts; each block then runs in a fresh namespace
+    (as __main__, in work_dir), with everything it prints, including from child processes,
+    returned as its output. A block that runs longer than `timeout` seconds kills the worker,
+    which is started again for the next block. Shell blocks are run by a
+    LocalCommandLineCodeExecutor in the same work_dir.
+
+    on_result, if set, is called with the code blocks and the CodeResult of every execution.
+
+    Example usage:
+    >>> executor = UserProxyAgent("Executor", code_execution_config={"executor": WarmPythonExecutor("groupchat")})
+    '''
+
+    def __init__(self, work_dir: str = ".", timeout: int = DEFAULT_EXECUTION_TIMEOUT,
+                 preload: Sequence[str] = WARM_IMPORTS,
+                 on_result: Optional[Callable[[List, object], None]] = None):
+        from autogen.coding import LocalCommandLineCodeExecutor, MarkdownCodeExtractor
+        self.work_dir = Path(work_dir).resolve()
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.timeout = timeout
+        self.preload = list(preload)
+        self.on_result = on_result
+        self.executions = 0
+        self.worker_starts = 0
+        self._extractor = MarkdownCodeExtractor()
+        self._shell = LocalCommandLineCodeExecutor(timeout=timeout, work_dir=self.work_dir)
+        self._process: Optional[subprocess.Popen] = None
+        self._reader = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+
+    @property
+    def code_extractor(self):
+        return self._extractor
+
+    def _start(self) -> subprocess.Popen:
+        if self._process is None or self._process.poll() is not None:
+            self._process = subprocess.Popen([sys.executable, "-u", os.path.abspath(__file__), *self.preload],
+                                             cwd=self.work_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                             stderr=subprocess.DEVNULL)
+            self.worker_starts += 1
+        return self._process
+
+    def run_python(self, code: str):
+        '''
+        Runs Python code in the worker and returns its CodeResult.
+        '''
+        from autogen.coding import CodeResult
+        with self._lock:
+            process = self._start()
+            try:
+                process.stdin.write(json.dumps({"code": code}).encode() + b"\n")
+                process.stdin.flush()
+                line = self._reader.submit(process.stdout.readline).result(timeout=self.timeout)
+            except FutureTimeout:
+                self._stop()
+                return CodeResult(exit_code=124, output=f"Timeout: the code ran for more than {self.timeout} seconds")
+            except (BrokenPipeError, OSError) as e:
+                self._stop()
+                return CodeResult(exit_code=1, output=f"The worker process failed: {e}")
+            if not line:
+                self._stop()
+                return CodeResult(exit_code=1, output="The worker process exited while running the code")
+            reply = json.loads(line)
+            return CodeResult(exit_code=reply["exit_code"], output=reply["output"])
+
+    def execute_code_blocks(self, code_blocks: List):
+        from autogen.coding import CodeResult
+        from tracing import tracer
+        self.executions += 1
+        outputs = []
+        exit_code = 0
+        with tracer.span("execute_code", blocks=len(code_blocks)) as span:
+            for block in code_blocks:
+                if block.language.lower() in PYTHON_LANGUAGES:
+                    result = self.run_python(block.code)
+                else:
+                    result = self._shell.execute_code_blocks([block])
+                outputs.append(result.output)
+                exit_code = result.exit_code
+                if exit_code != 0:
+                    break
+            span.set(exit_code=exit_code).add("code.executions")
+        result = CodeResult(exit_code=exit_code, output="".join(outputs))
+        if self.on_result:
+            self.on_result(code_blocks, result)
+        return result
+
+    def _stop(self) -> None:
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
+    def restart(self) -> None:
+        with self._lock:
+            self._stop()
+
+    def close(self) -> None:
+        self.restart()
+        self._reader.shutdown(wait=False)
+
+
+def _serve(preload: Sequence[str]) -> None:
+    # The worker: reads one JSON request per line on stdin and answers each on the original
+    # stdout. File descriptors 1 and 2 point at a temporary file while the code runs, so the
+    # output of child processes is captured too and can't get mixed up with the replies
+    import importlib
+    import traceback
+    replies = os.fdopen(os.dup(1), "wb")
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+    cwd = os.getcwd()
+    for line in sys.stdin:
+        code = json.loads(line)["code"]
+        exit_code = 0
+        with tempfile.TemporaryFile() as log:
+            saved = os.dup(1), os.dup(2)
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+            try:
+                exec(compile(code, "<code>", "exec"), {"__name__": "__main__", "__builtins__": __builtins__})
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except BaseException as e:
+                # Without the worker's own frame, so the traceback starts in the code
+                traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os.dup2(saved[0], 1)
+                os.dup2(saved[1], 2)
+                os.close(saved[0])
+                os.close(saved[1])
+                os.chdir(cwd)
+            log.seek(0)
+            output = log.read().decode("utf-8", "replace")
+        replies.write(json.dumps({"exit_code": exit_code, "output": output}).encode() + b"\n")
+        replies.flush()
+
+
+if __name__ == "__main__":
+    _serve(sys.argv[1:])